@@ -0,0 +1,128 @@
+import asyncio
+import math
+import time
+from collections import deque
+from typing import Deque, Dict, Iterable, Optional
+from starlette.responses import JSONResponse
+from metrics import ADMISSION_QUEUED, ADMISSION_RUNNING, ADMISSION_SHED, ADMISSION_WAIT_SECONDS
+
+
+class Overloaded(Exception):
+    def __init__(self, status_code: int, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+# At most `limit` requests of a lane run at once and at most `queue_size` wait, first
+# come first served. A request is turned away at once when the queue is full (429) or
+# when the wait it can expect - queue length times the recent service time over the
+# limit - is already past `max_wait` (503); one that does wait longer gets a 503 too.
+class Lane:
+    def __init__(self, name: str, limit: int, queue_size: int, max_wait: float):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.running = 0
+        self.waiters: Deque[asyncio.Future] = deque()
+        self.service_seconds = 0.0  # Moving average of how long admitted requests run
+
+    def expected_wait(self) -> float:
+        return (len(self.waiters) + 1) * self.service_seconds / self.limit
+
+    def _shed(self, status_code: int, reason: str) -> Overloaded:
+        ADMISSION_SHED.inc(self.name, reason)
+        return Overloaded(status_code, reason, max(1, math.ceil(self.expected_wait())))
+
+    def _publish(self):
+        ADMISSION_RUNNING.set(self.running, self.name)
+        ADMISSION_QUEUED.set(len(self.waiters), self.name)
+
+    async def acquire(self):
+        if self.running < self.limit and not self.waiters:
+            self.running += 1
+            self._publish()
+            ADMISSION_WAIT_SECONDS.observe(0.0, self.name)
+            return
+        if len(self.waiters) >= self.queue_size:
+            raise self._shed(429, "queue_full")
+        if self.expected_wait() > self.max_wait:
+            raise self._shed(503, "latency")
+
+        queued = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        self.waiters.append(waiter)
+        timer = loop.call_later(self.max_wait, lambda: waiter.done() or waiter.set_exception(self._shed(503, "timeout")))
+        self._publish()
+        try:
+            await waiter  # release() hands over its slot by resolving this
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled() and waiter.exception() is None:
+                self._hand_over()  # Given a slot just as the client went away
+            raise
+        finally:
+            timer.cancel()
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+            self._publish()
+        ADMISSION_WAIT_SECONDS.observe(time.perf_counter() - queued, self.name)
+
+    def release(self, seconds: float):
+        self.service_seconds = seconds if not self.service_seconds else 0.9 * self.service_seconds + 0.1 * seconds
+        self._hand_over()
+
+    def _hand_over(self):
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():  # Skip requests that timed out or went away
+                waiter.set_result(None)
+                self._publish()
+                return
+        self.running -= 1
+        self._publish()
+
+
+# ASGI middleware putting each request in a lane before it reaches the application.
+# Every listed write route gets a lane of its own, other writes share one, and reads
+# (GET/HEAD) share a separate lane, so reads keep flowing when writes back up. Paths in
+# `exempt` (long-polls, metrics) and CORS preflights are not limited.
+class AdmissionMiddleware:
+    def __init__(self, app, write_routes: Iterable[str], write_limit: int = 16, read_limit: int = 64,
+                 queue_size: int = 100, max_wait: float = 0.5, exempt: Iterable[str] = ()):
+        self.app = app
+        self.routes: Dict[str, Lane] = {path: Lane(path, write_limit, queue_size, max_wait) for path in write_routes}
+        self.writes = Lane("write", write_limit, queue_size, max_wait)
+        self.reads = Lane("read", read_limit, queue_size, max_wait)
+        self.exempt = set(exempt)
+
+    def lane(self, scope) -> Optional[Lane]:
+        method, path = scope["method"], scope["path"]
+        if method == "OPTIONS" or path in self.exempt:
+            return None
+        if method in ("GET", "HEAD"):
+            return self.reads
+        return self.routes.get(path, self.writes)
+
+    async def __call__(self, scope, receive, send):
+        lane = self.lane(scope) if scope["type"] == "http" else None
+        if lane is None:
+            await self.app(scope, receive, send)
+            return
+        try:
+            await lane.acquire()
+        except Overloaded as e:
+            response = JSONResponse(
+                {"detail": "Server is overloaded; retry later."},
+                status_code=e.status_code,
+                headers={"Retry-After": str(e.retry_after)},
+            )
+            await response(scope, receive, send)
+            return
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            lane.release(time.perf_counter() - started)
@@ -0,0 +1,83 @@
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+# Watches the products touched by each stock change and raises one low-stock alert
+# when a product drops to its threshold. The alert re-arms only once stock climbs
+# back above threshold + hysteresis, so a product hovering around the threshold
+# does not alert repeatedly. The armed/fired state lives on the product document
+# (low_stock_alert), flipped with a conditional update so only one worker sends it.
+# Fired alerts are collected for `digest_window` seconds and sent as one email.
+class ThresholdMonitor:
+    def __init__(self, db, notifier, hysteresis_ratio: float = 0.1, min_hysteresis: int = 1,
+                 digest_window: float = 60):
+        self.db = db
+        self.notifier = notifier
+        self.hysteresis_ratio = hysteresis_ratio
+        self.min_hysteresis = min_hysteresis
+        self.digest_window = digest_window
+        self.pending: Dict[str, dict] = {}
+        self.flusher: Optional[asyncio.Task] = None
+        self.fired = 0
+
+    def hysteresis(self, threshold: int) -> int:
+        return max(self.min_hysteresis, int(threshold * self.hysteresis_ratio))
+
+    # `products` are post-update documents as returned by the write, so no extra read is needed
+    async def evaluate(self, products: Iterable[dict]):
+        for product in products:
+            threshold = product.get("threshold")
+            if threshold is None:
+                continue
+            quantity = product["stock_quantity"]
+            alerted = product.get("low_stock_alert", False)
+
+            if quantity <= threshold and not alerted:
+                result = await self.db.products.update_one(
+                    {"_id": product["_id"], "low_stock_alert": {"$ne": True}},
+                    {"$set": {"low_stock_alert": True, "low_stock_alerted_at": datetime.now(timezone.utc)}},
+                )
+                product["low_stock_alert"] = True
+                if result.modified_count:
+                    self._queue(product)
+            elif quantity > threshold + self.hysteresis(threshold) and alerted:
+                # Only while stock is still above the re-arm level: a sale since this
+                # document was read may have taken it back down, and the alert stands
+                result = await self.db.products.update_one(
+                    {"_id": product["_id"], "stock_quantity": {"$gt": threshold + self.hysteresis(threshold)}},
+                    {"$set": {"low_stock_alert": False}},
+                )
+                if result.modified_count:
+                    product["low_stock_alert"] = False
+
+    def _queue(self, product: dict):
+        self.fired += 1
+        self.pending[product["product_id"]] = product
+        if self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.create_task(self._flush_later(), name="low-stock-digest")
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.digest_window)
+        self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        products, self.pending = list(self.pending.values()), {}
+        lines = [
+            f"Product: {p['name']} ({p['product_id']})\nCurrent Stock: {p['stock_quantity']}\nThreshold: {p['threshold']}\n"
+            for p in products
+        ]
+        self.notifier.notify(f"Low Stock Alert: {len(products)} product(s)", "\n".join(lines))
+
+    # Send whatever is still waiting, e.g. on shutdown
+    async def stop(self):
+        if self.flusher is not None:
+            self.flusher.cancel()
+            await asyncio.gather(self.flusher, return_exceptions=True)
+            self.flusher = None
+        self.flush()
@@ -0,0 +1,200 @@
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+from pymongo import UpdateOne
+
+# Daily rollups, updated incrementally by every write so reports read O(days x keys)
+# documents instead of scanning the raw history. Days are UTC dates, for sales and
+# stock movements alike:
+#   sales_daily             {_id: {product, day}}  quantity, revenue, lines
+#   manager_revenue_daily   {_id: {manager, day}}  revenue, orders
+#   stock_movements_daily   {_id: {product_id, day}}  added, adjusted, sold, installed, returned, reconciled, closing_stock
+SALES_DAILY = "sales_daily"
+MANAGER_REVENUE_DAILY = "manager_revenue_daily"
+STOCK_MOVEMENTS_DAILY = "stock_movements_daily"
+
+# stock_log action -> movement counter; "update" and "reconcile" keep their sign, the rest are counted as positive units
+MOVEMENT_FIELDS = {
+    "add": "added", "update": "adjusted", "sale": "sold", "installation": "installed", "return": "returned",
+    "reconcile": "reconciled",
+}
+SIGNED_ACTIONS = ("update", "reconcile")
+
+
+def day_of(when: Optional[datetime] = None) -> str:
+    return (when or datetime.now(timezone.utc)).strftime("%Y-%m-%d")
+
+
+def day_range(start: Optional[str], end: Optional[str]) -> dict:
+    condition = {}
+    if start:
+        condition["$gte"] = start
+    if end:
+        condition["$lte"] = end
+    return {"_id.day": condition} if condition else {}
+
+
+# Fold a batch of stock_log entries into the per-product daily movement rollup
+async def track_stock_movements(db, entries: List[dict]):
+    buckets: Dict[tuple, dict] = {}
+    for entry in entries:
+        key = (entry["product_id"], day_of(entry["date"]))
+        bucket = buckets.setdefault(key, {"inc": {}, "product_name": entry["product_name"]})
+        field = MOVEMENT_FIELDS[entry["action"]]
+        quantity = entry["quantity_changed"] if entry["action"] in SIGNED_ACTIONS else abs(entry["quantity_changed"])
+        bucket["inc"][field] = bucket["inc"].get(field, 0) + quantity
+        bucket["closing_stock"] = entry["remaining_stock"]
+    if not buckets:
+        return
+    await db.db[STOCK_MOVEMENTS_DAILY].bulk_write([
+        UpdateOne(
+            {"_id": {"product_id": product_id, "day": day}},
+            {"$inc": bucket["inc"], "$set": {"product_name": bucket["product_name"], "closing_stock": bucket["closing_stock"]}},
+            upsert=True,
+        )
+        for (product_id, day), bucket in buckets.items()
+    ], ordered=False)
+
+
+# Fold a batch of newly inserted sale records into the product and manager rollups
+async def track_sales(db, sales: List[dict]):
+    products: Dict[tuple, dict] = {}
+    managers: Dict[tuple, dict] = {}
+    for sale in sales:
+        day = day_of(sale["date_added"])
+        manager = managers.setdefault((sale["manager_name"], day), {"revenue": 0.0, "orders": 0})
+        manager["revenue"] += sale["total_amount"]
+        manager["orders"] += 1
+        for line in sale["products"]:
+            product = products.setdefault((line["product_name"], day), {"quantity": 0, "revenue": 0.0, "lines": 0})
+            product["quantity"] += line["quantity"]
+            product["revenue"] += line["amount"]
+            product["lines"] += 1
+    if products:
+        await db.db[SALES_DAILY].bulk_write([
+            UpdateOne({"_id": {"product": name, "day": day}}, {"$inc": totals}, upsert=True)
+            for (name, day), totals in products.items()
+        ], ordered=False)
+    if managers:
+        await db.db[MANAGER_REVENUE_DAILY].bulk_write([
+            UpdateOne({"_id": {"manager": name, "day": day}}, {"$inc": totals}, upsert=True)
+            for (name, day), totals in managers.items()
+        ], ordered=False)
+
+
+async def sales_per_product(db, start: Optional[str], end: Optional[str], product_name: Optional[str]) -> List[dict]:
+    query = day_range(start, end)
+    if product_name:
+        query["_id.product"] = product_name
+    rows = db.db[SALES_DAILY].find(query).sort([("_id.day", 1), ("_id.product", 1)])
+    return [
+        {"day": row["_id"]["day"], "product_name": row["_id"]["product"],
+         "quantity": row.get("quantity", 0), "revenue": row.get("revenue", 0.0), "lines": row.get("lines", 0)}
+        async for row in rows
+    ]
+
+
+async def revenue_per_manager(db, start: Optional[str], end: Optional[str]) -> List[dict]:
+    pipeline = [
+        {"$match": day_range(start, end)},
+        {"$group": {"_id": "$_id.manager", "revenue": {"$sum": "$revenue"}, "orders": {"$sum": "$orders"}}},
+        {"$sort": {"revenue": -1}},
+    ]
+    rows = await db.db[MANAGER_REVENUE_DAILY].aggregate(pipeline)
+    return [{"manager_name": row["_id"], "revenue": row["revenue"], "orders": row["orders"]} async for row in rows]
+
+
+# Units that left stock over the period divided by the average end-of-day stock on the days with movements
+async def stock_turnover(db, start: Optional[str], end: Optional[str]) -> List[dict]:
+    pipeline = [
+        {"$match": day_range(start, end)},
+        {"$sort": {"_id.day": 1}},  # So the name comes from the newest day
+        {"$group": {
+            "_id": "$_id.product_id",
+            "product_name": {"$last": "$product_name"},
+            "sold": {"$sum": "$sold"},
+            "installed": {"$sum": "$installed"},
+            "returned": {"$sum": "$returned"},
+            "average_stock": {"$avg": "$closing_stock"},
+        }},
+        {"$set": {"units_out": {"$subtract": [{"$add": ["$sold", "$installed"]}, "$returned"]}}},
+        {"$set": {"turnover": {"$cond": [
+            {"$gt": ["$average_stock", 0]}, {"$divide": ["$units_out", "$average_stock"]}, None,
+        ]}}},
+        {"$sort": {"turnover": -1}},
+    ]
+    rows = await db.db[STOCK_MOVEMENTS_DAILY].aggregate(pipeline)
+    return [
+        {"product_id": row["_id"], "product_name": row["product_name"], "units_out": row["units_out"],
+         "average_stock": row["average_stock"], "turnover": row["turnover"]}
+        async for row in rows
+    ]
+
+
+def low_stock(products: List[dict]) -> List[dict]:
+    rows = [
+        {"product_id": p["product_id"], "name": p["name"], "stock_quantity": p["stock_quantity"], "threshold": p["threshold"]}
+        for p in products if p["stock_quantity"] <= p.get("threshold", 0)
+    ]
+    return sorted(rows, key=lambda row: row["stock_quantity"] - row["threshold"])
+
+
+# Start of the first month the archive does not hold for `collection`, if it holds any
+def archived_until(archive, collection: str) -> Optional[datetime]:
+    parts = archive.parts(collection) if archive is not None else []
+    return max((part["end"] for part in parts), default=None)
+
+
+# Recompute the rollups from the raw collections, for backfilling or repairing them.
+# Months already moved to the archive are no longer in MongoDB, so their buckets are
+# kept and only the days after them are rebuilt. Returns the first rebuilt day per
+# source collection (None: all of it).
+async def rebuild_rollups(db, archive=None) -> Dict[str, Optional[str]]:
+    sales_from = archived_until(archive, "sales")
+    log_from = archived_until(archive, "stock_log")
+    for name, since in ((SALES_DAILY, sales_from), (MANAGER_REVENUE_DAILY, sales_from), (STOCK_MOVEMENTS_DAILY, log_from)):
+        await db.db[name].delete_many({"_id.day": {"$gte": day_of(since)}} if since else {})
+    recent_sales = [{"$match": {"date_added": {"$gte": sales_from}}}] if sales_from else []
+    recent_log = [{"$match": {"date": {"$gte": log_from}}}] if log_from else []
+
+    day = {"$dateToString": {"format": "%Y-%m-%d", "date": "$date_added"}}
+    await (await db.sales.aggregate([
+        *recent_sales,
+        {"$unwind": "$products"},
+        {"$group": {
+            "_id": {"product": "$products.product_name", "day": day},
+            "quantity": {"$sum": "$products.quantity"},
+            "revenue": {"$sum": "$products.amount"},
+            "lines": {"$sum": 1},
+        }},
+        {"$merge": {"into": SALES_DAILY, "whenMatched": "replace"}},
+    ])).to_list(None)
+    await (await db.sales.aggregate([
+        *recent_sales,
+        {"$group": {"_id": {"manager": "$manager_name", "day": day}, "revenue": {"$sum": "$total_amount"}, "orders": {"$sum": 1}}},
+        {"$merge": {"into": MANAGER_REVENUE_DAILY, "whenMatched": "replace"}},
+    ])).to_list(None)
+
+    def moved(action, signed=False):
+        quantity = "$quantity_changed" if signed else {"$abs": "$quantity_changed"}
+        return {"$sum": {"$cond": [{"$eq": ["$action", action]}, quantity, 0]}}
+
+    await (await db.stock_log.aggregate([
+        *recent_log,
+        {"$sort": {"date": 1, "_id": 1}},
+        {"$group": {
+            "_id": {"product_id": "$product_id", "day": {"$dateToString": {"format": "%Y-%m-%d", "date": "$date"}}},
+            "product_name": {"$last": "$product_name"},
+            "added": moved("add"),
+            "adjusted": moved("update", signed=True),
+            "sold": moved("sale"),
+            "installed": moved("installation"),
+            "returned": moved("return"),
+            "reconciled": moved("reconcile", signed=True),
+            "closing_stock": {"$last": "$remaining_stock"},
+        }},
+        {"$merge": {"into": STOCK_MOVEMENTS_DAILY, "whenMatched": "replace"}},
+    ])).to_list(None)
+    return {
+        "sales": day_of(sales_from) if sales_from else None,
+        "stock_log": day_of(log_from) if log_from else None,
+    }
@@ -0,0 +1,342 @@
+import asyncio
+import functools
+import json
+import logging
+import operator
+import os
+import socket
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:  # Optional; without it nothing is archived and reads only use MongoDB
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+# Collection -> the datetime field that decides a document's month
+ARCHIVED = {"sales": "date_added", "installations": "date_added", "returns": "date_added", "stock_log": "date"}
+MANIFEST = "manifest.json"
+ARCHIVE_LEASE = "archive_lease"  # {_id: "archive", owner, lease_until}
+PART_ROWS = 200000  # Most documents per Parquet file, bounding the memory one run needs
+
+
+def month_start(when: datetime) -> datetime:
+    return datetime(when.year, when.month, 1)
+
+
+def next_month(when: datetime) -> datetime:
+    return datetime(when.year + when.month // 12, when.month % 12 + 1, 1)
+
+
+# Dates are compared as naive UTC, which is how the driver returns them
+def naive_utc(when: datetime) -> datetime:
+    return when.astimezone(timezone.utc).replace(tzinfo=None) if when.tzinfo else when
+
+
+# A query date as MongoDB compares it: BSON dates only keep milliseconds
+def bson_date(when: datetime) -> datetime:
+    when = naive_utc(when)
+    return when.replace(microsecond=when.microsecond // 1000 * 1000)
+
+
+# Apply a MongoDB inclusion projection, including one level into arrays of documents
+# ("products.quantity")
+def project(doc: dict, fields: dict) -> dict:
+    wanted: Dict[str, set] = {"_id": set()}
+    for name in fields:
+        top, _, sub = name.partition(".")
+        wanted.setdefault(top, set()).add(sub)
+    projected = {}
+    for name, value in doc.items():
+        subs = wanted.get(name)
+        if subs is None:
+            continue
+        if "" in subs or not subs:
+            projected[name] = value
+        elif isinstance(value, list):
+            projected[name] = [
+                {key: item[key] for key in item if key in subs} for item in value if isinstance(item, dict)
+            ]
+        elif isinstance(value, dict):
+            projected[name] = {key: value[key] for key in value if key in subs}
+    return projected
+
+
+# Raised when another worker took over the archive lease during a run
+class LeaseLost(Exception):
+    pass
+
+
+# Moves sales, installations, returns and stock_log documents older than `horizon_days`
+# out of MongoDB into zstd-compressed Parquet files, one directory per collection and
+# month (sales/2024-01/part-<last _id>.parquet), listed in manifest.json. Only whole
+# months are archived, so a month's files never change once written. Each part is
+# written and added to the manifest before its documents are deleted, and the next part
+# starts after the manifest's last _id, so an interrupted run resumes without
+# duplicates. A lease in MongoDB keeps workers sharing `root` from archiving at once; it
+# is renewed before every part is written and before its documents are deleted, and a
+# run that finds the lease taken over stops where it is.
+class Archive:
+    def __init__(self, db, root: Optional[str], horizon_days: int = 365, run_every: float = 86400, lease: float = 3600):
+        self.db = db
+        self.root = root
+        self.horizon = timedelta(days=horizon_days)
+        self.run_every = run_every
+        self.lease = lease
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.manifest: Dict[str, List[dict]] = {}
+        self.manifest_mtime: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.root) and pa is not None
+
+    # Reload the manifest when another worker has rewritten it
+    def parts(self, collection: str) -> List[dict]:
+        if not self.enabled:
+            return []
+        path = os.path.join(self.root, MANIFEST)
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return []
+        if mtime != self.manifest_mtime:
+            with open(path) as f:
+                manifest = json.load(f)
+            for parts in manifest.values():
+                for part in parts:
+                    part["start"] = datetime.fromisoformat(part["start"])
+                    part["end"] = datetime.fromisoformat(part["end"])
+            self.manifest, self.manifest_mtime = manifest, mtime
+        return self.manifest.get(collection, [])
+
+    def _save_manifest(self, manifest: Dict[str, List[dict]]):
+        encoded = {
+            collection: [{**part, "start": part["start"].isoformat(), "end": part["end"].isoformat()} for part in parts]
+            for collection, parts in manifest.items()
+        }
+        path = os.path.join(self.root, MANIFEST)
+        with open(path + ".tmp", "w") as f:
+            json.dump(encoded, f, indent=1)
+        os.replace(path + ".tmp", path)
+
+    # True if a query on `collection` over [start, ...] may need archived documents
+    def covers(self, collection: str, start: Optional[datetime]) -> bool:
+        parts = self.parts(collection)
+        return bool(parts) and (start is None or naive_utc(start) < max(part["end"] for part in parts))
+
+    async def _take_lease(self) -> bool:
+        now = datetime.now(timezone.utc)
+        try:
+            taken = await self.db.db[ARCHIVE_LEASE].find_one_and_update(
+                {"_id": "archive", "$or": [{"lease_until": {"$lt": now}}, {"owner": self.owner}]},
+                {"$set": {"owner": self.owner, "lease_until": now + timedelta(seconds=self.lease)}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            return False  # Held by another worker
+        return taken is not None
+
+    async def _renew_lease(self):
+        if not await self._take_lease():
+            raise LeaseLost()
+
+    async def _release_lease(self):
+        await self.db.db[ARCHIVE_LEASE].delete_one({"_id": "archive", "owner": self.owner})
+
+    def _write_part(self, collection: str, month: datetime, docs: List[dict]) -> dict:
+        object_ids = sorted({name for doc in docs for name, value in doc.items() if isinstance(value, ObjectId)})
+        names = list(dict.fromkeys(name for doc in docs for name in doc))
+        table = pa.table({
+            name: [str(doc[name]) if name in object_ids and name in doc else doc.get(name) for doc in docs]
+            for name in names
+        })
+        relative = os.path.join(collection, month.strftime("%Y-%m"), f"part-{docs[-1]['_id']}.parquet")
+        path = os.path.join(self.root, relative)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        pq.write_table(table, path + ".tmp", compression="zstd")
+        os.replace(path + ".tmp", path)
+        return {
+            "file": relative,
+            "month": month.strftime("%Y-%m"),
+            "start": month,
+            "end": next_month(month),
+            "rows": len(docs),
+            "min_id": str(docs[0]["_id"]),
+            "max_id": str(docs[-1]["_id"]),
+            "columns": table.column_names,
+            "object_ids": object_ids,
+        }
+
+    async def _archive_month(self, collection: str, field: str, month: datetime) -> int:
+        archived = 0
+        while True:
+            done = [part for part in self.parts(collection) if part["month"] == month.strftime("%Y-%m")]
+            query = {field: {"$gte": month, "$lt": next_month(month)}}
+            await self._renew_lease()
+            if done:
+                last = ObjectId(max(part["max_id"] for part in done))
+                # Whatever an interrupted run archived but did not delete yet
+                await self.db.db[collection].delete_many({**query, "_id": {"$lte": last}})
+                query["_id"] = {"$gt": last}
+            docs = await self.db.db[collection].find(query).sort("_id", 1).limit(PART_ROWS).to_list(None)
+            if not docs:
+                return archived
+            part = await asyncio.to_thread(self._write_part, collection, month, docs)
+            manifest = {name: list(parts) for name, parts in self.manifest.items()}
+            manifest.setdefault(collection, []).append(part)
+            await asyncio.to_thread(self._save_manifest, manifest)
+            self.manifest = manifest
+            await self._renew_lease()
+            await self.db.db[collection].delete_many({**query, "_id": {"$lte": docs[-1]["_id"]}})
+            archived += len(docs)
+
+    # Archive every whole month that ended before the horizon; returns the documents moved
+    async def run(self) -> int:
+        if not self.enabled or not await self._take_lease():
+            return 0
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            cutoff = month_start(naive_utc(datetime.now(timezone.utc) - self.horizon))
+            archived = 0
+            for collection, field in ARCHIVED.items():
+                oldest = await self.db.db[collection].find_one({field: {"$lt": cutoff}}, {field: 1}, sort=[(field, 1)])
+                if oldest is None:
+                    continue
+                month = month_start(oldest[field])
+                while month < cutoff:
+                    archived += await self._archive_month(collection, field, month)
+                    month = next_month(month)
+            return archived
+        except LeaseLost:
+            logger.warning("Archive lease was taken over by another worker; stopping this run")
+            return archived
+        finally:
+            await self._release_lease()
+
+    async def _run(self):
+        while True:
+            try:
+                archived = await self.run()
+                if archived:
+                    logger.info("Archived %d documents to %s", archived, self.root)
+            except Exception as e:
+                logger.error("Archiving failed: %s", e)
+            await asyncio.sleep(self.run_every)
+
+    def start(self):
+        if self.enabled:
+            self.task = asyncio.create_task(self._run(), name="archive")
+        elif self.root:
+            logger.warning("ARCHIVE_DIR is set but pyarrow is not installed; nothing will be archived")
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    # Split a MongoDB query into a pyarrow filter for top-level fields and conditions on
+    # array elements ("products.product_name") that are checked row by row
+    @staticmethod
+    def _filters(query: dict, object_ids: List[str]) -> Tuple[list, Dict[str, object], List[str]]:
+        expressions, residual, filtered = [], {}, []
+        for name, condition in query.items():
+            if "." in name:
+                residual[name] = condition
+                continue
+            conditions = condition if isinstance(condition, dict) else {"$eq": condition}
+            filtered.append(name)
+            for op, value in conditions.items():
+                if isinstance(value, ObjectId) or name in object_ids:
+                    value = str(value)
+                elif isinstance(value, datetime):
+                    value = bson_date(value)
+                field = pc.field(name)
+                expressions.append({
+                    "$eq": field == value, "$gt": field > value, "$gte": field >= value,
+                    "$lt": field < value, "$lte": field <= value,
+                }[op])
+        return expressions, residual, filtered
+
+    @staticmethod
+    def _matches(doc: dict, residual: Dict[str, object]) -> bool:
+        for name, value in residual.items():
+            array, key = name.split(".", 1)
+            if not any(isinstance(item, dict) and item.get(key) == value for item in doc.get(array) or []):
+                return False
+        return True
+
+    @staticmethod
+    def _overlaps(part: dict, query: dict, field: str) -> bool:
+        after = query.get("_id", {}).get("$gt")
+        if after is not None and part["max_id"] <= str(after):
+            return False
+        dates = {op: bson_date(value) for op, value in query.get(field, {}).items()}
+        if "$gte" in dates and dates["$gte"] >= part["end"]:
+            return False
+        if "$lte" in dates and dates["$lte"] < part["start"]:
+            return False
+        return True
+
+    def _read_part(self, part: dict, query: dict, fields: Optional[dict], limit: Optional[int]) -> List[dict]:
+        expressions, residual, filtered = self._filters(query, part["object_ids"])
+        if any(name not in part["columns"] for name in filtered):
+            return []  # A condition on a field no document in the part has never matches
+        columns = None
+        if fields:
+            needed = {name.split(".", 1)[0] for name in [*fields, *residual]} | {"_id"}
+            columns = [name for name in part["columns"] if name in needed]
+        table = pq.read_table(
+            os.path.join(self.root, part["file"]),
+            columns=columns,
+            filters=functools.reduce(operator.and_, expressions) if expressions else None,
+            memory_map=True,
+        )
+        if limit is not None and not residual:
+            table = table.slice(0, limit)
+        docs = []
+        for row in table.to_pylist():
+            if residual and not self._matches(row, residual):
+                continue
+            doc = {
+                name: ObjectId(value) if name in part["object_ids"] else value
+                for name, value in row.items()
+                if value is not None
+            }
+            docs.append(project(doc, fields) if fields else doc)
+            if limit is not None and len(docs) >= limit:
+                break
+        return docs
+
+    # Matching archived documents in _id order, one list per Parquet part, read with
+    # memory-mapped, column-pruned reads off the event loop. Documents come back as
+    # MongoDB returned them: ObjectIds restored and fields the original did not have left out.
+    async def batches(self, collection: str, query: dict, fields: Optional[dict] = None,
+                      limit: Optional[int] = None) -> AsyncIterator[List[dict]]:
+        field = ARCHIVED[collection]
+        for part in sorted(self.parts(collection), key=lambda p: p["min_id"]):
+            if not self._overlaps(part, query, field):
+                continue
+            docs = await asyncio.to_thread(self._read_part, part, query, fields, limit)
+            if docs:
+                yield docs
+            if limit is not None:
+                limit -= len(docs)
+                if limit <= 0:
+                    return
+
+    async def find(self, collection: str, query: dict, fields: Optional[dict] = None, limit: Optional[int] = None) -> List[dict]:
+        docs = []
+        async for batch in self.batches(collection, query, fields, limit):
+            docs += batch
+        return docs
@@ -0,0 +1,143 @@
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import List, Optional
+from pymongo.errors import BulkWriteError
+from analytics import track_stock_movements
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS = "migrations"  # {_id: migration name, done_at}
+
+
+# stock_log stays a regular collection: /view-logs/, the change feed and reconciliation
+# all walk it in _id order, which a time-series collection can only answer by unpacking
+# and sorting every bucket. Deployments that converted it are told to copy it back.
+async def ensure_stock_log_collection(db):
+    if "stock_log" not in await db.db.list_collection_names(filter={"name": "stock_log"}):
+        return
+    options = (await db.db.stock_log.options()) or {}
+    if "timeseries" in options:
+        logger.warning(
+            "stock_log is a time-series collection; its _id-ordered reads scan the whole log. "
+            "Copy it into a regular collection to use the stock_log indexes"
+        )
+
+
+# Entries used to store `date` as an ISO string; convert them to BSON dates once so date
+# filters, snapshots, rollups and archival see the whole log
+async def migrate_stock_log_dates(db):
+    if await db.db[MIGRATIONS].find_one({"_id": "stock_log_dates"}):
+        return
+    result = await db.stock_log.update_many(
+        {"date": {"$type": "string"}},
+        [{"$set": {"date": {"$dateFromString": {"dateString": "$date"}}}}],
+    )
+    if result.modified_count:
+        logger.info("Converted %d stock_log dates from strings", result.modified_count)
+    await db.db[MIGRATIONS].update_one(
+        {"_id": "stock_log_dates"}, {"$set": {"done_at": datetime.now(timezone.utc)}}, upsert=True,
+    )
+
+
+# MongoDB hands dates back without a timezone; the log's dates are UTC and have always
+# been returned with their offset
+def with_utc_date(entry: dict) -> dict:
+    date = entry.get("date")
+    if isinstance(date, datetime) and date.tzinfo is None:
+        entry["date"] = date.replace(tzinfo=timezone.utc)
+    return entry
+
+
+# Raised when some entries of a batch were written and the others were not
+class StockLogWriteError(Exception):
+    def __init__(self, entries: List[dict], error: BulkWriteError):
+        super().__init__(f"{len(entries)} stock_log entries were not written: {error}")
+        self.entries = entries
+
+
+# Collects stock_log entries and writes them with insert_many. With flush_interval = 0
+# each request's entries are written before it returns. With flush_interval > 0 entries
+# from many requests are buffered and written together at least that often, or as soon
+# as max_batch entries are waiting; flush_interval is then the bound on how much of the
+# log a crash can lose.
+#
+# insert_many gives each entry its _id before sending it, so an entry kept for the next
+# flush is inserted at most once: a duplicate key on retry means the failed attempt did
+# write it. Only entries that were not written are kept. The daily rollups are updated
+# separately, once, for the entries that were; a failed rollup update is logged and left
+# to POST /analytics/rebuild, since retrying its $inc could count entries twice.
+class StockLogWriter:
+    def __init__(self, db, flush_interval: float = 0.0, max_batch: int = 1000):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.buffer: List[dict] = []
+        self.flusher: Optional[asyncio.Task] = None
+        self.written = 0
+
+    async def start(self):
+        if self.flush_interval > 0:
+            self.flusher = asyncio.create_task(self._run(), name="stock-log-flusher")
+
+    async def write(self, entries: List[dict]):
+        if not entries:
+            return
+        if self.flush_interval <= 0:
+            await self._insert(entries)
+            return
+        self.buffer.extend(entries)
+        if len(self.buffer) >= self.max_batch:
+            # The stock change is already committed; a failed flush keeps the entries for
+            # the next one instead of failing the request
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error("Could not flush %d stock_log entries: %s", len(self.buffer), e)
+
+    async def flush(self):
+        entries, self.buffer = self.buffer, []
+        if not entries:
+            return
+        try:
+            await self._insert(entries)
+        except StockLogWriteError as e:
+            # Keep the entries for the next flush rather than dropping audit records
+            self.buffer[:0] = e.entries
+            raise
+        except Exception:
+            self.buffer[:0] = entries
+            raise
+
+    async def _insert(self, entries: List[dict]):
+        try:
+            await self.db.stock_log.insert_many(entries, ordered=False)
+        except BulkWriteError as e:
+            failed = {error["index"] for error in e.details["writeErrors"] if error["code"] != 11000}
+            await self._track([entry for index, entry in enumerate(entries) if index not in failed])
+            if failed:
+                raise StockLogWriteError([entries[index] for index in sorted(failed)], e) from e
+            return
+        await self._track(entries)
+
+    async def _track(self, entries: List[dict]):
+        self.written += len(entries)
+        try:
+            await track_stock_movements(self.db, entries)
+        except Exception as e:
+            logger.error("Could not add %d stock_log entries to the daily rollups: %s", len(entries), e)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error("Could not flush %d stock_log entries: %s", len(self.buffer), e)
+
+    async def stop(self):
+        if self.flusher is not None:
+            self.flusher.cancel()
+            await asyncio.gather(self.flusher, return_exceptions=True)
+            self.flusher = None
+        await self.flush()
@@ -0,0 +1,259 @@
+import logging
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+from analytics import track_sales
+from bulk_import import describe, log_entry
+from stock import ProductNotFound, InsufficientStock
+
+logger = logging.getLogger(__name__)
+
+MAX_BATCH_ORDERS = 500  # Most orders accepted in one batch request
+UNDO_ATTEMPTS = 3  # Tries at giving back what rejected orders took before the batch fails
+
+
+# Raised when stock taken by orders rejected part way could not be given back, so the
+# stock of `totals`' products is off by those amounts and nothing was recorded
+class UndoFailed(Exception):
+    def __init__(self, totals: Dict[str, int]):
+        super().__init__(f"Could not undo stock changes {totals}")
+        self.totals = totals
+
+
+# How one kind of order (a SaleRecord, InstallationRecord or ReturnRequest body) maps
+# onto the shared batch pipeline
+class OrderKind(ABC):
+    action = ""  # stock_log action
+    collection = ""  # Where the records go
+    sign = -1  # Direction the order moves stock in
+    creates_customers = True  # Returns need an existing customer
+
+    def customer(self, order) -> Tuple[str, str, str]:
+        return order.customer_name, order.customer_number, order.customer_address
+
+    def performed_by(self, order) -> str:
+        return order.manager_name
+
+    def lines(self, order) -> List[Tuple[str, int]]:
+        return list(zip(order.products, order.quantities))
+
+    def mismatch(self, order) -> Optional[str]:
+        if len(order.products) != len(order.quantities) or len(order.products) != len(order.remarks):
+            return "Mismatch in the number of products and details provided."
+        return None
+
+    def not_found(self, name: str) -> str:
+        return describe(ProductNotFound(name))
+
+    @abstractmethod
+    def records(self, order, customer: dict) -> List[dict]:
+        pass
+
+
+class SaleOrders(OrderKind):
+    action = "sale"
+    collection = "sales"
+
+    def customer(self, order) -> Tuple[str, str, str]:
+        return order.customer.name, order.customer.number, order.customer.address
+
+    def performed_by(self, order) -> str:
+        return order.customer.manager_name
+
+    def lines(self, order) -> List[Tuple[str, int]]:
+        return list(zip(order.product_names, order.quantities))
+
+    def mismatch(self, order) -> Optional[str]:
+        counts = {len(order.product_names), len(order.quantities), len(order.amounts), len(order.remarks)}
+        return "Mismatch in the number of products and details provided." if len(counts) > 1 else None
+
+    def records(self, order, customer: dict) -> List[dict]:
+        return [{
+            "customer_id": customer["_id"],
+            "customer_name": order.customer.name,
+            "customer_number": order.customer.number,
+            "customer_address": order.customer.address,
+            "manager_name": order.customer.manager_name,
+            "date": order.date,
+            "total_amount": order.total_amount,
+            "products": [
+                {"product_name": name, "quantity": quantity, "amount": amount, "remarks": remark}
+                for name, quantity, amount, remark in zip(order.product_names, order.quantities, order.amounts, order.remarks)
+            ],
+            "date_added": datetime.now(timezone.utc),
+        }]
+
+
+class InstallationOrders(OrderKind):
+    action = "installation"
+    collection = "installations"
+
+    def records(self, order, customer: dict) -> List[dict]:
+        return [{
+            "staff_names": order.staff_names,
+            "manager_name": order.manager_name,
+            "customer_id": customer["_id"],
+            "customer_name": order.customer_name,
+            "customer_number": order.customer_number,
+            "customer_address": order.customer_address,
+            "installation_date": order.installation_date,
+            "products": [
+                {"product_name": name, "quantity": quantity, "remarks": remark}
+                for name, quantity, remark in zip(order.products, order.quantities, order.remarks)
+            ],
+            "date_added": datetime.now(timezone.utc),
+        }]
+
+
+class ReturnOrders(OrderKind):
+    action = "return"
+    collection = "returns"
+    sign = 1
+    creates_customers = False
+
+    def mismatch(self, order) -> Optional[str]:
+        if len(order.products) != len(order.quantities):
+            return "Products and quantities list lengths must match."
+        return None
+
+    def not_found(self, name: str) -> str:
+        return f"Product '{name}' not found in inventory."
+
+    # One record per returned product, as /return-item/ writes them
+    def records(self, order, customer: dict) -> List[dict]:
+        return [{
+            "staff_name": order.staff_name,
+            "manager_name": order.manager_name,
+            "customer_id": customer["_id"],
+            "customer_name": order.customer_name,
+            "customer_number": order.customer_number,
+            "customer_address": order.customer_address,
+            "return_date": order.return_date,
+            "product_name": name,
+            "quantity": quantity,
+            "remarks": order.remarks,
+            "date_added": datetime.now(timezone.utc),
+        } for name, quantity in zip(order.products, order.quantities)]
+
+
+SALE_ORDERS = SaleOrders()
+INSTALLATION_ORDERS = InstallationOrders()
+RETURN_ORDERS = ReturnOrders()
+
+
+# Record a batch of orders with a fixed number of round-trips: one customer lookup/upsert,
+# one product read, one guarded bulk_write for the stock of every accepted order, one
+# insert_many for the records and one stock_log write. Each order is all or nothing:
+# orders are checked in sequence against the stock left by the ones before them, and a
+# rejected order leaves stock untouched. Returns one result per order, in order.
+async def record_orders(db, stock, stock_log_writer, customers, kind: OrderKind, orders: list) -> List[dict]:
+    results: List[Optional[dict]] = [None] * len(orders)
+
+    def reject(i: int, message: str):
+        results[i] = {"index": i, "status": "error", "error": message}
+
+    pending = []
+    for i, order in enumerate(orders):
+        error = kind.mismatch(order)
+        if error:
+            reject(i, error)
+        else:
+            pending.append(i)
+
+    # Customers for every order at once
+    addresses: Dict[tuple, str] = {}
+    for i in pending:
+        name, number, address = kind.customer(orders[i])
+        addresses.setdefault((name, number), address)
+    if not addresses:
+        resolved = {}
+    elif kind.creates_customers:
+        resolved = await customers.resolve_many(addresses)
+    else:
+        resolved = await customers.find_many(list(addresses))
+    for i in pending:
+        if kind.customer(orders[i])[:2] not in resolved:
+            reject(i, "Customer not found.")
+    pending = [i for i in pending if results[i] is None]
+
+    # Check each order whole against the running stock, in request order
+    deltas: Dict[int, Dict[str, int]] = {}
+    for i in pending:
+        order_totals: Dict[str, int] = {}
+        for name, quantity in kind.lines(orders[i]):
+            order_totals[name] = order_totals.get(name, 0) + kind.sign * quantity
+        deltas[i] = order_totals
+    names = list(dict.fromkeys(name for order_totals in deltas.values() for name in order_totals))
+    running = await stock.current(names) if names else {}
+
+    accepted, totals = [], {}
+    for i in pending:
+        missing = next((name for name in deltas[i] if name not in running), None)
+        if missing is not None:
+            reject(i, kind.not_found(missing))
+            continue
+        short = next((name for name, delta in deltas[i].items() if running[name] + delta < 0), None)
+        if short is not None:
+            reject(i, describe(InsufficientStock(short)))
+            continue
+        for name, delta in deltas[i].items():
+            running[name] += delta
+            totals[name] = totals.get(name, 0) + delta
+        accepted.append(i)
+
+    products, failed = await stock.apply_independent(totals) if totals else ({}, {})
+
+    # A product whose stock changed since it was read fails for every order that uses it; give back what
+    # those orders took of their other products so they stay all or nothing
+    if failed:
+        undo: Dict[str, int] = {}
+        for i in accepted:
+            bad = next((name for name in deltas[i] if name in failed), None)
+            if bad is None:
+                continue
+            error = failed[bad]
+            reject(i, kind.not_found(bad) if isinstance(error, ProductNotFound) else describe(error))
+            for name, delta in deltas[i].items():
+                if name not in failed:
+                    undo[name] = undo.get(name, 0) - delta
+                    totals[name] -= delta
+        accepted = [i for i in accepted if results[i] is None]
+        undo = {name: delta for name, delta in undo.items() if delta}
+        # Giving back a return is a guarded decrement that a sale in the meantime can reject
+        for _ in range(UNDO_ATTEMPTS):
+            if not undo:
+                break
+            undone, stuck = await stock.apply_independent(undo)
+            products.update(undone)
+            undo = {name: delta for name, delta in undo.items() if name in stuck}
+        if undo:
+            logger.error("Batch of %s failed: could not undo %s for orders rejected part way", kind.collection, undo)
+            raise UndoFailed(undo)
+
+    if not accepted:
+        return results
+
+    remaining = {name: products[name]["stock_quantity"] - totals[name] for name in totals if name not in failed}
+    records, owners, entries = [], [], []
+    for i in accepted:
+        order = orders[i]
+        customer_name, customer_number, _ = kind.customer(order)
+        lines = []
+        for name, quantity in kind.lines(order):
+            remaining[name] += kind.sign * quantity
+            lines.append({"product_name": name, "quantity": quantity, "remaining_stock": remaining[name]})
+            entries.append(log_entry(
+                kind.action, products[name], kind.sign * quantity, remaining[name], kind.performed_by(order), customer_name,
+            ))
+        order_records = kind.records(order, resolved[(customer_name, customer_number)])
+        records += order_records
+        owners += [i] * len(order_records)
+        results[i] = {"index": i, "status": "ok", "ids": [], "products": lines}
+
+    inserted = await db.db[kind.collection].insert_many(records)
+    for i, record_id in zip(owners, inserted.inserted_ids):
+        results[i]["ids"].append(str(record_id))
+    await stock_log_writer.write(entries)
+    if kind.action == "sale":
+        await track_sales(db, records)
+    return results
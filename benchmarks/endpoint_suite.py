@@ -0,0 +1,352 @@
+"""Latency benchmark suite for the main API endpoints.
+
+Seeds a scratch MongoDB database with realistic volumes, runs the app
+in-process through httpx's ASGI transport (email goes to a local SMTP sink)
+and drives each scenario at a fixed concurrency. For every scenario it
+reports throughput, p50/p95/p99 latency and MongoDB round-trips per request.
+
+Needs a MongoDB server; the database named by --db is dropped with --reseed.
+
+    python benchmarks/endpoint_suite.py --reseed --save-baseline benchmarks/baseline.json
+    python benchmarks/endpoint_suite.py --compare benchmarks/baseline.json
+
+With --compare the exit status is 1 when a scenario regressed: p95 latency or
+throughput worse than the baseline by more than --tolerance, or more
+round-trips per request than before.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+import httpx
+from pymongo import monitoring
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SEED_BATCH_SIZE = 10000
+LOG_ACTIONS = ["add", "update", "sale", "installation", "return"]
+
+
+# Counts the commands every MongoClient sends; registered before the app connects
+class CommandCounter(monitoring.CommandListener):
+    def __init__(self):
+        self.count = 0
+
+    def started(self, event):
+        self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+# Accepts SMTP sessions on localhost and throws the messages away
+class SMTPSink:
+    def __init__(self):
+        self.server = None
+        self.messages = 0
+
+    async def start(self) -> int:
+        self.server = await asyncio.start_server(self._session, "127.0.0.1", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def _session(self, reader, writer):
+        writer.write(b"220 benchmark sink\r\n")
+        in_data = False
+        while line := await reader.readline():
+            if in_data:
+                if line.rstrip(b"\r\n") == b".":
+                    in_data = False
+                    self.messages += 1
+                    writer.write(b"250 OK\r\n")
+                continue
+            command = line[:4].upper()
+            if command == b"DATA":
+                in_data = True
+                writer.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+            elif command == b"QUIT":
+                writer.write(b"221 Bye\r\n")
+                break
+            else:
+                writer.write(b"250 OK\r\n")
+            await writer.drain()
+        writer.close()
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+
+def product_doc(i: int) -> dict:
+    return {
+        "product_id": f"P{i:06d}",
+        "name": f"Product {i:06d}",
+        "category": f"Category {i % 50}",
+        "stock_quantity": 1_000_000,  # High enough that benchmark sales never run out
+        "threshold": 10,
+        "supplier": f"Supplier {i % 200}",
+        "added_by": "benchmark",
+        "date_added": datetime.now(timezone.utc),
+    }
+
+
+def customer_doc(i: int) -> dict:
+    name = f"Customer {i:06d}"
+    return {
+        "name": name,
+        "name_normalized": name.lower(),
+        "number": str(9000000000 + i),
+        "address": f"{i} Benchmark Street",
+        "date_added": datetime.now(timezone.utc),
+    }
+
+
+def sale_doc(i: int, customers: int, products: int) -> dict:
+    customer = customer_doc(i % customers)
+    product = product_doc(i % products)
+    return {
+        "customer_name": customer["name"],
+        "customer_number": customer["number"],
+        "customer_address": customer["address"],
+        "manager_name": f"Manager {i % 20}",
+        "date": "2024-01-01",
+        "total_amount": 10.0,
+        "products": [{"product_name": product["name"], "quantity": 1, "amount": 10.0, "remarks": ""}],
+        "date_added": datetime.now(timezone.utc),
+    }
+
+
+def log_doc(i: int, products: int, start: datetime, span: float) -> dict:
+    product = product_doc(i % products)
+    return {
+        "date": start + timedelta(seconds=span * i),
+        "action": LOG_ACTIONS[i % len(LOG_ACTIONS)],
+        "product_id": product["product_id"],
+        "product_name": product["name"],
+        "quantity_changed": -1,
+        "remaining_stock": product["stock_quantity"],
+        "performed_by": "benchmark",
+    }
+
+
+async def insert_in_batches(collection, total: int, make):
+    for first in range(0, total, SEED_BATCH_SIZE):
+        docs = [make(i) for i in range(first, min(first + SEED_BATCH_SIZE, total))]
+        await collection.insert_many(docs, ordered=False)
+
+
+async def seed(db, args):
+    if await db.products.estimated_document_count() >= args.products:
+        print("using existing seed data (pass --reseed to rebuild it)")
+        return
+    started = time.perf_counter()
+    await insert_in_batches(db.products, args.products, product_doc)
+    await insert_in_batches(db.customers, args.customers, customer_doc)
+    await insert_in_batches(db.sales, args.sales, lambda i: sale_doc(i, args.customers, args.products))
+    log_start = datetime.now(timezone.utc) - timedelta(days=365)
+    span = 365 * 86400 / max(args.logs, 1)
+    await insert_in_batches(db.stock_log, args.logs, lambda i: log_doc(i, args.products, log_start, span))
+    print(f"seeded {args.products} products, {args.customers} customers, {args.sales} sales, "
+          f"{args.logs} stock_log rows in {time.perf_counter() - started:.1f}s")
+
+
+# Scenario name -> coroutine issuing one request; `i` is the request number
+def scenarios(args):
+    def random_product():
+        return product_doc(random.randrange(args.products))
+
+    def random_customer():
+        return customer_doc(random.randrange(args.customers))
+
+    async def record_sale(client, i):
+        product = random_product()
+        customer = random_customer()
+        return await client.post("/record-sale/", data={
+            "customer_name": customer["name"],
+            "customer_number": customer["number"],
+            "customer_address": customer["address"],
+            "manager_name": "benchmark",
+            "date": "2024-01-01",
+            "total_amount": 10.0,
+            "product_names": [product["name"]],
+            "quantities": [1],
+            "amounts": [10.0],
+            "remarks": ["benchmark"],
+        })
+
+    async def view_logs(client, i):
+        return await client.get("/view-logs/", params={"product_id": random_product()["product_id"], "limit": 100})
+
+    async def view_logs_range(client, i):
+        end = datetime.now(timezone.utc) - timedelta(days=random.randrange(365))
+        return await client.get("/view-logs/", params={
+            "action": "sale",
+            "start_date": (end - timedelta(days=7)).isoformat(),
+            "end_date": end.isoformat(),
+            "limit": 100,
+        })
+
+    async def search_customer(client, i):
+        return await client.get("/search-customer", params={"name": random_customer()["name"]})
+
+    async def get_products(client, i):
+        return await client.get("/get-products/")
+
+    return {
+        "record_sale": record_sale,
+        "view_logs": view_logs,
+        "view_logs_range": view_logs_range,
+        "search_customer": search_customer,
+        "get_products": get_products,
+    }
+
+
+def percentile(ordered, p: float) -> float:
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+async def run_scenario(client, request, counter: CommandCounter, args) -> dict:
+    for i in range(args.warmup):
+        await request(client, i)
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    errors = 0
+
+    async def one(i):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            response = await request(client, i)
+            if response.status_code >= 400:
+                errors += 1
+            return time.perf_counter() - started
+
+    commands_before = counter.count
+    started = time.perf_counter()
+    latencies = await asyncio.gather(*(one(i) for i in range(args.requests)))
+    elapsed = time.perf_counter() - started
+    commands = counter.count - commands_before
+
+    latencies.sort()
+    return {
+        "requests": args.requests,
+        "errors": errors,
+        "throughput": args.requests / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "round_trips": commands / args.requests,
+    }
+
+
+def print_results(results: dict):
+    print(f"{'scenario':<18} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'trips':>7} {'errors':>7}")
+    for name, r in results.items():
+        print(f"{name:<18} {r['throughput']:>9.1f} {r['p50_ms']:>9.2f} {r['p95_ms']:>9.2f} "
+              f"{r['p99_ms']:>9.2f} {r['round_trips']:>7.2f} {r['errors']:>7}")
+
+
+# Returns a description of every regression against the baseline
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for name, r in results.items():
+        before = baseline["results"].get(name)
+        if before is None:
+            continue
+        if r["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {before['p95_ms']:.2f} -> {r['p95_ms']:.2f} ms")
+        if r["throughput"] < before["throughput"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {before['throughput']:.1f} -> {r['throughput']:.1f} req/s")
+        if r["round_trips"] > before["round_trips"] + 0.05:
+            regressions.append(f"{name}: round-trips {before['round_trips']:.2f} -> {r['round_trips']:.2f} per request")
+        if r["errors"] > before["errors"]:
+            regressions.append(f"{name}: errors {before['errors']} -> {r['errors']}")
+    return regressions
+
+
+async def main(args) -> int:
+    os.environ["MONGO_URI"] = args.mongo_uri
+    os.environ["MONGO_DB_NAME"] = args.db
+    counter = CommandCounter()
+    monitoring.register(counter)
+
+    import project  # Reads the environment above at import time
+
+    sink = SMTPSink()
+    project.notifier.host = "127.0.0.1"
+    project.notifier.port = await sink.start()
+    project.notifier.use_tls = False
+    project.notifier.password = None
+    project.notifier.require_login = False
+
+    if args.reseed:
+        await project.db.connect()
+        await project.db.client.drop_database(args.db)
+        await project.db.close()
+
+    selected = scenarios(args)
+    names = args.scenarios.split(",") if args.scenarios else list(selected)
+    unknown = [name for name in names if name not in selected]
+    if unknown:
+        raise SystemExit(f"unknown scenarios: {', '.join(unknown)}")
+
+    results = {}
+    async with project.lifespan(project.app):
+        await seed(project.db, args)
+        transport = httpx.ASGITransport(app=project.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=60) as client:
+            for name in names:
+                results[name] = await run_scenario(client, selected[name], counter, args)
+    await sink.stop()
+
+    print(f"{args.requests} requests per scenario at concurrency {args.concurrency}, "
+          f"{sink.messages} email(s) sent to the sink")
+    print_results(results)
+
+    run = {
+        "settings": {key: getattr(args, key) for key in ("products", "customers", "sales", "logs", "requests", "concurrency")},
+        "results": results,
+    }
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(run, f, indent=2)
+        print(f"baseline saved to {args.save_baseline}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline["settings"] != run["settings"]:
+            print(f"warning: baseline was recorded with different settings: {baseline['settings']}")
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+        print("no regressions against the baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mongo-uri", default=os.environ.get("MONGO_URI", "mongodb://localhost:27017"))
+    parser.add_argument("--db", default="stock_bench")
+    parser.add_argument("--reseed", action="store_true", help="drop the benchmark database and seed it again")
+    parser.add_argument("--products", type=int, default=10_000)
+    parser.add_argument("--customers", type=int, default=100_000)
+    parser.add_argument("--sales", type=int, default=100_000)
+    parser.add_argument("--logs", type=int, default=1_000_000)
+    parser.add_argument("--scenarios", help="comma-separated subset of scenarios to run")
+    parser.add_argument("--requests", type=int, default=500, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=20, help="sequential requests before measuring")
+    parser.add_argument("--save-baseline", metavar="PATH")
+    parser.add_argument("--compare", metavar="PATH")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown, default 0.2")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,80 @@
+"""Concurrent load test for /record-sale/.
+
+Start the API against a scratch database first, e.g.
+
+    MONGO_DB_NAME=stock_bench uvicorn project:app --workers 1
+
+then run
+
+    python benchmarks/record_sale_load.py --requests 2000 --concurrency 200
+"""
+import argparse
+import asyncio
+import statistics
+import time
+import uuid
+
+import httpx
+
+
+async def seed_product(client: httpx.AsyncClient, name: str, quantity: int):
+    response = await client.post("/add-product/", json={
+        "product_id": name,
+        "name": name,
+        "category": "benchmark",
+        "stock_quantity": quantity,
+        "threshold": 0,
+        "supplier": "benchmark",
+        "added_by": "benchmark",
+    })
+    response.raise_for_status()
+
+
+async def record_sale(client: httpx.AsyncClient, product_name: str, i: int) -> float:
+    started = time.perf_counter()
+    response = await client.post("/record-sale/", data={
+        "customer_name": f"Load Customer {i % 500}",
+        "customer_number": f"{9000000000 + i % 500}",
+        "customer_address": "Benchmark Street",
+        "manager_name": "benchmark",
+        "date": "2024-01-01",
+        "total_amount": 10.0,
+        "product_names": [product_name],
+        "quantities": [1],
+        "amounts": [10.0],
+        "remarks": ["load test"],
+    })
+    response.raise_for_status()
+    return time.perf_counter() - started
+
+
+async def main(args):
+    product_name = f"load-{uuid.uuid4().hex[:8]}"
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=60) as client:
+        await seed_product(client, product_name, args.requests)
+
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def one(i):
+            async with semaphore:
+                return await record_sale(client, product_name, i)
+
+        started = time.perf_counter()
+        latencies = await asyncio.gather(*(one(i) for i in range(args.requests)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    print(f"requests:    {args.requests} at concurrency {args.concurrency}")
+    print(f"throughput:  {args.requests / elapsed:.1f} req/s")
+    print(f"latency p50: {statistics.median(latencies) * 1000:.1f} ms")
+    print(f"latency p95: {latencies[int(len(latencies) * 0.95) - 1] * 1000:.1f} ms")
+    print(f"latency p99: {latencies[int(len(latencies) * 0.99) - 1] * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,237 @@
+import codecs
+import csv
+import json
+from bisect import insort
+from datetime import datetime, timezone
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from fastapi import HTTPException, UploadFile
+from pydantic import BaseModel, ValidationError
+from pymongo import InsertOne
+from pymongo.errors import BulkWriteError
+from analytics import track_sales
+from stock import InsufficientStock, ProductNotFound, StockError
+
+IMPORT_BATCH_SIZE = 1000  # Rows validated and written per bulk_write / insert_many
+READ_CHUNK_SIZE = 64 * 1024
+MAX_REPORTED_ERRORS = 1000  # Errors past this are counted but not listed; the lowest rows are kept
+
+
+# Per-row outcome of an import; failing rows are reported without aborting the batch.
+# Rows fail while being parsed and later while being applied, so errors are kept in row order.
+class ImportReport:
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.rows = 0
+        self.applied = 0
+        self.error_count = 0
+        self.errors: List[dict] = []
+
+    def error(self, row: int, message: str):
+        self.error_count += 1
+        insort(self.errors, {"row": row, "error": message}, key=lambda error: error["row"])
+        if len(self.errors) > MAX_REPORTED_ERRORS:
+            self.errors.pop()
+
+    def summary(self) -> dict:
+        return {
+            "kind": self.kind,
+            "rows": self.rows,
+            "applied": self.applied,
+            "error_count": self.error_count,
+            "errors": self.errors,
+        }
+
+
+def detect_format(upload: UploadFile, fmt: Optional[str]) -> str:
+    if fmt:
+        return fmt
+    filename = (upload.filename or "").lower()
+    if filename.endswith((".ndjson", ".jsonl")) or "ndjson" in (upload.content_type or ""):
+        return "ndjson"
+    if filename.endswith(".csv") or "csv" in (upload.content_type or ""):
+        return "csv"
+    raise HTTPException(status_code=400, detail="Could not tell the file format; pass format=csv or format=ndjson.")
+
+
+def describe(error: Exception) -> str:
+    if isinstance(error, ValidationError):
+        return "; ".join(f"{'.'.join(str(part) for part in e['loc'])}: {e['msg']}" for e in error.errors())
+    if isinstance(error, ProductNotFound):
+        return f"Product {error.name} not found in inventory."
+    if isinstance(error, StockError):
+        return f"Not enough stock for {error.name}"
+    return str(error)
+
+
+# Decode the upload chunk by chunk and yield its lines
+async def read_lines(upload: UploadFile) -> AsyncIterator[str]:
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    pending = ""
+    while True:
+        chunk = await upload.read(READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            yield line.rstrip("\r")
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending.rstrip("\r")
+
+
+# Parse and validate rows with `model`, yielding them in batches of (row number, model instance).
+# CSV files need a header row; quoted fields may not contain line breaks.
+async def read_batches(upload: UploadFile, fmt: str, model, report: ImportReport) -> AsyncIterator[List[Tuple[int, BaseModel]]]:
+    header = None
+    batch = []
+    async for line in read_lines(upload):
+        if not line.strip():
+            continue
+        if fmt == "csv" and header is None:
+            try:
+                header = [column.strip() for column in next(csv.reader([line]))]
+            except csv.Error as e:
+                raise HTTPException(status_code=400, detail=f"Could not read the CSV header: {e}")
+            continue
+        report.rows += 1
+        try:
+            if fmt == "csv":
+                data = dict(zip(header, next(csv.reader([line]))))
+            else:
+                data = json.loads(line)
+            batch.append((report.rows, model.model_validate(data)))
+        except (ValueError, csv.Error) as e:  # Covers JSON decode, CSV syntax and validation errors
+            report.error(report.rows, describe(e))
+        if len(batch) == IMPORT_BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def log_entry(action: str, product: dict, quantity_changed: int, remaining_stock: int,
+              performed_by: str, customer_name: Optional[str] = None) -> dict:
+    entry = {
+        "date": datetime.now(timezone.utc),
+        "action": action,
+        "product_id": product["product_id"],
+        "product_name": product["name"],
+        "quantity_changed": quantity_changed,
+        "remaining_stock": remaining_stock,
+        "performed_by": performed_by,
+    }
+    if customer_name is not None:
+        entry["customer_name"] = customer_name
+    return entry
+
+
+async def import_products(db, stock, stock_log_writer, customers, batch, report: ImportReport):
+    rows, docs = [], []
+    for row, product in batch:
+        doc = product.model_dump()
+        doc["date_added"] = datetime.now(timezone.utc)
+        rows.append(row)
+        docs.append(doc)
+
+    failed = set()
+    try:
+        await db.products.bulk_write([InsertOne(doc) for doc in docs], ordered=False)
+    except BulkWriteError as e:
+        for error in e.details["writeErrors"]:
+            failed.add(error["index"])
+            message = "Product with this ID or name already exists" if error["code"] == 11000 else error["errmsg"]
+            report.error(rows[error["index"]], message)
+
+    entries, added = [], []
+    for i, (row, product) in enumerate(batch):
+        if i in failed:
+            continue
+        stock.cache.put(docs[i])
+        added.append(docs[i])
+        entries.append(log_entry("add", docs[i], product.stock_quantity, product.stock_quantity, product.added_by))
+    await stock.monitor.evaluate(added)
+    await stock_log_writer.write(entries)
+    report.applied += len(entries)
+
+
+# Check rows against current stock in file order and apply what fits as one
+# change per product. Returns the accepted rows with their product document and
+# the stock left after each row.
+async def _apply_stock_rows(stock, changes: List[Tuple[int, str, int]], report: ImportReport) -> List[Tuple[int, dict, int]]:
+    names = list(dict.fromkeys(name for _, name, _ in changes))
+    running = await stock.current(names)
+
+    accepted, totals = [], {}
+    for row, name, delta in changes:
+        if name not in running:
+            report.error(row, describe(ProductNotFound(name)))
+            continue
+        if running[name] + delta < 0:
+            report.error(row, describe(InsufficientStock(name)))
+            continue
+        running[name] += delta
+        totals[name] = totals.get(name, 0) + delta
+        accepted.append((row, name, delta))
+
+    products, failed = await stock.apply_independent(totals) if totals else ({}, {})
+
+    remaining = {name: product["stock_quantity"] - totals[name] for name, product in products.items()}
+    applied = []
+    for row, name, delta in accepted:
+        if name in failed:
+            report.error(row, describe(failed[name]))
+            continue
+        remaining[name] += delta
+        applied.append((row, products[name], remaining[name]))
+    return applied
+
+
+async def import_stock_adjustments(db, stock, stock_log_writer, customers, batch, report: ImportReport):
+    updates = dict(batch)
+    applied = await _apply_stock_rows(stock, [(row, u.product_name, u.quantity) for row, u in batch], report)
+    entries = [
+        log_entry("update", product, updates[row].quantity, remaining, updates[row].updated_by)
+        for row, product, remaining in applied
+    ]
+    await stock_log_writer.write(entries)
+    report.applied += len(entries)
+
+
+async def import_sales(db, stock, stock_log_writer, customers, batch, report: ImportReport):
+    sales = dict(batch)
+    applied = await _apply_stock_rows(stock, [(row, s.product_name, -s.quantity) for row, s in batch], report)
+    if not applied:
+        return
+
+    # Resolve the batch's customers, creating first-time ones with a single bulk upsert
+    addresses: Dict[tuple, str] = {}
+    for row, _, _ in applied:
+        sale = sales[row]
+        addresses.setdefault((sale.customer_name, sale.customer_number), sale.customer_address)
+    resolved = await customers.resolve_many(addresses)
+
+    records, entries = [], []
+    for row, product, remaining in applied:
+        sale = sales[row]
+        records.append({
+            "customer_id": resolved[(sale.customer_name, sale.customer_number)]["_id"],
+            "customer_name": sale.customer_name,
+            "customer_number": sale.customer_number,
+            "customer_address": sale.customer_address,
+            "manager_name": sale.manager_name,
+            "date": sale.date,
+            "total_amount": sale.amount,
+            "products": [{
+                "product_name": sale.product_name,
+                "quantity": sale.quantity,
+                "amount": sale.amount,
+                "remarks": sale.remarks,
+            }],
+            "date_added": datetime.now(timezone.utc),
+        })
+        entries.append(log_entry("sale", product, -sale.quantity, remaining, sale.manager_name, sale.customer_name))
+    await db.sales.insert_many(records, ordered=False)
+    await stock_log_writer.write(entries)
+    await track_sales(db, records)
+    report.applied += len(records)
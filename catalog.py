@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+# In-process cache of product documents keyed by name, with a product_id -> name
+# index. Entries expire after `ttl` seconds and the least recently used ones are
+# evicted beyond `max_size`. Stock mutations write their post-update documents
+# through `put()`, so this worker never serves its own stale writes; other workers'
+# writes show up after the TTL, or immediately when following the change stream.
+class CatalogCache:
+    def __init__(self, db, ttl: float = 30, max_size: int = 10000):
+        self.db = db
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries: "OrderedDict[str, tuple]" = OrderedDict()  # name -> (expires_at, product)
+        self.names_by_id: Dict[str, str] = {}
+        self.full_until = 0.0  # The whole catalog is cached until this time
+        self.hits = 0
+        self.misses = 0
+        self.watcher: Optional[asyncio.Task] = None
+
+    def put(self, product: dict):
+        name = product["name"]
+        self.entries[name] = (time.monotonic() + self.ttl, product)
+        self.entries.move_to_end(name)
+        self.names_by_id[product["product_id"]] = name
+        while len(self.entries) > self.max_size:
+            _, (_, old) = self.entries.popitem(last=False)
+            self.names_by_id.pop(old["product_id"], None)
+            self.full_until = 0.0
+
+    def invalidate(self, name: Optional[str] = None):
+        if name is None:
+            self.entries.clear()
+            self.names_by_id.clear()
+        elif name in self.entries:
+            _, product = self.entries.pop(name)
+            self.names_by_id.pop(product["product_id"], None)
+        self.full_until = 0.0
+
+    def _lookup(self, name: str) -> Optional[dict]:
+        entry = self.entries.get(name)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        self.entries.move_to_end(name)
+        return entry[1]
+
+    # The cached document, if any, without touching MongoDB or the hit/miss counts
+    def peek(self, name: str) -> Optional[dict]:
+        entry = self.entries.get(name)
+        return entry[1] if entry is not None and entry[0] >= time.monotonic() else None
+
+    async def get(self, name: str) -> Optional[dict]:
+        return (await self.get_many([name])).get(name)
+
+    # Look up several products, fetching all the misses with one $in query
+    async def get_many(self, names: List[str]) -> Dict[str, dict]:
+        found, missing = {}, []
+        for name in names:
+            product = self._lookup(name)
+            if product is None:
+                missing.append(name)
+            else:
+                found[name] = product
+        self.hits += len(found)
+        self.misses += len(missing)
+        if missing:
+            async for product in self.db.products.find({"name": {"$in": missing}}):
+                self.put(product)
+                found[product["name"]] = product
+        return found
+
+    async def get_by_product_id(self, product_id: str) -> Optional[dict]:
+        name = self.names_by_id.get(product_id)
+        product = self._lookup(name) if name else None
+        if product is not None:
+            self.hits += 1
+            return product
+        self.misses += 1
+        product = await self.db.products.find_one({"product_id": product_id})
+        if product is not None:
+            self.put(product)
+        return product
+
+    # The whole catalog, loaded with a single query whenever the cached copy has expired
+    async def all(self) -> List[dict]:
+        if self.full_until > time.monotonic():
+            self.hits += 1
+            return [product for _, product in self.entries.values()]
+        self.misses += 1
+        products = await self.db.products.find().to_list(None)
+        if len(products) <= self.max_size:
+            self.invalidate()
+            for product in products:
+                self.put(product)
+            self.full_until = time.monotonic() + self.ttl
+        return products
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "watching_changes": self.watcher is not None and not self.watcher.done(),
+        }
+
+    def start_watching(self):
+        self.watcher = asyncio.create_task(self._follow_changes(), name="catalog-change-stream")
+
+    async def stop_watching(self):
+        if self.watcher is not None:
+            self.watcher.cancel()
+            await asyncio.gather(self.watcher, return_exceptions=True)
+            self.watcher = None
+
+    # Apply product changes made by any worker as they happen (needs a replica set)
+    async def _follow_changes(self):
+        resume_after = None
+        while True:
+            try:
+                async with await self.db.products.watch(full_document="updateLookup", resume_after=resume_after) as stream:
+                    async for change in stream:
+                        resume_after = stream.resume_token
+                        product = change.get("fullDocument")
+                        if product is not None:
+                            self.put(product)
+                        else:
+                            # Deleted, or gone before the lookup ran; drop everything rather than guess
+                            self.invalidate()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if resume_after is None:
+                    # Never got going, e.g. a standalone server without change streams
+                    logger.warning("Catalog change stream unavailable (%s); relying on TTL expiry", e)
+                    return
+                logger.warning("Catalog change stream interrupted (%s); resuming", e)
+                self.invalidate()
+                await asyncio.sleep(1)
@@ -0,0 +1,180 @@
+import re
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+# Collections holding a customer's history, and the action label for each
+HISTORY_SOURCES = [("sales", "Sale"), ("installations", "Installation"), ("returns", "Return")]
+
+
+# Lower-case and collapse whitespace, so prefix searches can use a plain index
+def normalize_name(name: str) -> str:
+    return " ".join(name.lower().split())
+
+
+# Fill in name_normalized for customers created before the field existed
+async def backfill_normalized_names(db, batch_size: int = 1000):
+    operations = []
+    async for customer in db.customers.find({"name_normalized": {"$exists": False}}, {"name": 1}):
+        operations.append(UpdateOne({"_id": customer["_id"]}, {"$set": {"name_normalized": normalize_name(customer["name"])}}))
+        if len(operations) == batch_size:
+            await db.customers.bulk_write(operations, ordered=False)
+            operations = []
+    if operations:
+        await db.customers.bulk_write(operations, ordered=False)
+
+
+def new_customer(name: str, number: str, address: str) -> dict:
+    return {
+        "name": name,
+        "name_normalized": normalize_name(name),
+        "number": number,
+        "address": address,
+        "date_added": datetime.now(),
+    }
+
+
+# Maps (name, number) to the customer document, creating the customer on first sight
+# with one upsert against the unique name_number index, so concurrent first orders
+# cannot create duplicates. Resolved customers are kept in an LRU; a customer's
+# identity never changes, so repeat customers resolve without touching MongoDB.
+class CustomerResolver:
+    def __init__(self, db, max_size: int = 10000):
+        self.db = db
+        self.max_size = max_size
+        self.entries: "OrderedDict[tuple, dict]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _remember(self, customer: dict) -> dict:
+        key = (customer["name"], customer["number"])
+        self.entries[key] = customer
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return customer
+
+    def _lookup(self, name: str, number: str) -> Optional[dict]:
+        customer = self.entries.get((name, number))
+        if customer is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end((name, number))
+        return customer
+
+    async def resolve(self, name: str, number: str, address: str) -> dict:
+        customer = self._lookup(name, number)
+        if customer is not None:
+            return customer
+        try:
+            customer = await self.db.customers.find_one_and_update(
+                {"name": name, "number": number},
+                {"$setOnInsert": new_customer(name, number, address)},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            # Lost the race to insert the same customer; it exists now
+            customer = await self.db.customers.find_one({"name": name, "number": number})
+        return self._remember(customer)
+
+    # Existing customer only; None if there is no such customer
+    async def find(self, name: str, number: str) -> Optional[dict]:
+        customer = self._lookup(name, number)
+        if customer is not None:
+            return customer
+        customer = await self.db.customers.find_one({"name": name, "number": number})
+        return self._remember(customer) if customer else None
+
+    # Resolve many (name, number) -> address pairs: one bulk upsert and one read for the misses
+    async def resolve_many(self, customers: Dict[tuple, str]) -> Dict[tuple, dict]:
+        found, missing = {}, {}
+        for (name, number), address in customers.items():
+            customer = self._lookup(name, number)
+            if customer is not None:
+                found[(name, number)] = customer
+            else:
+                missing[(name, number)] = address
+        if missing:
+            try:
+                await self.db.customers.bulk_write([
+                    UpdateOne({"name": name, "number": number}, {"$setOnInsert": new_customer(name, number, address)}, upsert=True)
+                    for (name, number), address in missing.items()
+                ], ordered=False)
+            except BulkWriteError as e:
+                # Duplicate keys mean another request created the customer first; anything else is real
+                if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                    raise
+            query = {"$or": [{"name": name, "number": number} for name, number in missing]}
+            async for customer in self.db.customers.find(query):
+                found[(customer["name"], customer["number"])] = self._remember(customer)
+        return found
+
+    # Existing customers only, with one read for the misses; unknown pairs are left out
+    async def find_many(self, keys: Iterable[tuple]) -> Dict[tuple, dict]:
+        found, missing = {}, []
+        for name, number in dict.fromkeys(keys):
+            customer = self._lookup(name, number)
+            if customer is not None:
+                found[(name, number)] = customer
+            else:
+                missing.append((name, number))
+        if missing:
+            query = {"$or": [{"name": name, "number": number} for name, number in missing]}
+            async for customer in self.db.customers.find(query):
+                found[(customer["name"], customer["number"])] = self._remember(customer)
+        return found
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+# Customers whose name starts with `name` (case-insensitive) and/or whose number matches.
+# The anchored regex on name_normalized is answered from the index.
+async def search_customers(db, name: Optional[str], number: Optional[str], limit: int) -> List[dict]:
+    query = {}
+    if name:
+        query["name_normalized"] = {"$regex": "^" + re.escape(normalize_name(name))}
+    if number:
+        query["number"] = number
+    return await db.customers.find(query).sort("name_normalized", 1).limit(limit).to_list(None)
+
+
+# One page of sales, installations and returns for the given customers, oldest first.
+# Records are matched on customer_id; ones written before records carried it fall back
+# to the customer's name and number. Each collection contributes at most `limit + 1`
+# documents through its customer indexes, so the cost depends on the page size, not on
+# the total history.
+async def customer_history(db, customers: List[dict], after: Optional[ObjectId], limit: int) -> Tuple[List[dict], Optional[str]]:
+    match = {"$or": [
+        {"customer_id": {"$in": [c["_id"] for c in customers]}},
+        *({"customer_number": c["number"], "customer_name": c["name"], "customer_id": {"$exists": False}} for c in customers),
+    ]}
+    if after is not None:
+        match["_id"] = {"$gt": after}
+
+    def source(action):
+        return [{"$match": match}, {"$sort": {"_id": 1}}, {"$limit": limit + 1}, {"$set": {"action": action}}]
+
+    (first, first_action), *others = HISTORY_SOURCES
+    pipeline = source(first_action)
+    for collection, action in others:
+        pipeline.append({"$unionWith": {"coll": collection, "pipeline": source(action)}})
+    pipeline += [{"$sort": {"_id": 1}}, {"$limit": limit + 1}]
+
+    docs = await (await getattr(db, first).aggregate(pipeline)).to_list(None)
+    next_after = None
+    if len(docs) > limit:
+        docs = docs[:limit]
+        next_after = str(docs[-1]["_id"])
+    return docs, next_after
@@ -0,0 +1,54 @@
+from typing import Optional
+from pymongo import AsyncMongoClient
+
+
+# Async MongoDB connection pool and collection handles. Nothing connects until
+# `connect()` is awaited from the application's startup, so importing the app
+# does not touch the network and a forked worker opens its own pool.
+class Database:
+    def __init__(self, uri: str, name: str, **options):
+        self.client: Optional[AsyncMongoClient] = None
+        self.configure(uri, name, **options)
+
+    # Point at another server or change pool options; only before `connect()`
+    def configure(
+        self,
+        uri: str,
+        name: str,
+        max_pool_size: int = 100,
+        min_pool_size: int = 0,
+        server_selection_timeout_ms: int = 5000,
+        connect_timeout_ms: int = 5000,
+        socket_timeout_ms: Optional[int] = None,
+        wait_queue_timeout_ms: Optional[int] = None,
+        **client_options,
+    ):
+        if self.client is not None:
+            raise RuntimeError("Cannot reconfigure a connected database")
+        self.uri = uri
+        self.name = name
+        self.client_options = dict(
+            maxPoolSize=max_pool_size,
+            minPoolSize=min_pool_size,
+            serverSelectionTimeoutMS=server_selection_timeout_ms,
+            connectTimeoutMS=connect_timeout_ms,
+            socketTimeoutMS=socket_timeout_ms,
+            waitQueueTimeoutMS=wait_queue_timeout_ms,
+            **client_options,
+        )
+
+    async def connect(self):
+        self.client = AsyncMongoClient(self.uri, **self.client_options)
+        await self.client.aconnect()
+        self.db = self.client[self.name]
+        self.products = self.db.products
+        self.sales = self.db.sales
+        self.customers = self.db.customers
+        self.installations = self.db.installations
+        self.returns = self.db.returns
+        self.stock_log = self.db.stock_log
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.close()
+            self.client = None
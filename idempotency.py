@@ -0,0 +1,150 @@
+import functools
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_KEYS = "idempotency_keys"  # {_id: "<endpoint>:<key>", fingerprint, state, status_code, response, lease_until, expires_at}
+FAILED_RESPONSE = {"detail": "The request failed after it may have changed stock. Check the records before retrying with a new Idempotency-Key."}
+
+
+def fingerprint(params: dict) -> str:
+    encoded = json.dumps(jsonable_encoder(params), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+# Remembers the response to each request sent with an Idempotency-Key header, so a
+# client retrying after a timeout gets the original result instead of applying the
+# sale/installation/return a second time. The first request claims the key with an
+# insert (unique _id), runs, then stores its response; documents expire through a TTL
+# index after `ttl` seconds. Completed responses are also kept in a small in-process
+# LRU so replays to the same worker skip MongoDB. A claim left behind by a crashed
+# worker can be taken over once its `lease` runs out. Only client errors (4xx), which
+# the endpoints raise before touching stock, free the key for a retry; any other
+# failure is stored as a 500 so the retry cannot apply the change twice.
+class IdempotencyStore:
+    def __init__(self, db, ttl: float = 86400, lease: float = 60, cache_size: int = 10000):
+        self.db = db
+        self.ttl = ttl
+        self.lease = lease
+        self.cache_size = cache_size
+        self.cache: "OrderedDict[str, tuple]" = OrderedDict()  # id -> (expires_at, fingerprint, response, status_code)
+
+    def _cached(self, key_id: str) -> Optional[tuple]:
+        entry = self.cache.get(key_id)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        self.cache.move_to_end(key_id)
+        return entry
+
+    def _remember(self, key_id: str, digest: str, response, status_code: int = 200):
+        self.cache[key_id] = (time.monotonic() + self.ttl, digest, response, status_code)
+        self.cache.move_to_end(key_id)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def _replay(self, digest: str, stored_digest: str, response, status_code: int = 200) -> JSONResponse:
+        if digest != stored_digest:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used with different parameters.")
+        return JSONResponse(response, status_code=status_code, headers={"Idempotent-Replayed": "true"})
+
+    # Claim the key for this request, or return the stored response if it already ran
+    async def begin(self, key_id: str, digest: str) -> Optional[JSONResponse]:
+        cached = self._cached(key_id)
+        if cached is not None:
+            return self._replay(digest, cached[1], cached[2], cached[3])
+
+        now = datetime.now(timezone.utc)
+        claim = {
+            "fingerprint": digest,
+            "state": "pending",
+            "lease_until": now + timedelta(seconds=self.lease),
+            "expires_at": now + timedelta(seconds=self.ttl),
+        }
+        try:
+            await self.db.db[IDEMPOTENCY_KEYS].insert_one({"_id": key_id, **claim})
+            return None
+        except DuplicateKeyError:
+            pass
+
+        # Take over a claim whose owner did not finish within its lease
+        taken = await self.db.db[IDEMPOTENCY_KEYS].find_one_and_update(
+            {"_id": key_id, "state": "pending", "lease_until": {"$lt": now}},
+            {"$set": claim},
+            return_document=ReturnDocument.AFTER,
+        )
+        if taken is not None:
+            return None
+
+        existing = await self.db.db[IDEMPOTENCY_KEYS].find_one({"_id": key_id})
+        if existing is None:  # Expired or released in the meantime
+            return await self.begin(key_id, digest)
+        if existing["state"] == "pending":
+            raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still being processed.")
+        status_code = existing.get("status_code", 200)
+        self._remember(key_id, existing["fingerprint"], existing["response"], status_code)
+        return self._replay(digest, existing["fingerprint"], existing["response"], status_code)
+
+    async def complete(self, key_id: str, digest: str, response):
+        response = jsonable_encoder(response)
+        await self.db.db[IDEMPOTENCY_KEYS].update_one(
+            {"_id": key_id}, {"$set": {"state": "done", "response": response}, "$unset": {"lease_until": ""}},
+        )
+        self._remember(key_id, digest, response)
+
+    # Rejected requests did not change anything, so the client may retry with the same key
+    async def release(self, key_id: str):
+        await self.db.db[IDEMPOTENCY_KEYS].delete_one({"_id": key_id, "state": "pending"})
+
+    # The request failed part way, possibly after stock was taken: keep the key and
+    # answer retries with a 500. If this write fails too, the claim stays pending.
+    async def fail(self, key_id: str, digest: str):
+        try:
+            await self.db.db[IDEMPOTENCY_KEYS].update_one(
+                {"_id": key_id},
+                {"$set": {"state": "failed", "status_code": 500, "response": FAILED_RESPONSE}, "$unset": {"lease_until": ""}},
+            )
+        except Exception as e:
+            logger.error("Could not record the failure of %s: %s", key_id, e)
+            return
+        self._remember(key_id, digest, FAILED_RESPONSE, 500)
+
+    # Decorator for endpoints taking an `idempotency_key` header parameter; requests
+    # without the header run as before
+    def guard(self, endpoint_name: str):
+        def decorate(endpoint):
+            @functools.wraps(endpoint)
+            async def wrapper(**params):
+                key = params.get("idempotency_key")
+                if not key:
+                    return await endpoint(**params)
+                key_id = f"{endpoint_name}:{key}"
+                digest = fingerprint({name: value for name, value in params.items() if name != "idempotency_key"})
+                replay = await self.begin(key_id, digest)
+                if replay is not None:
+                    return replay
+                try:
+                    response = await endpoint(**params)
+                except HTTPException as e:
+                    if e.status_code < 500:
+                        await self.release(key_id)
+                    else:
+                        await self.fail(key_id, digest)
+                    raise
+                except Exception:
+                    await self.fail(key_id, digest)
+                    raise
+                await self.complete(key_id, digest, response)
+                return response
+            return wrapper
+        return decorate
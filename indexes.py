@@ -0,0 +1,136 @@
+import logging
+from typing import Dict, List
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+# Every index the application relies on, by collection. Applied on startup;
+# create_indexes is a no-op for indexes that already exist.
+INDEXES: Dict[str, List[IndexModel]] = {
+    "products": [
+        IndexModel([("product_id", ASCENDING)], name="product_id_unique", unique=True),
+        IndexModel([("name", ASCENDING)], name="name_unique", unique=True),
+    ],
+    "customers": [
+        # One customer per (name, number); customer resolution upserts against it
+        IndexModel([("name", ASCENDING), ("number", ASCENDING)], name="name_number_unique", unique=True),
+        # Prefix search on the lower-cased name, and lookups by phone number
+        IndexModel([("name_normalized", ASCENDING)], name="name_normalized"),
+        IndexModel([("number", ASCENDING)], name="number"),
+    ],
+    "stock_log": [
+        IndexModel([("action", ASCENDING), ("date", ASCENDING)], name="action_date"),
+        IndexModel([("product_id", ASCENDING), ("date", ASCENDING)], name="product_id_date"),
+        # Keyset pagination in /view-logs/ walks _id within an action or product
+        IndexModel([("action", ASCENDING), ("_id", ASCENDING)], name="action_id"),
+        IndexModel([("product_id", ASCENDING), ("_id", ASCENDING)], name="product_id_id"),
+        # Date filters in /view-logs/, point-in-time stock and snapshot compaction
+        IndexModel([("date", ASCENDING), ("_id", ASCENDING)], name="date_id"),
+    ],
+    "sales": [
+        IndexModel([("customer_name", ASCENDING)], name="customer_name"),
+        IndexModel([("customer_number", ASCENDING)], name="customer_number"),
+        IndexModel([("customer_number", ASCENDING), ("customer_name", ASCENDING), ("_id", ASCENDING)], name="customer_history"),
+        IndexModel([("customer_id", ASCENDING), ("_id", ASCENDING)], name="customer_id_id"),
+        # Date filters in /view-records/, and archival walking each month by date
+        IndexModel([("date_added", ASCENDING), ("_id", ASCENDING)], name="date_added_id"),
+    ],
+    "installations": [
+        IndexModel([("customer_name", ASCENDING)], name="customer_name"),
+        IndexModel([("customer_number", ASCENDING)], name="customer_number"),
+        IndexModel([("customer_number", ASCENDING), ("customer_name", ASCENDING), ("_id", ASCENDING)], name="customer_history"),
+        IndexModel([("customer_id", ASCENDING), ("_id", ASCENDING)], name="customer_id_id"),
+        # Date filters in /view-records/, and archival walking each month by date
+        IndexModel([("date_added", ASCENDING), ("_id", ASCENDING)], name="date_added_id"),
+    ],
+    "returns": [
+        IndexModel([("customer_name", ASCENDING)], name="customer_name"),
+        IndexModel([("customer_number", ASCENDING)], name="customer_number"),
+        IndexModel([("customer_number", ASCENDING), ("customer_name", ASCENDING), ("_id", ASCENDING)], name="customer_history"),
+        IndexModel([("customer_id", ASCENDING), ("_id", ASCENDING)], name="customer_id_id"),
+        # Date filters in /view-records/, and archival walking each month by date
+        IndexModel([("date_added", ASCENDING), ("_id", ASCENDING)], name="date_added_id"),
+    ],
+    # Analytics rollups are read by day range
+    "sales_daily": [IndexModel([("_id.day", ASCENDING)], name="day")],
+    "manager_revenue_daily": [IndexModel([("_id.day", ASCENDING)], name="day")],
+    "stock_movements_daily": [IndexModel([("_id.day", ASCENDING)], name="day")],
+    # Sharded stock counters are read per product
+    "stock_shards": [IndexModel([("product_id", ASCENDING)], name="product_id")],
+    # Stored Idempotency-Key responses are removed once expires_at passes
+    "idempotency_keys": [IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0)],
+}
+
+# Representative filters for the queries each endpoint runs, used by the
+# explain-based self-check below. The values are placeholders; only the shape matters.
+ENDPOINT_QUERIES = [
+    ("/add-product/", "products", {"product_id": ""}),
+    ("/update-product-quantity/", "products", {"name": ""}),
+    ("/record-sale/", "customers", {"name": "", "number": ""}),
+    ("/record-sale/", "products", {"name": {"$in": [""]}}),
+    ("/record-installation/", "customers", {"name": "", "number": ""}),
+    ("/return-item/", "customers", {"name": "", "number": ""}),
+    ("/view-logs/", "stock_log", {"action": "sale"}),
+    ("/view-logs/", "stock_log", {"date": {"$gte": "", "$lte": ""}}),
+    ("/view-records/", "sales", {"date_added": {"$gte": "", "$lte": ""}}),
+    ("/view-records/", "installations", {"date_added": {"$gte": "", "$lte": ""}}),
+    ("/view-records/", "returns", {"date_added": {"$gte": "", "$lte": ""}}),
+    ("/stock-at", "stock_log", {"date": {"$gte": "", "$lte": ""}}),
+    ("archive", "sales", {"date_added": {"$gte": "", "$lt": ""}}),
+    ("archive", "installations", {"date_added": {"$gte": "", "$lt": ""}}),
+    ("archive", "returns", {"date_added": {"$gte": "", "$lt": ""}}),
+    ("/search-customer", "customers", {"name_normalized": {"$regex": "^a"}}),
+    ("/customers/{id}/history", "sales", {"customer_id": {"$in": [""]}}),
+    ("/customers/{id}/history", "installations", {"customer_id": {"$in": [""]}}),
+    ("/customers/{id}/history", "returns", {"customer_id": {"$in": [""]}}),
+    # Records written before they carried customer_id
+    ("/customers/{id}/history", "sales", {"customer_number": "", "customer_name": "", "customer_id": {"$exists": False}}),
+    ("/customers/{id}/history", "installations", {"customer_number": "", "customer_name": "", "customer_id": {"$exists": False}}),
+    ("/customers/{id}/history", "returns", {"customer_number": "", "customer_name": "", "customer_id": {"$exists": False}}),
+]
+
+
+async def ensure_indexes(db):
+    for collection, indexes in INDEXES.items():
+        try:
+            await db.db[collection].create_indexes(indexes)
+        except OperationFailure as e:
+            # Usually existing duplicates blocking a unique index; keep serving and report it
+            logger.error("Could not create indexes on %s: %s", collection, e)
+
+
+# The winning plans in an explain result, wherever it nests them: time-series and other
+# aggregation-backed collections report a `stages` pipeline whose $cursor holds the plan
+def _winning_plans(explain):
+    if isinstance(explain, dict):
+        if "winningPlan" in explain:
+            yield explain["winningPlan"]
+        for value in explain.values():
+            yield from _winning_plans(value)
+    elif isinstance(explain, list):
+        for value in explain:
+            yield from _winning_plans(value)
+
+
+def _stages(plan):
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from _stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from _stages(value)
+
+
+# Explain every endpoint query and report the ones whose winning plan still scans a whole collection
+async def check_query_plans(db) -> List[dict]:
+    collscans = []
+    for endpoint, collection, query in ENDPOINT_QUERIES:
+        explain = await db.db.command({"explain": {"find": collection, "filter": query}, "verbosity": "queryPlanner"})
+        if any("COLLSCAN" in _stages(plan) for plan in _winning_plans(explain)):
+            collscans.append({"endpoint": endpoint, "collection": collection, "filter": query})
+    for scan in collscans:
+        logger.warning("%s runs a COLLSCAN on %s for %s", scan["endpoint"], scan["collection"], scan["filter"])
+    return collscans
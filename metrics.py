@@ -0,0 +1,192 @@
+import logging
+import threading
+import time
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+
+
+# Prometheus histogram keyed by label values; rendered in the text exposition format
+class Histogram:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...], buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series: Dict[tuple, list] = {}  # label values -> [per-bucket counts..., sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, *label_values: str):
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            items = [(values, list(series)) for values, series in self.series.items()]
+        for values, series in sorted(items):
+            labels = ",".join(f'{key}="{escape(value)}"' for key, value in zip(self.labels, values))
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels}{"," if labels else ""}le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{labels}{"," if labels else ""}le="+Inf"}} {series[-1]}')
+            lines.append(f"{self.name}_sum{{{labels}}} {series[-2]}")
+            lines.append(f"{self.name}_count{{{labels}}} {series[-1]}")
+        return lines
+
+
+# Prometheus counter (only goes up) or gauge (current value) keyed by label values
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...]):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: Dict[tuple, float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values: str, amount: float = 1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            items = sorted(self.values.items())
+        for values, value in items:
+            labels = ",".join(f'{key}="{escape(value)}"' for key, value in zip(self.labels, values))
+            lines.append(f"{self.name}{{{labels}}} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, *label_values: str):
+        with self.lock:
+            self.values[label_values] = value
+
+
+def escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+REQUEST_SECONDS = Histogram("http_request_duration_seconds", "Time from request to the end of the response body", ("method", "route", "status"))
+HANDLER_SECONDS = Histogram("http_handler_duration_seconds", "Time until the response headers are ready", ("method", "route"))
+REQUEST_DB_SECONDS = Histogram("http_request_db_seconds", "Time spent in MongoDB commands per request", ("method", "route"))
+REQUEST_DB_COMMANDS = Histogram("http_request_db_commands", "MongoDB commands per request", ("method", "route"), buckets=COUNT_BUCKETS)
+MONGO_COMMAND_SECONDS = Histogram("mongodb_command_duration_seconds", "MongoDB command round-trip time", ("command", "outcome"))
+SMTP_SEND_SECONDS = Histogram("smtp_send_duration_seconds", "Time to hand one email to the SMTP server", ("outcome",))
+ADMISSION_WAIT_SECONDS = Histogram("http_admission_wait_seconds", "Time admitted requests waited in the admission queue", ("lane",))
+ADMISSION_RUNNING = Gauge("http_admission_running", "Requests currently running per admission lane", ("lane",))
+ADMISSION_QUEUED = Gauge("http_admission_queue_depth", "Requests currently waiting per admission lane", ("lane",))
+ADMISSION_SHED = Counter("http_admission_shed_total", "Requests turned away by admission control", ("lane", "reason"))
+
+HISTOGRAMS = [REQUEST_SECONDS, HANDLER_SECONDS, REQUEST_DB_SECONDS, REQUEST_DB_COMMANDS, MONGO_COMMAND_SECONDS, SMTP_SEND_SECONDS, ADMISSION_WAIT_SECONDS]
+GAUGES = [ADMISSION_RUNNING, ADMISSION_QUEUED]
+COUNTERS = [ADMISSION_SHED]
+
+
+def render() -> str:
+    return "\n".join(line for metric in HISTOGRAMS + GAUGES + COUNTERS for line in metric.render()) + "\n"
+
+
+# What the current request has spent so far; None outside a request (background tasks)
+class RequestStats:
+    def __init__(self):
+        self.db_commands = 0
+        self.db_seconds = 0.0
+
+
+current_request: ContextVar[Optional[RequestStats]] = ContextVar("current_request", default=None)
+
+
+# Times every MongoDB command and charges it to the request that issued it. The async
+# client publishes events from the task running the operation, so the context variable
+# set by the middleware is visible here.
+class CommandMetrics(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._record(event, "ok")
+
+    def failed(self, event):
+        self._record(event, "error")
+
+    def _record(self, event, outcome: str):
+        seconds = event.duration_micros / 1e6
+        MONGO_COMMAND_SECONDS.observe(seconds, event.command_name, outcome)
+        stats = current_request.get()
+        if stats is not None:
+            stats.db_commands += 1
+            stats.db_seconds += seconds
+
+
+# ASGI middleware recording per-route timings. Routes are labelled by their path template
+# so ids in the URL do not create new series. Requests slower than `slow_threshold` seconds
+# are logged with their breakdown: handler (until headers), MongoDB share, response body.
+class RequestMetricsMiddleware:
+    def __init__(self, app, slow_threshold: float = 1.0):
+        self.app = app
+        self.slow_threshold = slow_threshold
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = current_request.set(stats)
+        started = time.perf_counter()
+        headers_at = None
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal headers_at, status
+            if message["type"] == "http.response.start":
+                headers_at = time.perf_counter()
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            finished = time.perf_counter()
+            current_request.reset(token)
+            self._record(scope, status, started, headers_at or finished, finished, stats)
+
+    def _record(self, scope, status: int, started: float, headers_at: float, finished: float, stats: RequestStats):
+        route = scope.get("route")
+        path = getattr(route, "path", "unmatched")
+        method = scope["method"]
+        total = finished - started
+        handler = headers_at - started
+
+        REQUEST_SECONDS.observe(total, method, path, str(status))
+        HANDLER_SECONDS.observe(handler, method, path)
+        REQUEST_DB_SECONDS.observe(stats.db_seconds, method, path)
+        REQUEST_DB_COMMANDS.observe(stats.db_commands, method, path)
+
+        if total >= self.slow_threshold:
+            logger.warning(
+                "Slow request %s %s -> %d in %.1f ms: handler %.1f ms (MongoDB %.1f ms over %d commands, "
+                "Python %.1f ms), response body %.1f ms",
+                method, scope["path"], status, total * 1000, handler * 1000, stats.db_seconds * 1000,
+                stats.db_commands, max(handler - stats.db_seconds, 0) * 1000, (finished - headers_at) * 1000,
+            )
@@ -0,0 +1,196 @@
+import asyncio
+import logging
+import smtplib
+import time
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+from typing import List, Optional, Tuple
+from metrics import SMTP_SEND_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+# One SMTP connection, opened lazily and kept authenticated between messages
+class SMTPSession:
+    def __init__(self, host: str, port: int, sender: str, password: Optional[str],
+                 use_tls: bool = True, timeout: float = 30):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.password = password
+        self.use_tls = use_tls
+        self.timeout = timeout
+        self.server: Optional[smtplib.SMTP] = None
+
+    def connect(self):
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.use_tls:
+            server.starttls()  # Secure the connection
+        if self.password:
+            server.login(self.sender, self.password)
+        self.server = server
+
+    def send(self, recipient: str, subject: str, message: str):
+        msg = MIMEMultipart()
+        msg['From'] = self.sender
+        msg['To'] = recipient
+        msg['Subject'] = subject
+        msg.attach(MIMEText(message, 'plain'))
+
+        if self.server is None:
+            self.connect()
+        try:
+            self.server.sendmail(self.sender, recipient, msg.as_string())
+        except smtplib.SMTPServerDisconnected:
+            # The server dropped an idle session; reconnect once and resend
+            self.connect()
+            self.server.sendmail(self.sender, recipient, msg.as_string())
+
+    def close(self):
+        if self.server is None:
+            return
+        try:
+            self.server.quit()
+        except Exception:
+            pass
+        self.server = None
+
+
+# Bounded in-process queue of email notifications delivered by background workers.
+# Bursts that arrive within `digest_window` seconds are merged into one message.
+class EmailNotifier:
+    def __init__(self, host: str, port: int, sender: str, password: Optional[str], recipient: str, **options):
+        self.queue: Optional[asyncio.Queue] = None
+        self.configure(host, port, sender, password, recipient, **options)
+        self.workers: List[asyncio.Task] = []
+        self.sessions: List[SMTPSession] = []
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+
+    # Change the mail server or queue settings; only before `start()`, which opens the
+    # SMTP sessions in the worker process
+    def configure(
+        self,
+        host: str,
+        port: int,
+        sender: str,
+        password: Optional[str],
+        recipient: str,
+        use_tls: bool = True,
+        require_login: bool = True,
+        queue_size: int = 1000,
+        workers: int = 1,
+        digest_window: float = 2.0,
+        max_digest: int = 50,
+        max_retries: int = 5,
+        retry_backoff: float = 1.0,
+    ):
+        if self.queue is not None:
+            raise RuntimeError("Cannot reconfigure a started notifier")
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.password = password
+        self.recipient = recipient
+        self.use_tls = use_tls
+        self.require_login = require_login
+        self.queue_size = queue_size
+        self.worker_count = workers
+        self.digest_window = digest_window
+        self.max_digest = max_digest
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+
+    async def start(self):
+        if self.require_login and not self.password:
+            logger.warning("SENDER_PASSWORD is not set; email notifications are disabled")
+            return
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        for i in range(self.worker_count):
+            session = SMTPSession(self.host, self.port, self.sender, self.password, self.use_tls)
+            self.sessions.append(session)
+            self.workers.append(asyncio.create_task(self._worker(session), name=f"email-worker-{i}"))
+
+    # Queue a message without waiting for delivery; returns False if it had to be dropped
+    def notify(self, subject: str, message: str) -> bool:
+        if self.queue is None:
+            if self.require_login and not self.password:
+                logger.debug("Email disabled, dropping %r", subject)
+            else:
+                logger.warning("Email notifier not started, dropping %r", subject)
+            self.dropped += 1
+            return False
+        try:
+            self.queue.put_nowait((subject, message))
+            return True
+        except asyncio.QueueFull:
+            logger.warning("Email queue full, dropping %r", subject)
+            self.dropped += 1
+            return False
+
+    # Wait for queued messages to go out, then close the SMTP sessions
+    async def stop(self, drain_timeout: float = 30):
+        if self.queue is not None:
+            try:
+                await asyncio.wait_for(self.queue.join(), drain_timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Email queue not drained on shutdown, %d message(s) lost", self.queue.qsize())
+        for task in self.workers:
+            task.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        for session in self.sessions:
+            await asyncio.to_thread(session.close)
+        self.workers = []
+        self.sessions = []
+        self.queue = None
+
+    async def _collect_batch(self) -> List[Tuple[str, str]]:
+        batch = [await self.queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.digest_window
+        while len(batch) < self.max_digest:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _worker(self, session: SMTPSession):
+        while True:
+            batch = await self._collect_batch()
+            try:
+                subject, message = digest(batch)
+                await self._deliver(session, subject, message)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def _deliver(self, session: SMTPSession, subject: str, message: str):
+        for attempt in range(self.max_retries):
+            started = time.perf_counter()
+            try:
+                await asyncio.to_thread(session.send, self.recipient, subject, message)
+                SMTP_SEND_SECONDS.observe(time.perf_counter() - started, "ok")
+                self.sent += 1
+                return
+            except Exception as e:
+                SMTP_SEND_SECONDS.observe(time.perf_counter() - started, "error")
+                logger.warning("Error sending email (attempt %d/%d): %s", attempt + 1, self.max_retries, e)
+                await asyncio.to_thread(session.close)
+                if attempt + 1 < self.max_retries:
+                    await asyncio.sleep(self.retry_backoff * 2 ** attempt)
+        self.failed += 1
+        logger.error("Giving up on email %r after %d attempts", subject, self.max_retries)
+
+
+# Merge several queued notifications into a single message
+def digest(batch: List[Tuple[str, str]]) -> Tuple[str, str]:
+    if len(batch) == 1:
+        return batch[0]
+    subject = f"Inventory Digest: {len(batch)} notifications"
+    parts = [f"=== {item_subject} ===\n\n{item_message}" for item_subject, item_message in batch]
+    return subject, "\n".join(parts)
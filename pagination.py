@@ -0,0 +1,86 @@
+from datetime import datetime
+from typing import AsyncIterator, Callable, List, Optional, Tuple
+from bson import ObjectId
+from bson.errors import InvalidId
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from responses import dumps
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 1000  # Documents fetched per cursor batch and written per chunk when streaming
+
+
+def parse_object_id(value: str, detail: str) -> ObjectId:
+    try:
+        return ObjectId(value)
+    except (InvalidId, TypeError):
+        raise HTTPException(status_code=400, detail=detail)
+
+
+# Restrict a query to documents after the `after` cursor (the last _id of the previous page)
+def after_cursor(query: dict, after: Optional[str]) -> dict:
+    if after:
+        query["_id"] = {"$gt": parse_object_id(after, "Invalid 'after' cursor.")}
+    return query
+
+
+def date_range(start: Optional[datetime], end: Optional[datetime]) -> dict:
+    condition = {}
+    if start:
+        condition["$gte"] = start
+    if end:
+        condition["$lte"] = end
+    return condition
+
+
+# Turn a comma-separated `fields` parameter into a MongoDB projection
+def projection(fields: Optional[str]) -> Optional[dict]:
+    if not fields:
+        return None
+    return {field.strip(): 1 for field in fields.split(",") if field.strip()}
+
+
+# Fetch one page in _id order; next_after is None on the last page. Documents keep their
+# BSON types, so return them through FastJSONResponse. `archived` are matching documents
+# from the archive (at most limit + 1, in _id order) to merge in.
+async def fetch_page(collection, query: dict, limit: int, fields: Optional[dict] = None,
+                     archived: List[dict] = ()) -> Tuple[List[dict], Optional[str]]:
+    docs = await collection.find(query, fields).sort("_id", 1).limit(limit + 1).to_list(None)
+    if archived:
+        docs = sorted(list(archived) + docs, key=lambda doc: doc["_id"])[:limit + 1]
+    next_after = None
+    if len(docs) > limit:
+        docs = docs[:limit]
+        next_after = str(docs[-1]["_id"])
+    return docs, next_after
+
+
+# Stream matching documents as newline-delimited JSON without holding the result set in memory.
+# `archived` yields batches of older, archived documents that go out first; `prepare`
+# adjusts each document before it is encoded.
+def stream_ndjson(collection, query: dict, fields: Optional[dict] = None, limit: Optional[int] = None,
+                  archived: Optional[AsyncIterator[List[dict]]] = None,
+                  prepare: Callable[[dict], dict] = lambda doc: doc) -> StreamingResponse:
+    async def rows():
+        remaining = limit
+        if archived is not None:
+            async for batch in archived:
+                yield b"".join(dumps(prepare(doc)) + b"\n" for doc in batch)
+                if remaining:
+                    remaining -= len(batch)
+            if limit and remaining <= 0:
+                return
+        cursor = collection.find(query, fields, batch_size=STREAM_BATCH_SIZE).sort("_id", 1)
+        if remaining:
+            cursor = cursor.limit(remaining)
+        chunk = []
+        async for doc in cursor:
+            chunk.append(dumps(prepare(doc)))
+            if len(chunk) == STREAM_BATCH_SIZE:
+                yield b"\n".join(chunk) + b"\n"
+                chunk = []
+        if chunk:
+            yield b"\n".join(chunk) + b"\n"
+
+    return StreamingResponse(rows(), media_type="application/x-ndjson")
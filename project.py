@@ -1,32 +1,128 @@
-from fastapi import FastAPI, HTTPException, Form, Query
+from fastapi import APIRouter, FastAPI, HTTPException, Form, Query, File, UploadFile, Header, Request
 from pydantic import BaseModel
-from pymongo import MongoClient
-from datetime import datetime,timezone
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-import smtplib
+import os
+from datetime import datetime,timedelta,timezone
+from contextlib import asynccontextmanager
 from typing import List,Optional
 from fastapi.middleware.cors import CORSMiddleware
-
-app = FastAPI()
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # You can specify a list of allowed origins if needed, e.g., ["http://localhost:3000"]
-    allow_credentials=True,
-    allow_methods=["*"],  # Allows all methods (GET, POST, etc.)
-    allow_headers=["*"],  # Allows all headers
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pymongo.errors import DuplicateKeyError
+from admission import AdmissionMiddleware
+from alerts import ThresholdMonitor
+from archive import Archive
+from analytics import track_sales, sales_per_product, revenue_per_manager, stock_turnover, low_stock, rebuild_rollups
+from audit import StockLogWriter, ensure_stock_log_collection, migrate_stock_log_dates, with_utc_date
+from batch_orders import MAX_BATCH_ORDERS, SALE_ORDERS, INSTALLATION_ORDERS, RETURN_ORDERS, UndoFailed, record_orders
+from bulk_import import ImportReport, detect_format, read_batches, import_products, import_stock_adjustments, import_sales
+from catalog import CatalogCache
+from customers import CustomerResolver, backfill_normalized_names, search_customers, customer_history
+from database import Database
+from idempotency import IdempotencyStore
+from indexes import ensure_indexes, check_query_plans
+import metrics
+from metrics import CommandMetrics, RequestMetricsMiddleware
+from responses import CompressionMiddleware, FastJSONResponse
+from reconcile import StockReconciler
+from settings import Settings
+from pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, parse_object_id, after_cursor, date_range, projection, fetch_page, stream_ndjson
+from notifications import EmailNotifier
+from sync import ChangeFeed
+from shards import ShardedStock
+from snapshots import SnapshotCompactor, stock_at, product_stock_at, utc
+from stock import StockEngine, StockChange, ProductNotFound, InsufficientStock
+from versions import VersionCounters
+
+# Per-worker startup: the Mongo pool, indexes, background jobs and SMTP sessions are all
+# opened here, after the server has forked, and /readyz only reports ready once the
+# catalog is cached
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    settings: Settings = app.state.settings
+    app.state.ready = False
+    await db.connect()
+    await ensure_stock_log_collection(db)
+    await migrate_stock_log_dates(db)
+    await ensure_indexes(db)
+    await backfill_normalized_names(db)
+    if settings.check_query_plans:
+        await check_query_plans(db)
+    if settings.warm_catalog:
+        await catalog.all()
+    if CATALOG_WATCH_CHANGES:
+        catalog.start_watching()
+    await notifier.start()
+    await stock_log_writer.start()
+    versions.start()
+    snapshot_compactor.start()
+    archive.start()
+    stock_shards.start()
+    reconciler.start()
+    app.state.ready = True
+    yield
+    app.state.ready = False  # Fail readiness first so the load balancer stops sending traffic
+    await reconciler.stop()
+    await stock_shards.stop()
+    await archive.stop()
+    await snapshot_compactor.stop()
+    await stock_log_writer.stop()
+    await versions.stop()
+    # Flush pending alerts and notifications before the worker exits
+    await threshold_monitor.stop()
+    await notifier.stop()
+    await catalog.stop_watching()
+    await db.close()
+
+# Routes are collected here and mounted on the application by create_app()
+router = APIRouter()
+
+# Deployment settings (MONGO_*, SMTP_*, CORS_ORIGINS, ADMISSION_*, ...) read from the environment
+settings = Settings.from_env()
+
+# MongoDB Connection (opened on startup, one pool per worker process; pool options are applied by create_app())
+db = Database(settings.mongo_uri, settings.mongo_db_name)
+
+# Product catalog cache; reads of the catalog and name -> product_id lookups are served from memory
+CATALOG_CACHE_TTL = float(os.environ.get("CATALOG_CACHE_TTL", 30))
+CATALOG_CACHE_SIZE = int(os.environ.get("CATALOG_CACHE_SIZE", 10000))
+CATALOG_WATCH_CHANGES = os.environ.get("CATALOG_WATCH_CHANGES", "0") == "1"  # Needs a replica set
+catalog = CatalogCache(db, ttl=CATALOG_CACHE_TTL, max_size=CATALOG_CACHE_SIZE)
+
+# stock_log entries are written with insert_many; a positive interval buffers entries
+# across requests and bounds how long an entry can wait before it is written
+STOCK_LOG_FLUSH_INTERVAL = float(os.environ.get("STOCK_LOG_FLUSH_INTERVAL", 0))
+STOCK_LOG_MAX_BATCH = int(os.environ.get("STOCK_LOG_MAX_BATCH", 1000))
+stock_log_writer = StockLogWriter(db, flush_interval=STOCK_LOG_FLUSH_INTERVAL, max_batch=STOCK_LOG_MAX_BATCH)
+
+# Recently seen customers, so repeat customers are resolved without a database round-trip
+CUSTOMER_CACHE_SIZE = int(os.environ.get("CUSTOMER_CACHE_SIZE", 10000))
+customer_resolver = CustomerResolver(db, max_size=CUSTOMER_CACHE_SIZE)
+
+# Change counters behind the ETag / Last-Modified headers of the catalog and record listings.
+# Another worker's product changes also drop this worker's catalog cache.
+VERSION_REFRESH_INTERVAL = float(os.environ.get("VERSION_REFRESH_INTERVAL", 1.0))
+VERSION_FLUSH_INTERVAL = float(os.environ.get("VERSION_FLUSH_INTERVAL", 0.25))  # Seconds this worker's bumps are batched
+versions = VersionCounters(db, refresh_interval=VERSION_REFRESH_INTERVAL, flush_interval=VERSION_FLUSH_INTERVAL)
+versions.on_change("products", catalog.invalidate)
+
+# Delta feed for offline terminals. Changes are handed out once they are this many seconds
+# old (plus the stock_log flush interval), so late inserts from other workers are not skipped.
+SYNC_SETTLE_SECONDS = float(os.environ.get("SYNC_SETTLE_SECONDS", 5))
+MAX_SYNC_WAIT = 60  # Longest long-poll, in seconds
+change_feed = ChangeFeed(db, versions, settle=SYNC_SETTLE_SECONDS + STOCK_LOG_FLUSH_INTERVAL)
+
+# Whole-catalog stock snapshots behind /stock-at, built in the background
+STOCK_SNAPSHOT_INTERVAL_HOURS = float(os.environ.get("STOCK_SNAPSHOT_INTERVAL_HOURS", 24))
+STOCK_SNAPSHOT_RUN_EVERY = float(os.environ.get("STOCK_SNAPSHOT_RUN_EVERY", 3600))  # Seconds between compaction runs
+snapshot_compactor = SnapshotCompactor(
+    db, interval=timedelta(hours=STOCK_SNAPSHOT_INTERVAL_HOURS), run_every=STOCK_SNAPSHOT_RUN_EVERY,
 )
 
-# MongoDB Connection
-client = MongoClient("mongodb://localhost:27017")
-db = client.stock_management
-products_collection = db.products
-sales_collection = db.sales
-customers_collection = db.customers
-installations_collection = db.installations
-returns_collection = db.returns
-stock_log = db.stock_log
+# Sales, installations, returns and stock_log entries older than the horizon are moved to
+# compressed Parquet files under ARCHIVE_DIR (needs pyarrow); the listings read them back
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR")
+ARCHIVE_AFTER_DAYS = int(os.environ.get("ARCHIVE_AFTER_DAYS", 365))
+ARCHIVE_RUN_EVERY = float(os.environ.get("ARCHIVE_RUN_EVERY", 86400))  # Seconds between archival runs
+archive = Archive(db, ARCHIVE_DIR, horizon_days=ARCHIVE_AFTER_DAYS, run_every=ARCHIVE_RUN_EVERY)
 
 # Product Model
 class Product(BaseModel):
@@ -92,49 +188,77 @@ class ReturnRequest(BaseModel):
     quantities: List[int]
     remarks: str
 
-# Email setup (Gmail SMTP server)
-SENDER_EMAIL = "gamingidofmine@gmail.com"  # Replace with your Gmail address
-SENDER_PASSWORD = "onoi wwnf vxql xscx"  # Replace with your Gmail app password
-RECIPIENT_EMAIL = "sahil14agrawal03@gmail.com"  # Replace with your phone or email address
-SMTP_SERVER = "smtp.gmail.com"
-SMTP_PORT = 587
+# One row of a bulk sales import: a single product sold to a customer
+class SaleImportRow(BaseModel):
+    customer_name: str
+    customer_number: str
+    customer_address: str
+    manager_name: str
+    date: str
+    product_name: str
+    quantity: int
+    amount: float
+    remarks: str = ""
 
-# Helper function to send an email
-def send_email(subject: str, message: str):
-    msg = MIMEMultipart()
-    msg['From'] = SENDER_EMAIL
-    msg['To'] = RECIPIENT_EMAIL
-    msg['Subject'] = subject
+# Email notifications (SMTP_*, SENDER_*, RECIPIENT_EMAIL and EMAIL_* settings, applied by create_app())
+notifier = EmailNotifier(
+    settings.smtp_server, settings.smtp_port, settings.sender_email, settings.sender_password, settings.recipient_email,
+)
 
-    msg.attach(MIMEText(message, 'plain'))
+# Per-event emails (every sale, return, ...) are off by default; low-stock alerts replace them
+EMAIL_EVERY_EVENT = os.environ.get("EMAIL_EVERY_EVENT", "0") == "1"
+LOW_STOCK_DIGEST_WINDOW = float(os.environ.get("LOW_STOCK_DIGEST_WINDOW", 60))  # Seconds alerts are collected per email
+
+threshold_monitor = ThresholdMonitor(db, notifier, digest_window=LOW_STOCK_DIGEST_WINDOW)
+
+# Hot products can keep their stock in several counter documents (POST /stock-shards/{product_id});
+# their stock_quantity is refreshed from the shards this often, in seconds
+STOCK_SHARD_REBALANCE_EVERY = float(os.environ.get("STOCK_SHARD_REBALANCE_EVERY", 1.0))
+MAX_STOCK_SHARDS = 64
+stock_shards = ShardedStock(db, rebalance_every=STOCK_SHARD_REBALANCE_EVERY)
+stock = StockEngine(db, cache=catalog, monitor=threshold_monitor, shards=stock_shards)
+
+# Background check of products.stock_quantity against the stock_log; each run folds only the
+# entries logged since the previous one. Mismatches are logged, POST /reconcile-stock reports
+# (and repairs) them on demand.
+STOCK_RECONCILE_EVERY = float(os.environ.get("STOCK_RECONCILE_EVERY", 3600))  # Seconds between runs
+STOCK_RECONCILE_PARTITIONS = int(os.environ.get("STOCK_RECONCILE_PARTITIONS", 4))
+MAX_RECONCILE_PARTITIONS = 32
+reconciler = StockReconciler(
+    db, stock, stock_log_writer, archive=archive, settle=SYNC_SETTLE_SECONDS + STOCK_LOG_FLUSH_INTERVAL,
+    run_every=STOCK_RECONCILE_EVERY, partitions=STOCK_RECONCILE_PARTITIONS,
+)
 
-    try:
-        server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
-        server.starttls()  # Secure the connection
-        server.login(SENDER_EMAIL, SENDER_PASSWORD)
-        text = msg.as_string()
-        server.sendmail(SENDER_EMAIL, RECIPIENT_EMAIL, text)
-        server.quit()
-        print("Email sent successfully!")
-    except Exception as e:
-        print(f"Error sending email: {e}")
+# Responses to requests carrying an Idempotency-Key are kept this long, so client retries replay them
+IDEMPOTENCY_TTL = float(os.environ.get("IDEMPOTENCY_TTL", 86400))
+idempotency = IdempotencyStore(db, ttl=IDEMPOTENCY_TTL)
 
-def convert_objectid_to_str(log):
-    log["_id"] = str(log["_id"])  # Convert ObjectId to string
-    return log
+# Helper function to send an event email; it is queued and delivered in the background.
+# Returns whether it was queued: per-event email is off unless EMAIL_EVERY_EVENT=1.
+def send_email(subject: str, message: str) -> bool:
+    if EMAIL_EVERY_EVENT:
+        return notifier.notify(subject, message)
+    return False
 
-@app.post("/add-product/")
+@router.post("/add-product/")
 async def add_product(product: Product):
-    if products_collection.find_one({"product_id": product.product_id}):
+    if await catalog.get_by_product_id(product.product_id):
         raise HTTPException(status_code=400, detail="Product with this ID already exists")
 
     new_product = product.model_dump()
     new_product["date_added"] = datetime.now(timezone.utc)
-    result = products_collection.insert_one(new_product)
+    try:
+        result = await db.products.insert_one(new_product)
+    except DuplicateKeyError as e:
+        # The unique indexes catch products added since the cache was filled
+        field = "name" if "name" in (e.details or {}).get("keyPattern", {}) else "ID"
+        raise HTTPException(status_code=400, detail=f"Product with this {field} already exists")
     
     if result.acknowledged:
-        # Fetch updated stock info
-        product_info = products_collection.find_one({"product_id": product.product_id})
+        # The inserted document is the current stock info
+        product_info = new_product
+        catalog.put(new_product)
+        await threshold_monitor.evaluate([new_product])
 
         # Prepare email content
         email_subject = "New Product Added to Inventory"
@@ -149,11 +273,11 @@ async def add_product(product: Product):
         )
 
         # Send email
-        send_email(email_subject, email_body)
+        email_queued = send_email(email_subject, email_body)
 
         # Log the action in stock_log collection
         stock_log_entry = {
-            "date": datetime.now(timezone.utc).isoformat(),
+            "date": datetime.now(timezone.utc),
             "action": "add",
             "product_id": product.product_id,
             "product_name": product.name,
@@ -161,77 +285,77 @@ async def add_product(product: Product):
             "remaining_stock": product_info['stock_quantity'],
             "performed_by": product.added_by
         }
-        stock_log.insert_one(stock_log_entry)
+        await stock_log_writer.write([stock_log_entry])
+        await versions.bump("products")
 
-        return {"message": "Product added successfully, logged and email notification sent!"}
+        if email_queued:
+            return {"message": "Product added successfully, logged and email notification queued!"}
+        return {"message": "Product added successfully and logged!"}
     
     else:
         raise HTTPException(status_code=500, detail="Failed to add product")
 
-@app.get("/view-all-stock/", response_model=List[Product])
-async def view_all_stock():
-    products = list(products_collection.find())  # Fetch all products
+PRODUCT_FIELDS = list(Product.model_fields)
+
+@router.get("/view-all-stock/", response_model=List[Product])
+@versions.conditional("products")
+async def view_all_stock(request: Request):
+    products = await catalog.all()  # Fetch all products
     if not products:
         raise HTTPException(status_code=404, detail="No products found.")
     
-    # Convert the MongoDB _id to string
-    for product in products:
-        product['_id'] = str(product['_id'])
-    
-    return products
+    # Copy just the Product fields out of the cached documents; they were validated on the
+    # way in, so the response is encoded directly instead of being re-validated
+    return FastJSONResponse([{field: product.get(field) for field in PRODUCT_FIELDS} for product in products])
 
-@app.put("/update-product-quantity/")
+@router.put("/update-product-quantity/")
 async def update_product_quantity(product_update: ProductUpdate):
-    # Find the product by product name (field is 'name' in the DB)
-    product = products_collection.find_one({"name": product_update.product_name})
-    
-    if not product:
+    # Apply the change atomically; the engine refuses to take stock below zero
+    try:
+        [result] = await stock.apply(
+            [StockChange(product_update.product_name, product_update.quantity)],
+            set_fields={"date_added": datetime.now(timezone.utc)},
+        )
+    except ProductNotFound:
         raise HTTPException(status_code=404, detail="Product not found.")
-    
-    # Calculate the new stock quantity
-    new_quantity = product["stock_quantity"] + product_update.quantity
-    if new_quantity < 0:
+    except InsufficientStock:
         raise HTTPException(status_code=400, detail="Quantity cannot be negative.")
 
-    # Update the product stock
-    result = products_collection.update_one(
-        {"name": product_update.product_name},
-        {"$set": {"stock_quantity": new_quantity, "date_added": datetime.now(timezone.utc)}}
+    product = result.product
+    new_quantity = result.remaining_stock
+
+    # Prepare email content
+    email_subject = f"Product Quantity Updated: {product['name']}"
+    email_body = (
+        f"Product: {product['name']}\n"
+        f"Category: {product['category']}\n"
+        f"Old Stock Quantity: {new_quantity - product_update.quantity}\n"
+        f"Quantity Added: {product_update.quantity}\n"
+        f"New Stock Quantity: {new_quantity}\n"
+        f"Updated By: {product_update.updated_by}\n"
+        f"Update Date: {datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')}\n"
     )
 
-    if result.modified_count == 1:
-        # Prepare email content
-        email_subject = f"Product Quantity Updated: {product['name']}"
-        email_body = (
-            f"Product: {product['name']}\n"
-            f"Category: {product['category']}\n"
-            f"Old Stock Quantity: {product['stock_quantity']}\n"
-            f"Quantity Added: {product_update.quantity}\n"
-            f"New Stock Quantity: {new_quantity}\n"
-            f"Updated By: {product_update.updated_by}\n"
-            f"Update Date: {datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')}\n"
-        )
-
-        # Send email notification
-        send_email(email_subject, email_body)
-
-        # Log the update in stock_log collection
-        stock_log_entry = {
-            "date": datetime.now(timezone.utc).isoformat(),
-            "action": "update",
-            "product_id": product["product_id"],
-            "product_name": product["name"],
-            "quantity_changed": product_update.quantity,
-            "remaining_stock": new_quantity,
-            "performed_by": product_update.updated_by
-        }
-        stock_log.insert_one(stock_log_entry)
+    # Send email notification
+    send_email(email_subject, email_body)
+
+    # Log the update in stock_log collection
+    stock_log_entry = {
+        "date": datetime.now(timezone.utc),
+        "action": "update",
+        "product_id": product["product_id"],
+        "product_name": product["name"],
+        "quantity_changed": product_update.quantity,
+        "remaining_stock": new_quantity,
+        "performed_by": product_update.updated_by
+    }
+    await stock_log_writer.write([stock_log_entry])
+    await versions.bump("products")
 
-        return {"message": f"Product quantity updated successfully. New stock: {new_quantity}"}
-    else:
-        raise HTTPException(status_code=500, detail="Failed to update product quantity.")
+    return {"message": f"Product quantity updated successfully. New stock: {new_quantity}"}
 
-@app.post("/record-sale/")
+@router.post("/record-sale/")
+@idempotency.guard("record-sale")
 async def record_sale(
     customer_name: str = Form(...),
     customer_number: str = Form(...),
@@ -243,19 +367,10 @@ async def record_sale(
     quantities: List[int] = Form(...),
     amounts: List[float] = Form(...),
     remarks: List[str] = Form(...),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
 ):
-    # Check if customer already exists in the database
-    customer = customers_collection.find_one({"name": customer_name, "number": customer_number})
-
-    if not customer:
-        # If customer doesn't exist, create a new customer entry
-        customer_data = {
-            "name": customer_name,
-            "number": customer_number,
-            "address": customer_address,
-            "date_added": datetime.now()
-        }
-        customers_collection.insert_one(customer_data)
+    # Find the customer, creating them on their first order
+    customer = await customer_resolver.resolve(customer_name, customer_number, customer_address)
 
     # Ensure the number of product details matches
     if len(product_names) != len(quantities) or len(product_names) != len(amounts) or len(product_names) != len(remarks):
@@ -263,6 +378,7 @@ async def record_sale(
 
     # Prepare the sale record for insertion
     sale_record = {
+        "customer_id": customer["_id"],
         "customer_name": customer_name,
         "customer_number": customer_number,
         "customer_address": customer_address,
@@ -270,7 +386,7 @@ async def record_sale(
         "date": date,
         "total_amount": total_amount,
         "products": [],
-        "date_added": datetime.now()
+        "date_added": datetime.now(timezone.utc)
     }
 
     # Loop through products to process them
@@ -283,36 +399,36 @@ async def record_sale(
             "remarks": remark
         })
 
-        # Update stock quantity of the product in the inventory
-        product_in_db = products_collection.find_one({"name": product_name})
-        if product_in_db:
-            new_stock_quantity = product_in_db['stock_quantity'] - quantity
-            if new_stock_quantity < 0:
-                raise HTTPException(status_code=400, detail=f"Not enough stock for {product_name}")
-
-            # Update the product quantity in the products collection
-            products_collection.update_one(
-                {"name": product_name},
-                {"$set": {"stock_quantity": new_stock_quantity}}
-            )
-
-            # Log the sale in the stock_log collection
-            stock_log_entry = {
-                "date": datetime.now(timezone.utc).isoformat(),
-                "action": "sale",
-                "product_id": product_in_db["product_id"],
-                "product_name": product_name,
-                "quantity_changed": -quantity,
-                "remaining_stock": new_stock_quantity,
-                "performed_by": manager_name,
-                "customer_name": customer_name
-            }
-            stock_log.insert_one(stock_log_entry)
-        else:
-            raise HTTPException(status_code=404, detail=f"Product {product_name} not found in inventory.")
+    # Take the stock for every line at once; nothing changes if any line fails
+    try:
+        stock_results = await stock.apply([StockChange(name, -quantity) for name, quantity in zip(product_names, quantities)])
+    except ProductNotFound as e:
+        raise HTTPException(status_code=404, detail=f"Product {e.name} not found in inventory.")
+    except InsufficientStock as e:
+        raise HTTPException(status_code=400, detail=f"Not enough stock for {e.name}")
+
+    stock_log_entries = []
+    for product_name, quantity, result in zip(product_names, quantities, stock_results):
+        # Log the sale in the stock_log collection
+        stock_log_entry = {
+            "date": datetime.now(timezone.utc),
+            "action": "sale",
+            "product_id": result.product["product_id"],
+            "product_name": product_name,
+            "quantity_changed": -quantity,
+            "remaining_stock": result.remaining_stock,
+            "performed_by": manager_name,
+            "customer_name": customer_name
+        }
+        stock_log_entries.append(stock_log_entry)
 
     # Insert the sale record into the sales collection
-    sale_result = sales_collection.insert_one(sale_record)
+    sale_result = await db.sales.insert_one(sale_record)
+
+    # Write the stock_log entries together and keep the reporting rollups current
+    await stock_log_writer.write(stock_log_entries)
+    await track_sales(db, [sale_record])
+    await versions.bump("products", "sales")
 
     # Create email message body
     email_message = f"Sale Information:\n\nCustomer: {customer_name}\nManager: {manager_name}\nDate: {date}\nTotal Amount: {total_amount}\n\n"
@@ -325,7 +441,8 @@ async def record_sale(
 
     return {"message": "Sale recorded successfully", "sale_id": str(sale_result.inserted_id)}
 
-@app.post("/record-installation/")
+@router.post("/record-installation/")
+@idempotency.guard("record-installation")
 async def record_installation(
     staff_names: List[str] = Form(...),
     manager_name: str = Form(...),
@@ -336,19 +453,10 @@ async def record_installation(
     products: List[str] = Form(...),
     quantities: List[int] = Form(...),
     remarks: List[str] = Form(...),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
 ):
-    # Check if customer exists in the database
-    customer = customers_collection.find_one({"name": customer_name, "number": customer_number})
-
-    if not customer:
-        # If customer doesn't exist, create a new customer entry
-        customer_data = {
-            "name": customer_name,
-            "number": customer_number,
-            "address": customer_address,
-            "date_added": datetime.now()
-        }
-        customers_collection.insert_one(customer_data)
+    # Find the customer, creating them on their first order
+    customer = await customer_resolver.resolve(customer_name, customer_number, customer_address)
 
     # Ensure the number of product details matches
     if len(products) != len(quantities) or len(products) != len(remarks):
@@ -358,12 +466,13 @@ async def record_installation(
     installation_record = {
         "staff_names": staff_names,
         "manager_name": manager_name,
+        "customer_id": customer["_id"],
         "customer_name": customer_name,
         "customer_number": customer_number,
         "customer_address": customer_address,
         "installation_date": installation_date,
         "products": [],
-        "date_added": datetime.now()
+        "date_added": datetime.now(timezone.utc)
     }
 
     # Loop through products to process them
@@ -375,36 +484,33 @@ async def record_installation(
             "remarks": remark
         })
 
-        # Update stock quantity of the product in the inventory
-        product_in_db = products_collection.find_one({"name": product})
-        if product_in_db:
-            new_stock_quantity = product_in_db['stock_quantity'] - quantity
-            if new_stock_quantity < 0:
-                raise HTTPException(status_code=400, detail=f"Not enough stock for {product}")
-
-            # Update the product quantity in the products collection
-            products_collection.update_one(
-                {"name": product},
-                {"$set": {"stock_quantity": new_stock_quantity}}
-            )
-
-            # Log the installation action in the stock_log collection
-            stock_log_entry = {
-                "date": datetime.now(timezone.utc).isoformat(),
-                "action": "installation",
-                "product_id": product_in_db["product_id"],
-                "product_name": product,
-                "quantity_changed": -quantity,
-                "remaining_stock": new_stock_quantity,
-                "performed_by": manager_name,
-                "customer_name": customer_name
-            }
-            stock_log.insert_one(stock_log_entry)
-        else:
-            raise HTTPException(status_code=404, detail=f"Product {product} not found in inventory.")
+    # Take the stock for every line at once; nothing changes if any line fails
+    try:
+        stock_results = await stock.apply([StockChange(name, -quantity) for name, quantity in zip(products, quantities)])
+    except ProductNotFound as e:
+        raise HTTPException(status_code=404, detail=f"Product {e.name} not found in inventory.")
+    except InsufficientStock as e:
+        raise HTTPException(status_code=400, detail=f"Not enough stock for {e.name}")
+
+    stock_log_entries = []
+    for product, quantity, result in zip(products, quantities, stock_results):
+        # Log the installation action in the stock_log collection
+        stock_log_entry = {
+            "date": datetime.now(timezone.utc),
+            "action": "installation",
+            "product_id": result.product["product_id"],
+            "product_name": product,
+            "quantity_changed": -quantity,
+            "remaining_stock": result.remaining_stock,
+            "performed_by": manager_name,
+            "customer_name": customer_name
+        }
+        stock_log_entries.append(stock_log_entry)
 
     # Insert the installation record into the installations collection
-    installation_result = installations_collection.insert_one(installation_record)
+    installation_result = await db.installations.insert_one(installation_record)
+    await stock_log_writer.write(stock_log_entries)
+    await versions.bump("products", "installations")
 
     # Create email message body
     email_message = f"Installation Information:\n\nCustomer: {customer_name}\nManager: {manager_name}\nDate: {installation_date}\n\n"
@@ -417,7 +523,8 @@ async def record_installation(
 
     return {"message": "Installation recorded successfully", "installation_id": str(installation_result.inserted_id)}
 
-@app.post("/return-item/")
+@router.post("/return-item/")
+@idempotency.guard("return-item")
 async def return_item(
     staff_name: str = Form(...),
     manager_name: str = Form(...),
@@ -428,15 +535,13 @@ async def return_item(
     products: List[str] = Form(...),
     quantities: List[int] = Form(...),
     remarks: str = Form(...),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
 ):
     if len(products) != len(quantities):
         raise HTTPException(status_code=400, detail="Products and quantities list lengths must match.")
 
     # Check if customer exists
-    customer = customers_collection.find_one({
-        "name": customer_name,
-        "number": customer_number
-    })
+    customer = await customer_resolver.find(customer_name, customer_number)
 
     if not customer:
         raise HTTPException(status_code=404, detail="Customer not found.")
@@ -452,37 +557,36 @@ async def return_item(
         f"Remarks: {remarks}\n\n"
     )
 
-    # Loop through products and update stock
-    for product, quantity in zip(products, quantities):
-        product_in_db = products_collection.find_one({"name": product})
-
-        if not product_in_db:
-            raise HTTPException(status_code=404, detail=f"Product '{product}' not found in inventory.")
+    # Add the returned quantities back to stock in one step
+    try:
+        stock_results = await stock.apply([StockChange(name, quantity) for name, quantity in zip(products, quantities)])
+    except ProductNotFound as e:
+        raise HTTPException(status_code=404, detail=f"Product '{e.name}' not found in inventory.")
 
-        # Update the stock by adding the returned quantity
-        new_stock_quantity = product_in_db['stock_quantity'] + quantity
-        products_collection.update_one(
-            {"name": product},
-            {"$set": {"stock_quantity": new_stock_quantity}}
-        )
+    # Loop through products and record the returns
+    stock_log_entries = []
+    return_records = []
+    for product, quantity, result in zip(products, quantities, stock_results):
+        new_stock_quantity = result.remaining_stock
 
         # Log the return action in the stock_log collection
         stock_log_entry = {
-            "date": datetime.now(timezone.utc).isoformat(),
+            "date": datetime.now(timezone.utc),
             "action": "return",
-            "product_id": product_in_db["product_id"],
+            "product_id": result.product["product_id"],
             "product_name": product,
             "quantity_changed": quantity,
             "remaining_stock": new_stock_quantity,
             "performed_by": manager_name,
             "customer_name": customer_name
         }
-        stock_log.insert_one(stock_log_entry)
+        stock_log_entries.append(stock_log_entry)
 
         # Record return details for each product
         return_record = {
             "staff_name": staff_name,
             "manager_name": manager_name,
+            "customer_id": customer["_id"],
             "customer_name": customer_name,
             "customer_number": customer_number,
             "customer_address": customer_address,
@@ -490,15 +594,19 @@ async def return_item(
             "product_name": product,
             "quantity": quantity,
             "remarks": remarks,
-            "date_added": datetime.now()
+            "date_added": datetime.now(timezone.utc)
         }
-
-        returns_collection.insert_one(return_record)
+        return_records.append(return_record)
 
         email_message += (f"Product: {product}\n"
                           f"Quantity Returned: {quantity}\n"
                           f"Updated Stock: {new_stock_quantity}\n\n")
 
+    # One insert for all the returned products and one for their log entries
+    await db.returns.insert_many(return_records)
+    await stock_log_writer.write(stock_log_entries)
+    await versions.bump("products", "returns")
+
     send_email("Product Return Notification", email_message)
 
     return {
@@ -507,135 +615,223 @@ async def return_item(
         "quantities": quantities
     }
 
-@app.get("/view-logs/")
-async def view_logs(action: Optional[str] = Query(None, regex="^(add|update|sale|installation|return)$")):
-    # Build query based on action
+# Batches of orders as JSON arrays. Each order is recorded or rejected as a whole and
+# gets its own result; the batch costs the same few round-trips however many orders it has.
+async def record_batch(kind, orders: list, subject: str):
+    if len(orders) > MAX_BATCH_ORDERS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_ORDERS} orders per batch.")
+    try:
+        results = await record_orders(db, stock, stock_log_writer, customer_resolver, kind, orders)
+    except UndoFailed as e:
+        raise HTTPException(status_code=500, detail=f"Batch failed; stock of {', '.join(e.totals)} needs checking.")
+    recorded = [result for result in results if result["status"] == "ok"]
+    if recorded:
+        await versions.bump("products", kind.collection)
+        email_message = f"{len(recorded)} {kind.collection} recorded in one batch:\n\n"
+        for result in recorded:
+            name, number, _ = kind.customer(orders[result["index"]])
+            email_message += f"Customer: {name} ({number})\n"
+            for line in result["products"]:
+                email_message += f"  {line['product_name']}: {line['quantity']} (stock left: {line['remaining_stock']})\n"
+        send_email(subject, email_message)
+    return {"recorded": len(recorded), "failed": len(results) - len(recorded), "results": results}
+
+@router.post("/record-sale/batch/")
+@idempotency.guard("record-sale-batch")
+async def record_sales_batch(
+    orders: List[SaleRecord],
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+):
+    return await record_batch(SALE_ORDERS, orders, "New Sales Notification")
+
+@router.post("/record-installation/batch/")
+@idempotency.guard("record-installation-batch")
+async def record_installations_batch(
+    orders: List[InstallationRecord],
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+):
+    return await record_batch(INSTALLATION_ORDERS, orders, "New Installations Notification")
+
+@router.post("/return-item/batch/")
+@idempotency.guard("return-item-batch")
+async def return_items_batch(
+    orders: List[ReturnRequest],
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+):
+    return await record_batch(RETURN_ORDERS, orders, "Product Returns Notification")
+
+@router.get("/view-logs/")
+async def view_logs(
+    action: Optional[str] = Query(None, pattern="^(add|update|sale|installation|return|reconcile)$"),
+    product_id: Optional[str] = Query(None),
+    start_date: Optional[datetime] = Query(None),
+    end_date: Optional[datetime] = Query(None),
+    after: Optional[str] = Query(None),  # _id of the last log on the previous page
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    fields: Optional[str] = Query(None),  # Comma-separated fields to return
+    format: str = Query("json", pattern="^(json|ndjson)$"),
+):
+    # Build query based on the filters
     query = {}
     if action:
         query["action"] = action
-    
-    # Query for logs based on the action
-    logs_cursor = stock_log.find(query)
-    logs = list(logs_cursor)
-    
-    if not logs:
+    if product_id:
+        query["product_id"] = product_id
+    if start_date or end_date:
+        query["date"] = date_range(start_date, end_date)
+    after_cursor(query, after)
+    # Old date ranges are (partly) served from the archive
+    archived = archive.covers("stock_log", start_date)
+
+    # Exports stream the whole result set in batches instead of paging
+    if format == "ndjson":
+        older = archive.batches("stock_log", query, projection(fields), limit) if archived else None
+        return stream_ndjson(db.stock_log, query, projection(fields), limit, older, prepare=with_utc_date)
+
+    page_size = limit or DEFAULT_PAGE_SIZE
+    older = await archive.find("stock_log", query, projection(fields), page_size + 1) if archived else []
+    logs, next_after = await fetch_page(db.stock_log, query, page_size, projection(fields), older)
+    logs = [with_utc_date(log) for log in logs]
+
+    if not logs and not after:
         raise HTTPException(status_code=404, detail=f"No logs found for action '{action}'." if action else "No logs found.")
 
-    # Convert ObjectId to string for all logs
-    logs = [convert_objectid_to_str(log) for log in logs]
-
-    return {"logs": logs}
-
-@app.get("/view-records/")
-async def view_records(record_type: str):
-    if record_type == "sale":
-        # Fetch all sales records
-        sales_cursor = sales_collection.find()
-        sales = list(sales_cursor)
-
-        if not sales:
-            raise HTTPException(status_code=404, detail="No sales records found.")
-
-        # Convert ObjectId to string for all sales records
-        for sale in sales:
-            sale["_id"] = str(sale["_id"])
-
-        return {"sales": sales}
-    
-    elif record_type == "installation":
-        # Fetch all installation records
-        installations_cursor = installations_collection.find()
-        installations = list(installations_cursor)
-
-        if not installations:
-            raise HTTPException(status_code=404, detail="No installation records found.")
-
-        # Convert ObjectId to string for all installations records
-        for installation in installations:
-            installation["_id"] = str(installation["_id"])
-
-        return {"installations": installations}
-    
-    elif record_type == "return":
-    # Fetch all return records
-        returns_cursor = returns_collection.find()
-        returns = list(returns_cursor)
+    return FastJSONResponse({"logs": logs, "next_after": next_after})
+
+# record_type -> (collection attribute / response key, field holding the product name, not-found message)
+RECORD_TYPES = {
+    "sale": ("sales", "products.product_name", "No sales records found."),
+    "installation": ("installations", "products.product_name", "No installation records found."),
+    "return": ("returns", "product_name", "No return records found."),
+}
+
+# Validators only for known record types; the endpoint rejects the rest
+def record_collections(params):
+    record_type = RECORD_TYPES.get(params["record_type"])
+    return [record_type[0]] if record_type else None
+
+@router.get("/view-records/")
+@versions.conditional(record_collections)
+async def view_records(
+    request: Request,
+    record_type: str,
+    product_name: Optional[str] = Query(None),
+    start_date: Optional[datetime] = Query(None),
+    end_date: Optional[datetime] = Query(None),
+    after: Optional[str] = Query(None),  # _id of the last record on the previous page
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    fields: Optional[str] = Query(None),  # Comma-separated fields to return
+    format: str = Query("json", pattern="^(json|ndjson)$"),
+):
+    if record_type not in RECORD_TYPES:
+        raise HTTPException(status_code=400, detail="Invalid record type. Use 'sale', 'installation' or 'return'.")
+    key, product_field, not_found = RECORD_TYPES[record_type]
+    collection = getattr(db, key)
 
-        if not returns:
-            raise HTTPException(status_code=404, detail="No return records found.")
+    query = {}
+    if product_name:
+        query[product_field] = product_name
+    if start_date or end_date:
+        query["date_added"] = date_range(start_date, end_date)
+    after_cursor(query, after)
+    archived = archive.covers(key, start_date)
+
+    if format == "ndjson":
+        older = archive.batches(key, query, projection(fields), limit) if archived else None
+        return stream_ndjson(collection, query, projection(fields), limit, older)
+
+    page_size = limit or DEFAULT_PAGE_SIZE
+    older = await archive.find(key, query, projection(fields), page_size + 1) if archived else []
+    records, next_after = await fetch_page(collection, query, page_size, projection(fields), older)
+
+    if not records and not after:
+        raise HTTPException(status_code=404, detail=not_found)
+
+    return FastJSONResponse({key: records, "next_after": next_after})
+
+# Shape a sale, installation or return document for the customer search results
+def history_row(record):
+    row = {
+        "customer_id": str(record.get("_id")),
+        "customer_name": record.get("customer_name"),
+        "customer_phone": record.get("customer_number"),
+    }
+    if record["action"] == "Sale":
+        row["product_name"] = [product.get("product_name") for product in record.get("products", [])]
+        row["quantity"] = [product.get("quantity") for product in record.get("products", [])]
+        row["total_amount"] = record.get("total_amount")
+        row["date"] = record.get("date")
+    elif record["action"] == "Installation":
+        row["product_name"] = record.get("products")
+        row["date"] = record.get("installation_date")
+    else:
+        row["product_name"] = record.get("product_name")
+        row["quantity"] = record.get("quantity")
+        row["date"] = record.get("return_date")
+    row["action"] = record["action"]
+    return row
+
+@router.get("/customers/search")
+async def find_customers(
+    name: Optional[str] = Query(None),  # Matches the start of the name, ignoring case
+    number: Optional[str] = Query(None),
+    limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE),
+):
+    if not name and not number:
+        raise HTTPException(status_code=400, detail="Please provide either name or number")
 
-        # Convert ObjectId to string for all return records
-        for return_record in returns:
-            return_record["_id"] = str(return_record["_id"])
+    customers = await search_customers(db, name, number, limit)
+    return [
+        {"customer_id": str(c["_id"]), "name": c["name"], "number": c["number"], "address": c.get("address")}
+        for c in customers
+    ]
+
+@router.get("/customers/{customer_id}/history")
+async def get_customer_history(
+    customer_id: str,
+    after: Optional[str] = Query(None),  # _id of the last record on the previous page
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+):
+    customer = await db.customers.find_one({"_id": parse_object_id(customer_id, "Invalid customer id.")})
+    if not customer:
+        raise HTTPException(status_code=404, detail="Customer not found.")
 
-        return {"returns": returns}
-    
-    else:
-        raise HTTPException(status_code=400, detail="Invalid record type. Use 'sale' or 'installation'.")
+    after_id = parse_object_id(after, "Invalid 'after' cursor.") if after else None
+    records, next_after = await customer_history(db, [customer], after_id, limit)
+    return FastJSONResponse({"history": [history_row(record) for record in records], "next_after": next_after})
 
-@app.get("/search-customer")
-def search_customer(
+# The body stays a plain list of records; when there are more, the Next-After header
+# holds the `after` cursor for the next page
+@router.get("/search-customer")
+async def search_customer(
     name: Optional[str] = Query(None), 
-    number: Optional[str] = Query(None)
+    number: Optional[str] = Query(None),
+    after: Optional[str] = Query(None),  # Next-After header of the previous page
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
 ):
     if not name and not number:
         raise HTTPException(status_code=400, detail="Please provide either name or number")
 
-    query = {}
-    if name:
-        query["customer_name"] = {'$regex': name, '$options': 'i'}
-    if number:
-        query["customer_number"] = number
-
-    sales = list(sales_collection.find(query))
-    installations = list(installations_collection.find(query))
-    returns = list(returns_collection.find(query))
+    # Resolve matching customers through the customers index, then fetch their history
+    after_id = parse_object_id(after, "Invalid 'after' cursor.") if after else None
+    customers = await search_customers(db, name, number, limit)
+    records, next_after = [], None
+    if customers:
+        records, next_after = await customer_history(db, customers, after_id, limit)
 
     # Prepare response
-    response = []
-
-    for sale in sales:
-        response.append({
-            "customer_id": str(sale.get("_id")),
-            "customer_name": sale.get("customer_name"),
-            "customer_phone": sale.get("customer_number"),
-            "product_name": [product.get("product_name") for product in sale.get("products", [])],
-            "quantity": [product.get("quantity") for product in sale.get("products", [])],
-            "total_amount": sale.get("total_amount"),
-            "date": sale.get("date"),
-            "action": "Sale"
-        })
+    response = [history_row(record) for record in records]
 
-    for installation in installations:
-        response.append({
-            "customer_id": str(installation.get("_id")),
-            "customer_name": installation.get("customer_name"),
-            "customer_phone": installation.get("customer_number"),
-            "product_name": installation.get("products"),
-            "date": installation.get("installation_date"),
-            "action": "Installation"
-        })
-    
-    for return_data in returns:
-        response.append({
-            "customer_id": str(return_data.get("_id")),
-            "customer_name": return_data.get("customer_name"),
-            "customer_phone": return_data.get("customer_number"),
-            "product_name": return_data.get("product_name"),
-            "quantity": return_data.get("quantity"),
-            "date": return_data.get("return_date"),
-            "action": "Return"
-            })
-
-    if not response:
+    if not response and not after:
         raise HTTPException(status_code=404, detail="No records found")
 
-    return response
+    return FastJSONResponse(response, headers={"Next-After": next_after} if next_after else None)
 
-@app.get("/get-products/")
-async def get_products():
+@router.get("/get-products/")
+@versions.conditional("products")
+async def get_products(request: Request):
     try:
-        products = products_collection.find({}, {"name": 1, "_id": 1})
+        products = await catalog.all()
         product_list = [{"id": str(product["_id"]), "name": product["name"]} for product in products]
         
         if not product_list:
@@ -644,3 +840,259 @@ async def get_products():
         return product_list
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching products: {str(e)}")
+
+# kind -> (row model, importer applying one validated batch, collections it changes)
+IMPORTERS = {
+    "products": (Product, import_products, ["products"]),
+    "stock-adjustments": (ProductUpdate, import_stock_adjustments, ["products"]),
+    "sales": (SaleImportRow, import_sales, ["products", "sales"]),
+}
+
+@router.post("/bulk-import/{kind}")
+async def bulk_import(
+    kind: str,
+    file: UploadFile = File(...),
+    format: Optional[str] = Query(None, pattern="^(csv|ndjson)$"),  # Taken from the file name when omitted
+):
+    if kind not in IMPORTERS:
+        raise HTTPException(status_code=400, detail=f"Invalid import kind. Use one of: {', '.join(IMPORTERS)}.")
+    model, importer, changes = IMPORTERS[kind]
+
+    # Rows are parsed as the upload is read and applied a batch at a time
+    report = ImportReport(kind)
+    async for batch in read_batches(file, detect_format(file, format), model, report):
+        await importer(db, stock, stock_log_writer, customer_resolver, batch, report)
+    if report.applied:
+        await versions.bump(*changes)
+
+    # One summary notification for the whole import
+    notifier.notify(
+        f"Bulk Import Completed: {kind}",
+        f"Rows: {report.rows}\nApplied: {report.applied}\nErrors: {report.error_count}\n",
+    )
+
+    return report.summary()
+
+@router.get("/analytics/sales-per-product")
+async def analytics_sales_per_product(
+    start: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}-\d{2}$"),
+    end: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}-\d{2}$"),
+    product_name: Optional[str] = Query(None),
+):
+    return {"sales": await sales_per_product(db, start, end, product_name)}
+
+@router.get("/analytics/revenue-per-manager")
+async def analytics_revenue_per_manager(
+    start: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}-\d{2}$"),
+    end: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}-\d{2}$"),
+):
+    return {"managers": await revenue_per_manager(db, start, end)}
+
+@router.get("/analytics/stock-turnover")
+async def analytics_stock_turnover(
+    start: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}-\d{2}$"),
+    end: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}-\d{2}$"),
+):
+    return {"products": await stock_turnover(db, start, end)}
+
+@router.get("/analytics/low-stock")
+async def analytics_low_stock():
+    # Products at or below their threshold, straight from the catalog cache
+    return {"products": low_stock(await catalog.all())}
+
+@router.post("/analytics/rebuild")
+async def analytics_rebuild():
+    # Recompute the rollups from the raw history, e.g. after restoring a backup; archived
+    # months keep their rollups
+    rebuilt_from = await rebuild_rollups(db, archive)
+    return {"message": "Analytics rollups rebuilt.", "rebuilt_from": rebuilt_from}
+
+@router.get("/index-check/")
+async def index_check():
+    # Explain each endpoint query and list the ones not backed by an index
+    collscans = await check_query_plans(db)
+    return {"collscans": collscans}
+
+@router.get("/catalog-cache/stats")
+async def catalog_cache_stats():
+    return catalog.stats()
+
+@router.get("/customer-cache/stats")
+async def customer_cache_stats():
+    return customer_resolver.stats()
+
+# Split a hot product's stock over `count` counters so concurrent sales stop queueing on one document
+@router.post("/stock-shards/{product_id}")
+async def enable_stock_shards(product_id: str, count: int = Query(..., ge=2, le=MAX_STOCK_SHARDS)):
+    product = await stock_shards.enable(product_id, count)
+    if product is None:
+        if await db.products.find_one({"product_id": product_id}, {"_id": 1}) is None:
+            raise HTTPException(status_code=404, detail="Product not found")
+        raise HTTPException(status_code=409, detail="Product stock is already sharded.")
+    catalog.put(product)
+    await versions.bump("products")
+    return {"product_id": product_id, "stock_shards": count, "stock_quantity": product["stock_quantity"]}
+
+# Fold a product's shards back into its stock_quantity
+@router.delete("/stock-shards/{product_id}")
+async def disable_stock_shards(product_id: str):
+    product = await stock_shards.disable(product_id)
+    if product is None:
+        raise HTTPException(status_code=404, detail="Product not found or its stock is not sharded.")
+    catalog.put(product)
+    await versions.bump("products")
+    return {"product_id": product_id, "stock_quantity": product["stock_quantity"]}
+
+# Compare every product's stock with what the stock_log adds up to; `repair=true` moves the
+# mismatched products that still disagree after the settle window to the logged stock and
+# logs a `reconcile` entry for each
+@router.post("/reconcile-stock")
+async def reconcile_stock(
+    repair: bool = Query(False),
+    partitions: Optional[int] = Query(None, ge=1, le=MAX_RECONCILE_PARTITIONS),
+    performed_by: str = Query("reconciliation"),
+):
+    report = await reconciler.run(repair=repair, partitions=partitions, performed_by=performed_by)
+    if report is None:
+        raise HTTPException(status_code=409, detail="A stock reconciliation is already running.")
+    if report["repaired"]:
+        await versions.bump("products")
+    return report
+
+# Without `since`: the full catalog and a token. With `since`: the products, sales and
+# stock_log entries changed after that token, and the next token. `wait` long-polls until
+# there are changes; `stream=true` keeps sending them as Server-Sent Events.
+@router.get("/sync")
+async def sync(
+    request: Request,
+    since: Optional[str] = Query(None),
+    wait: float = Query(0, ge=0, le=MAX_SYNC_WAIT),
+    stream: bool = Query(False),
+):
+    if stream:
+        since = since or request.headers.get("last-event-id")
+        token = parse_object_id(since, "Invalid sync token.") if since else None
+        return StreamingResponse(change_feed.stream(token), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+    if since is None:
+        return FastJSONResponse(await change_feed.snapshot())
+    token = parse_object_id(since, "Invalid sync token.")
+    if wait:
+        return FastJSONResponse(await change_feed.wait(token, wait))
+    return FastJSONResponse(await change_feed.changes(token))
+
+# Stock as it was at `date` (UTC when no offset is given), for one product or the whole catalog
+@router.get("/stock-at")
+async def stock_at_date(
+    date: datetime = Query(...),
+    product_id: Optional[str] = Query(None),
+):
+    when = utc(date)
+    if product_id:
+        quantity = await product_stock_at(db, product_id, when, archive)
+        if quantity is None:
+            raise HTTPException(status_code=404, detail=f"No stock history for product {product_id} at that date.")
+        return {"date": when, "product_id": product_id, "stock_quantity": quantity}
+
+    stock_levels = await stock_at(db, when, archive)
+    if not stock_levels:
+        raise HTTPException(status_code=404, detail="No stock history at that date.")
+    names = {product["product_id"]: product["name"] for product in await catalog.all()}
+    products = [
+        {"product_id": product_id, "name": names.get(product_id), "stock_quantity": quantity}
+        for product_id, quantity in sorted(stock_levels.items())
+    ]
+    return {"date": when, "products": products, "total_units": sum(stock_levels.values())}
+
+# Prometheus scrape endpoint
+@router.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+# Liveness: the process is up and serving; no dependencies are checked
+@router.get("/healthz")
+async def healthz():
+    return {"status": "ok"}
+
+# Readiness: startup (indexes, catalog warm-up, background jobs) has finished and MongoDB answers
+@router.get("/readyz")
+async def readyz(request: Request):
+    if not getattr(request.app.state, "ready", False):
+        raise HTTPException(status_code=503, detail="Starting up.")
+    try:
+        await db.db.command("ping")
+    except Exception:
+        raise HTTPException(status_code=503, detail="Database unavailable.")
+    return {"status": "ready", "catalog": catalog.stats()["size"]}
+
+# Build the application for `settings`. Nothing connects here: the database pool, SMTP
+# sessions and background jobs are opened by the lifespan in each worker process.
+# These are the module-level objects above, so it is one app per process: create_app
+# points them at `settings`, which only works before an app has started, and only the
+# deployment settings come from `settings` - feature tuning is read from the
+# environment at import.
+def create_app(settings: Settings) -> FastAPI:
+    db.configure(
+        settings.mongo_uri,
+        settings.mongo_db_name,
+        max_pool_size=settings.mongo_max_pool_size,
+        min_pool_size=settings.mongo_min_pool_size,
+        server_selection_timeout_ms=settings.mongo_server_selection_timeout_ms,
+        connect_timeout_ms=settings.mongo_connect_timeout_ms,
+        socket_timeout_ms=settings.mongo_socket_timeout_ms,
+        wait_queue_timeout_ms=settings.mongo_wait_queue_timeout_ms,
+        event_listeners=[CommandMetrics()],  # Per-request MongoDB round-trip counts and timings
+    )
+    notifier.configure(
+        settings.smtp_server,
+        settings.smtp_port,
+        settings.sender_email,
+        settings.sender_password,
+        settings.recipient_email,
+        use_tls=settings.smtp_use_tls,
+        require_login=settings.smtp_require_login,
+        queue_size=settings.email_queue_size,
+        workers=settings.email_workers,
+        digest_window=settings.email_digest_window,
+    )
+
+    app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
+    app.state.settings = settings
+    app.state.ready = False
+
+    # Admission control: each write endpoint below runs at most admission_write_concurrency
+    # requests at once with a bounded queue, reads share their own larger lane, and requests
+    # that would queue longer than admission_max_wait seconds get 429/503 with Retry-After.
+    # Added first so it sits inside CORS and the metrics middleware.
+    app.add_middleware(
+        AdmissionMiddleware,
+        write_routes=[
+            "/add-product/", "/update-product-quantity/", "/record-sale/", "/record-installation/", "/return-item/",
+            "/record-sale/batch/", "/record-installation/batch/", "/return-item/batch/",
+        ],
+        write_limit=settings.admission_write_concurrency,
+        read_limit=settings.admission_read_concurrency,
+        queue_size=settings.admission_queue_size,
+        max_wait=settings.admission_max_wait,
+        # Long-polls would hold read slots for their whole wait; probes must answer under load
+        exempt=["/sync", "/metrics", "/healthz", "/readyz"],
+    )
+
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=settings.cors_origins,
+        allow_credentials=True,
+        allow_methods=["*"],  # Allows all methods (GET, POST, etc.)
+        allow_headers=["*"],  # Allows all headers
+        expose_headers=["Next-After"],  # /search-customer's cursor
+    )
+
+    # Large list responses are compressed (brotli when installed and accepted, gzip otherwise)
+    app.add_middleware(CompressionMiddleware, minimum_size=settings.compression_minimum_size)
+
+    # Per-route timing histograms served at /metrics; requests slower than this are logged with a breakdown
+    app.add_middleware(RequestMetricsMiddleware, slow_threshold=settings.slow_request_seconds)
+
+    app.include_router(router)
+    return app
+
+app = create_app(settings)
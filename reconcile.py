@@ -0,0 +1,334 @@
+import asyncio
+import logging
+import os
+import socket
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from bulk_import import log_entry
+from shards import STOCK_SHARDS
+from sync import last_id_before
+
+logger = logging.getLogger(__name__)
+
+STOCK_LEDGER = "stock_ledger"  # {_id: product_id, quantity, position, entries, last_remaining}
+RECONCILIATION = "stock_reconciliation"  # {_id: "stock_log", position, pending, owner, lease_until}
+MAX_REPORTED_MISMATCHES = 1000
+ARCHIVED_FIELDS = {"product_id": 1, "action": 1, "quantity_changed": 1, "remaining_stock": 1}
+
+# Stock each log entry stands for; reconcile entries record a repair the ledger already
+# expects, so they do not count again
+DELTA = {"$cond": [{"$eq": ["$action", "reconcile"]}, 0, "$quantity_changed"]}
+
+
+def product_range(lower: Optional[str], upper: Optional[str]) -> dict:
+    bounds = {}
+    if lower is not None:
+        bounds["$gte"] = lower
+    if upper is not None:
+        bounds["$lt"] = upper
+    return bounds
+
+
+# Checks products.stock_quantity against the stock_log. The log is folded incrementally
+# into a per-product ledger (sum of quantity_changed) up to a checkpoint, so each run
+# only aggregates the entries written since the last one. Entries younger than `settle`
+# seconds are left for the next run, as the change feed does, so a late insert cannot
+# land behind the checkpoint; they are added on top when comparing. Products are split
+# into `partitions` product_id ranges that are folded and compared concurrently.
+#
+# A run first records its window as `pending`. Each ledger update is an upsert guarded
+# on {position < window end}, so a window re-run after a failure skips the products it
+# already folded (duplicate key on the upsert) and nothing is counted twice.
+#
+# The archiver moves old months of the stock_log out of MongoDB, so a window reaching
+# back into them is folded from the archive parts plus what is left in MongoDB; entries
+# an interrupted archive run has written but not deleted yet are only counted from the
+# archive. A worker that cannot read the archive (no pyarrow) leaves the ledger where it
+# is, compares against the entries still in MongoDB and does not repair.
+#
+# Handlers change stock before its log entry is written, so a sale in flight looks like
+# a mismatch for a moment. A repair therefore re-reads the mismatched products `settle`
+# seconds later, fixes only those that disagree by the same amount both times, and makes
+# each $inc conditional on the stock it last read.
+class StockReconciler:
+    def __init__(self, db, stock, stock_log_writer, archive=None, settle: float = 5.0, run_every: float = 3600,
+                 partitions: int = 4, lease: float = 600):
+        self.db = db
+        self.stock = stock
+        self.stock_log_writer = stock_log_writer
+        self.archive = archive
+        self.settle = settle
+        self.run_every = run_every
+        self.partitions = partitions
+        self.lease = lease
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.task: Optional[asyncio.Task] = None
+
+    async def _take_lease(self) -> Optional[dict]:
+        now = datetime.now(timezone.utc)
+        try:
+            return await self.db.db[RECONCILIATION].find_one_and_update(
+                {"_id": "stock_log", "$or": [{"lease_until": {"$exists": False}}, {"lease_until": {"$lt": now}}]},
+                {"$set": {"owner": self.owner, "lease_until": now + timedelta(seconds=self.lease)}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            return None  # Another worker is reconciling
+
+    async def _release_lease(self):
+        await self.db.db[RECONCILIATION].update_one({"_id": "stock_log", "owner": self.owner}, {"$unset": {"lease_until": ""}})
+
+    async def _boundaries(self, partitions: int) -> List[Tuple[Optional[str], Optional[str]]]:
+        ids = sorted(await self.db.products.distinct("product_id"))
+        step = max(len(ids) // partitions, 1)
+        splits = ids[step::step][:partitions - 1]
+        edges = [None, *splits, None]
+        return list(zip(edges[:-1], edges[1:]))
+
+    @property
+    def archive_readable(self) -> bool:
+        return self.archive is None or not self.archive.root or self.archive.enabled
+
+    # Archived stock_log parts holding entries in the window, as (month start, month end,
+    # last archived _id) per month
+    def _archived_months(self, since: Optional[ObjectId]) -> List[Tuple[datetime, datetime, str]]:
+        if self.archive is None:
+            return []
+        months = {}
+        for part in self.archive.parts("stock_log"):
+            if since is not None and part["max_id"] <= str(since):
+                continue
+            start, end, last = months.get(part["month"], (part["start"], part["end"], part["max_id"]))
+            months[part["month"]] = (start, end, max(last, part["max_id"]))
+        return sorted(months.values())
+
+    async def _fold_archive(self, match: dict) -> Dict[str, dict]:
+        rows: Dict[str, dict] = {}
+        async for batch in self.archive.batches("stock_log", match, ARCHIVED_FIELDS):
+            for entry in batch:
+                row = rows.setdefault(entry["product_id"], {"delta": 0, "entries": 0, "last_id": None, "last_remaining": None})
+                if entry.get("action") != "reconcile":
+                    row["delta"] += entry.get("quantity_changed", 0)
+                row["entries"] += 1
+                if row["last_id"] is None or entry["_id"] > row["last_id"]:
+                    row["last_id"], row["last_remaining"] = entry["_id"], entry.get("remaining_stock")
+        return rows
+
+    async def _fold_mongo(self, match: dict) -> Dict[str, dict]:
+        rows = await self.db.stock_log.aggregate([
+            {"$match": match},
+            {"$sort": {"_id": 1}},
+            {"$group": {
+                "_id": "$product_id",
+                "delta": {"$sum": DELTA},
+                "entries": {"$sum": 1},
+                "last_id": {"$last": "$_id"},
+                "last_remaining": {"$last": "$remaining_stock"},
+            }},
+        ])
+        return {row.pop("_id"): row async for row in rows}
+
+    async def _fold(self, since: Optional[ObjectId], until: ObjectId, lower: Optional[str], upper: Optional[str]) -> int:
+        match = {"_id": {"$lte": until}}
+        if since is not None:
+            match["_id"]["$gt"] = since
+        products = product_range(lower, upper)
+        if products:
+            match["product_id"] = products
+        # Re-read if the archiver moved another part out of MongoDB meanwhile
+        months = self._archived_months(since)
+        while True:
+            archived = await self._fold_archive(match) if months else {}
+            live = match
+            if months:
+                live = {**match, "$nor": [
+                    {"date": {"$gte": start, "$lt": end}, "_id": {"$lte": ObjectId(last)}} for start, end, last in months
+                ]}
+            rows = await self._fold_mongo(live)
+            current = self._archived_months(since)
+            if current == months:
+                break
+            months = current
+        for product_id, row in archived.items():
+            merged = rows.setdefault(product_id, {"delta": 0, "entries": 0, "last_id": None, "last_remaining": None})
+            merged["delta"] += row["delta"]
+            merged["entries"] += row["entries"]
+            if merged["last_id"] is None or row["last_id"] > merged["last_id"]:
+                merged["last_id"], merged["last_remaining"] = row["last_id"], row["last_remaining"]
+        operations = [
+            UpdateOne(
+                {"_id": product_id, "position": {"$lt": until}},
+                {
+                    "$inc": {"quantity": row["delta"], "entries": row["entries"]},
+                    "$set": {"position": until, "last_remaining": row["last_remaining"]},
+                },
+                upsert=True,
+            )
+            for product_id, row in rows.items()
+        ]
+        if not operations:
+            return 0
+        try:
+            result = await self.db.db[STOCK_LEDGER].bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            # Duplicate keys are products a failed run already folded for this window
+            if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                raise
+            return e.details["nUpserted"] + e.details["nModified"]
+        return result.upserted_count + result.modified_count
+
+    async def _compare(self, since: Optional[ObjectId], lower: Optional[str] = None, upper: Optional[str] = None,
+                       product_ids: Optional[List[str]] = None) -> Tuple[int, List[dict]]:
+        products_match = {"$in": product_ids} if product_ids is not None else product_range(lower, upper)
+        product_filter = {"product_id": products_match} if products_match else {}
+        products = await self.db.products.find(
+            product_filter, {"product_id": 1, "name": 1, "stock_quantity": 1, "stock_shards": 1},
+        ).to_list(None)
+        ledger = {
+            row["_id"]: row
+            async for row in self.db.db[STOCK_LEDGER].find({"_id": products_match} if products_match else {})
+        }
+        # Entries too young to be folded yet
+        tail = {
+            row["_id"]: row["delta"]
+            async for row in await self.db.stock_log.aggregate([
+                {"$match": {**({"_id": {"$gt": since}} if since is not None else {}), **product_filter}},
+                {"$group": {"_id": "$product_id", "delta": {"$sum": DELTA}}},
+            ])
+        }
+        sharded = [product["product_id"] for product in products if "stock_shards" in product]
+        shard_totals = {}
+        if sharded:
+            shard_totals = {
+                row["_id"]: row["quantity"]
+                async for row in await self.db.db[STOCK_SHARDS].aggregate([
+                    {"$match": {"product_id": {"$in": sharded}}},
+                    {"$group": {"_id": "$product_id", "quantity": {"$sum": "$quantity"}}},
+                ])
+            }
+
+        mismatches = []
+        for product in products:
+            product_id = product["product_id"]
+            entry = ledger.get(product_id, {})
+            expected = entry.get("quantity", 0) + tail.get(product_id, 0)
+            actual = shard_totals.get(product_id, 0) if "stock_shards" in product else product["stock_quantity"]
+            if actual != expected:
+                mismatches.append({
+                    "product_id": product_id,
+                    "name": product["name"],
+                    "stock_quantity": actual,
+                    "expected": expected,
+                    "difference": actual - expected,
+                    "sharded": "stock_shards" in product,
+                    "log_entries": entry.get("entries", 0),
+                    "last_logged_stock": entry.get("last_remaining"),
+                })
+        return len(products), mismatches
+
+    # The mismatches that still read the same once every log entry for a change seen in
+    # the first read has landed
+    async def _confirm(self, mismatches: List[dict], since: ObjectId) -> List[dict]:
+        await asyncio.sleep(self.settle)
+        _, again = await self._compare(since, product_ids=[row["product_id"] for row in mismatches])
+        first = {row["product_id"]: row["difference"] for row in mismatches}
+        return [row for row in again if row["difference"] == first[row["product_id"]]]
+
+    # Bring confirmed mismatches to what the log says and record each repair in the
+    # stock_log. The $inc only applies if the stock is still what was read, so a sale made
+    # since is never overwritten; sharded stock is spread over several documents and is
+    # only reported. Sets each mismatch's "repair" outcome.
+    async def _repair(self, mismatches: List[dict], since: ObjectId, performed_by: str) -> int:
+        for row in mismatches:
+            row["repair"] = "unconfirmed"
+        confirmed = {row["product_id"]: row for row in await self._confirm(mismatches, since)}
+        products, entries = [], []
+        for row in mismatches:
+            current = confirmed.get(row["product_id"])
+            if current is None:
+                continue
+            if current["sharded"]:
+                row["repair"] = "sharded"
+                continue
+            product = await self.db.products.find_one_and_update(
+                {"product_id": row["product_id"], "stock_quantity": current["stock_quantity"], "stock_shards": {"$exists": False}},
+                {"$inc": {"stock_quantity": -current["difference"]}},
+                return_document=ReturnDocument.AFTER,
+            )
+            if product is None:
+                row["repair"] = "stock_changed"
+                continue
+            row["repair"] = "repaired"
+            products.append(product)
+            entries.append(log_entry("reconcile", product, -current["difference"], product["stock_quantity"], performed_by))
+        await self.stock_log_writer.write(entries)
+        if self.stock.cache is not None:
+            for product in products:
+                self.stock.cache.put(product)
+        if self.stock.monitor is not None and products:
+            await self.stock.monitor.evaluate(products)
+        return len(entries)
+
+    async def run(self, repair: bool = False, partitions: Optional[int] = None, performed_by: str = "reconciliation") -> Optional[dict]:
+        state = await self._take_lease()
+        if state is None:
+            return None
+        try:
+            since = state.get("position")
+            ranges = await self._boundaries(partitions or self.partitions)
+            readable = self.archive_readable
+            if readable:
+                until = state.get("pending") or last_id_before(datetime.now(timezone.utc) - timedelta(seconds=self.settle))
+                if since is not None and until <= since:
+                    until = since
+                await self.db.db[RECONCILIATION].update_one({"_id": "stock_log"}, {"$set": {"pending": until}})
+                folded = await asyncio.gather(*[self._fold(since, until, lower, upper) for lower, upper in ranges])
+                await self.db.db[RECONCILIATION].update_one(
+                    {"_id": "stock_log"}, {"$set": {"position": until, "checked_at": datetime.now(timezone.utc)}, "$unset": {"pending": ""}},
+                )
+            else:
+                logger.warning("Not folding or repairing stock: the stock_log archive cannot be read by this worker")
+                until, folded = since, []
+
+            compared = await asyncio.gather(*[self._compare(until, lower, upper) for lower, upper in ranges])
+            mismatches = [row for _, rows in compared for row in rows]
+            repaired = await self._repair(mismatches, until, performed_by) if repair and readable and mismatches else 0
+            return {
+                "checkpoint": str(until) if until is not None else None,
+                "previous_checkpoint": str(since) if since is not None else None,
+                "partitions": len(ranges),
+                "products_folded": sum(folded),
+                "products_checked": sum(checked for checked, _ in compared),
+                "mismatch_count": len(mismatches),
+                "mismatches": mismatches[:MAX_REPORTED_MISMATCHES],
+                "archive_readable": readable,
+                "repaired": repaired,
+            }
+        finally:
+            await self._release_lease()
+
+    async def _run(self):
+        while True:
+            try:
+                report = await self.run()
+                if report and report["mismatch_count"]:
+                    logger.warning(
+                        "Stock reconciliation: %d product(s) disagree with the stock_log, e.g. %s",
+                        report["mismatch_count"], report["mismatches"][:5],
+                    )
+            except Exception as e:
+                logger.error("Stock reconciliation failed: %s", e)
+            await asyncio.sleep(self.run_every)
+
+    def start(self):
+        self.task = asyncio.create_task(self._run(), name="stock-reconciliation")
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
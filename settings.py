@@ -0,0 +1,77 @@
+import os
+from typing import List, Optional
+from pydantic import BaseModel
+
+
+def env_flag(name: str, default: str = "0") -> bool:
+    return os.environ.get(name, default) == "1"
+
+
+# Deployment settings handed to create_app(): where the database and mail server are and
+# how the HTTP stack in front of the routes behaves. Feature tuning (cache sizes, background
+# job intervals, ...) stays next to the objects it configures in project.py.
+class Settings(BaseModel):
+    mongo_uri: str = "mongodb://localhost:27017"
+    mongo_db_name: str = "stock_management"
+    mongo_max_pool_size: int = 100
+    mongo_min_pool_size: int = 10
+    mongo_server_selection_timeout_ms: int = 5000
+    mongo_connect_timeout_ms: int = 5000
+    mongo_socket_timeout_ms: int = 30000
+    mongo_wait_queue_timeout_ms: int = 10000
+
+    smtp_server: str = "smtp.gmail.com"
+    smtp_port: int = 587
+    smtp_use_tls: bool = True
+    sender_email: str = "gamingidofmine@gmail.com"  # Replace with your Gmail address
+    sender_password: Optional[str] = None  # Gmail app password, from SENDER_PASSWORD; email is off without it
+    smtp_require_login: bool = True  # Set SMTP_REQUIRE_LOGIN=0 for a relay that accepts mail without a password
+    recipient_email: str = "sahil14agrawal03@gmail.com"  # Replace with your phone or email address
+    email_queue_size: int = 1000  # Notifications beyond this are dropped instead of blocking requests
+    email_workers: int = 1  # Each worker keeps its own authenticated SMTP connection
+    email_digest_window: float = 2.0  # Seconds to wait for more notifications to merge into one email
+
+    cors_origins: List[str] = ["*"]
+    admission_write_concurrency: int = 16
+    admission_read_concurrency: int = 64
+    admission_queue_size: int = 100
+    admission_max_wait: float = 0.5
+    slow_request_seconds: float = 1.0
+    compression_minimum_size: int = 1024
+
+    check_query_plans: bool = False
+    warm_catalog: bool = True  # Load the whole catalog into the cache before reporting ready
+
+    @classmethod
+    def from_env(cls) -> "Settings":
+        defaults = cls()
+        env = os.environ.get
+        return cls(
+            mongo_uri=env("MONGO_URI", defaults.mongo_uri),
+            mongo_db_name=env("MONGO_DB_NAME", defaults.mongo_db_name),
+            mongo_max_pool_size=int(env("MONGO_MAX_POOL_SIZE", defaults.mongo_max_pool_size)),
+            mongo_min_pool_size=int(env("MONGO_MIN_POOL_SIZE", defaults.mongo_min_pool_size)),
+            mongo_server_selection_timeout_ms=int(env("MONGO_SERVER_SELECTION_TIMEOUT_MS", defaults.mongo_server_selection_timeout_ms)),
+            mongo_connect_timeout_ms=int(env("MONGO_CONNECT_TIMEOUT_MS", defaults.mongo_connect_timeout_ms)),
+            mongo_socket_timeout_ms=int(env("MONGO_SOCKET_TIMEOUT_MS", defaults.mongo_socket_timeout_ms)),
+            mongo_wait_queue_timeout_ms=int(env("MONGO_WAIT_QUEUE_TIMEOUT_MS", defaults.mongo_wait_queue_timeout_ms)),
+            smtp_server=env("SMTP_SERVER", defaults.smtp_server),
+            smtp_port=int(env("SMTP_PORT", defaults.smtp_port)),
+            smtp_use_tls=env_flag("SMTP_USE_TLS", "1" if defaults.smtp_use_tls else "0"),
+            sender_email=env("SENDER_EMAIL", defaults.sender_email),
+            sender_password=env("SENDER_PASSWORD") or None,
+            smtp_require_login=env_flag("SMTP_REQUIRE_LOGIN", "1" if defaults.smtp_require_login else "0"),
+            recipient_email=env("RECIPIENT_EMAIL", defaults.recipient_email),
+            email_queue_size=int(env("EMAIL_QUEUE_SIZE", defaults.email_queue_size)),
+            email_workers=int(env("EMAIL_WORKERS", defaults.email_workers)),
+            email_digest_window=float(env("EMAIL_DIGEST_WINDOW", defaults.email_digest_window)),
+            cors_origins=[origin.strip() for origin in env("CORS_ORIGINS", ",".join(defaults.cors_origins)).split(",") if origin.strip()],
+            admission_write_concurrency=int(env("ADMISSION_WRITE_CONCURRENCY", defaults.admission_write_concurrency)),
+            admission_read_concurrency=int(env("ADMISSION_READ_CONCURRENCY", defaults.admission_read_concurrency)),
+            admission_queue_size=int(env("ADMISSION_QUEUE_SIZE", defaults.admission_queue_size)),
+            admission_max_wait=float(env("ADMISSION_MAX_WAIT", defaults.admission_max_wait)),
+            slow_request_seconds=float(env("SLOW_REQUEST_SECONDS", defaults.slow_request_seconds)),
+            compression_minimum_size=int(env("COMPRESSION_MINIMUM_SIZE", defaults.compression_minimum_size)),
+            check_query_plans=env_flag("CHECK_QUERY_PLANS"),
+            warm_catalog=env_flag("WARM_CATALOG", "1"),
+        )
@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import random
+from typing import Dict, List, Optional
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+from stock import InsufficientStock
+
+logger = logging.getLogger(__name__)
+
+STOCK_SHARDS = "stock_shards"  # {_id: "<product_id>:<n>", product_id, quantity}
+
+
+def shard_ids(product: dict) -> List[str]:
+    return [f"{product['product_id']}:{n}" for n in range(product["stock_shards"])]
+
+
+# Sharded stock counters for hot products. A product flagged with `stock_shards: N`
+# keeps its stock in N documents of stock_shards instead of its own stock_quantity, so
+# concurrent sales decrement different documents instead of queueing on one. A
+# decrement goes to a random shard known to hold enough; when no single shard does, it
+# takes from several and puts everything back if the total falls short. The product's
+# stock_quantity is the cached total: the rebalancer rewrites it from the shards every
+# `rebalance_every` seconds and evens out the shards, and this worker's writes hand the
+# fresh total to the catalog cache and the stock_log.
+class ShardedStock:
+    def __init__(self, db, rebalance_every: float = 1.0):
+        self.db = db
+        self.rebalance_every = rebalance_every
+        self.known: Dict[str, Dict[str, int]] = {}  # product_id -> last read shard quantities
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def shards(self):
+        return self.db.db[STOCK_SHARDS]
+
+    async def read(self, product_id: str) -> Dict[str, int]:
+        quantities = {shard["_id"]: shard["quantity"] async for shard in self.shards.find({"product_id": product_id})}
+        self.known[product_id] = quantities
+        return quantities
+
+    async def _take(self, shard_id: str, quantity: int) -> bool:
+        result = await self.shards.update_one({"_id": shard_id, "quantity": {"$gte": quantity}}, {"$inc": {"quantity": -quantity}})
+        return result.modified_count == 1
+
+    # Take `quantity` spread over several shards; all or nothing
+    async def _take_across(self, product: dict, quantity: int) -> bool:
+        quantities = await self.read(product["product_id"])
+        if sum(quantities.values()) < quantity:
+            return False
+        taken: Dict[str, int] = {}
+        for shard_id, available in sorted(quantities.items(), key=lambda item: -item[1]):
+            part = min(available, quantity - sum(taken.values()))
+            if part > 0 and await self._take(shard_id, part):
+                taken[shard_id] = part
+        if sum(taken.values()) == quantity:
+            return True
+        for shard_id, part in taken.items():
+            await self.shards.update_one({"_id": shard_id}, {"$inc": {"quantity": part}})
+        return False
+
+    # Apply `delta` to a sharded product; returns the product with the new total as stock_quantity
+    async def adjust(self, product: dict, delta: int) -> dict:
+        ids = shard_ids(product)
+        if delta >= 0:
+            await self.shards.update_one(
+                {"_id": random.choice(ids)},
+                {"$inc": {"quantity": delta}, "$setOnInsert": {"product_id": product["product_id"]}},
+                upsert=True,
+            )
+        else:
+            known = self.known.get(product["product_id"], {})
+            ready = [shard_id for shard_id in ids if known.get(shard_id, 0) >= -delta]
+            random.shuffle(ready)
+            for shard_id in ready:
+                if await self._take(shard_id, -delta):
+                    break
+            else:
+                if not await self._take_across(product, -delta):
+                    raise InsufficientStock(product["name"])
+        quantities = await self.read(product["product_id"])
+        return {**product, "stock_quantity": sum(quantities.values())}
+
+    # Move a product's stock into `count` shards. Writers that still see it unsharded
+    # fail their guard and retry here.
+    async def enable(self, product_id: str, count: int) -> Optional[dict]:
+        product = await self.db.products.find_one_and_update(
+            {"product_id": product_id, "stock_shards": {"$exists": False}},
+            {"$set": {"stock_shards": count}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if product is None:
+            return None
+        share, extra = divmod(product["stock_quantity"], count)
+        await self.shards.bulk_write([
+            UpdateOne(
+                {"_id": shard_id},
+                {"$inc": {"quantity": share + (1 if n < extra else 0)}, "$setOnInsert": {"product_id": product_id}},
+                upsert=True,
+            )
+            for n, shard_id in enumerate(shard_ids(product))
+        ])
+        return product
+
+    # Fold the shards back into stock_quantity
+    async def disable(self, product_id: str) -> Optional[dict]:
+        product = await self.db.products.find_one_and_update(
+            {"product_id": product_id, "stock_shards": {"$exists": True}},
+            {"$unset": {"stock_shards": ""}, "$set": {"stock_quantity": 0}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if product is None:
+            return None
+        return await self._drain(product_id) or product
+
+    # Empty the shards of an unsharded product into its stock_quantity, including
+    # late writes from workers that had not seen the flag go
+    async def _drain(self, product_id: str) -> Optional[dict]:
+        product = None
+        async for shard in self.shards.find({"product_id": product_id, "quantity": {"$ne": 0}}):
+            before = await self.shards.find_one_and_update({"_id": shard["_id"]}, {"$set": {"quantity": 0}})
+            product = await self.db.products.find_one_and_update(
+                {"product_id": product_id}, {"$inc": {"stock_quantity": before["quantity"]}}, return_document=ReturnDocument.AFTER,
+            )
+        self.known.pop(product_id, None)
+        return product
+
+    # Move half the difference from the fullest shard to the emptiest. The take is an
+    # upsert on {_id, quantity >= amount}: when the guard fails the insert hits a
+    # duplicate key and the ordered bulk stops before the give.
+    async def _move(self, source: str, target: str, amount: int):
+        try:
+            await self.shards.bulk_write([
+                UpdateOne({"_id": source, "quantity": {"$gte": amount}}, {"$inc": {"quantity": -amount}}, upsert=True),
+                UpdateOne({"_id": target}, {"$inc": {"quantity": amount}}),
+            ], ordered=True)
+        except BulkWriteError as e:
+            if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                raise
+
+    # Refresh the cached totals, even out shards and drain shards of unsharded products
+    async def rebalance(self):
+        sharded = {
+            product["product_id"]: product
+            async for product in self.db.products.find({"stock_shards": {"$exists": True}}, {"product_id": 1, "stock_shards": 1, "stock_quantity": 1})
+        }
+        quantities: Dict[str, Dict[str, int]] = {}
+        async for shard in self.shards.find({"quantity": {"$ne": 0}}):
+            quantities.setdefault(shard["product_id"], {})[shard["_id"]] = shard["quantity"]
+
+        totals = []
+        for product_id, product in sharded.items():
+            current = {shard_id: quantities.get(product_id, {}).get(shard_id, 0) for shard_id in shard_ids(product)}
+            self.known[product_id] = current
+            total = sum(current.values())
+            if total != product["stock_quantity"]:
+                totals.append(UpdateOne(
+                    {"_id": product["_id"], "stock_shards": {"$exists": True}}, {"$set": {"stock_quantity": total}},
+                ))
+            fullest = max(current, key=current.get)
+            emptiest = min(current, key=current.get)
+            if current[emptiest] < total // len(current) // 2:
+                await self._move(fullest, emptiest, (current[fullest] - current[emptiest]) // 2)
+        if totals:
+            await self.db.products.bulk_write(totals, ordered=False)
+
+        for product_id, shards in quantities.items():
+            if product_id not in sharded and any(shards.values()):
+                await self._drain(product_id)
+
+    async def _run(self):
+        while True:
+            try:
+                await self.rebalance()
+            except Exception as e:
+                logger.error("Stock shard rebalancing failed: %s", e)
+            await asyncio.sleep(self.rebalance_every)
+
+    def start(self):
+        self.task = asyncio.create_task(self._run(), name="stock-shards")
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
@@ -0,0 +1,129 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+from pymongo import DESCENDING
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+STOCK_SNAPSHOTS = "stock_snapshots"  # {_id: as_of, products: [{product_id, stock_quantity}]}
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def utc(when: datetime) -> datetime:
+    return when.replace(tzinfo=timezone.utc) if when.tzinfo is None else when.astimezone(timezone.utc)
+
+
+# Stock per product from the last stock_log entry in [start, end) - or [start, end] with
+# `inclusive` - relying on every entry recording the stock left after it
+async def last_stock(db, start: Optional[datetime], end: datetime, inclusive: bool = False) -> Dict[str, int]:
+    dates = {"$lte" if inclusive else "$lt": end}
+    if start is not None:
+        dates["$gte"] = start
+    rows = await db.stock_log.aggregate([
+        {"$match": {"date": dates}},
+        {"$sort": {"date": 1, "_id": 1}},
+        {"$group": {"_id": "$product_id", "stock_quantity": {"$last": "$remaining_stock"}}},
+    ])
+    return {row["_id"]: row["stock_quantity"] async for row in rows}
+
+
+# Archived stock_log entries only carry what these reads need
+ARCHIVED_FIELDS = {"product_id": 1, "remaining_stock": 1, "date": 1}
+
+
+def _newest(entries: List[dict]) -> List[dict]:
+    return sorted(entries, key=lambda entry: (entry["date"], entry["_id"]))
+
+
+# Stock of every product as of `when`: the newest snapshot taken at or before `when`
+# plus the log entries written since it, so the cost is one snapshot read and at most
+# one interval of log entries no matter how long the history is. Entries already moved
+# to `archive` are read from there.
+async def stock_at(db, when: datetime, archive=None) -> Dict[str, int]:
+    snapshot = await db.db[STOCK_SNAPSHOTS].find_one({"_id": {"$lte": when}}, sort=[("_id", DESCENDING)])
+    stock = {}
+    start = None
+    if snapshot is not None:
+        stock = {p["product_id"]: p["stock_quantity"] for p in snapshot["products"]}
+        start = snapshot["_id"]
+    if archive is not None and archive.covers("stock_log", start):
+        dates = {"$lte": when} if start is None else {"$gte": start, "$lte": when}
+        for entry in _newest(await archive.find("stock_log", {"date": dates}, ARCHIVED_FIELDS)):
+            stock[entry["product_id"]] = entry["remaining_stock"]
+    stock.update(await last_stock(db, start, when, inclusive=True))
+    return stock
+
+
+# One product as of `when`: the newest log entry at or before it, through the
+# (product_id, date) index
+async def product_stock_at(db, product_id: str, when: datetime, archive=None) -> Optional[int]:
+    query = {"product_id": product_id, "date": {"$lte": when}}
+    entry = await db.stock_log.find_one(query, {"remaining_stock": 1}, sort=[("date", DESCENDING), ("_id", DESCENDING)])
+    if entry is None and archive is not None and archive.covers("stock_log", None):
+        archived = _newest(await archive.find("stock_log", query, ARCHIVED_FIELDS))
+        entry = archived[-1] if archived else None
+    return entry["remaining_stock"] if entry else None
+
+
+# Builds whole-catalog stock snapshots at every `interval` boundary (UTC, aligned to the
+# epoch, so daily snapshots fall on midnight) once the boundary is `settle` seconds in
+# the past, leaving time for buffered log entries to land. Each new
+# snapshot is the previous one plus that interval's log entries, so a run only reads
+# what was logged since the last snapshot. Safe to run in several workers: a snapshot
+# another worker already wrote is skipped.
+class SnapshotCompactor:
+    def __init__(self, db, interval: timedelta = timedelta(days=1), run_every: float = 3600, settle: float = 300):
+        self.db = db
+        self.interval = interval
+        self.run_every = run_every
+        self.settle = settle
+        self.task: Optional[asyncio.Task] = None
+
+    def boundary_after(self, when: datetime) -> datetime:
+        return EPOCH + ((utc(when) - EPOCH) // self.interval + 1) * self.interval
+
+    async def compact(self) -> int:
+        snapshots = self.db.db[STOCK_SNAPSHOTS]
+        latest = await snapshots.find_one({}, sort=[("_id", DESCENDING)])
+        if latest is None:
+            first = await self.db.stock_log.find_one({}, {"date": 1}, sort=[("date", 1)])
+            if first is None:
+                return 0
+            start, stock, boundary = None, {}, self.boundary_after(first["date"])
+        else:
+            start = utc(latest["_id"])
+            stock = {p["product_id"]: p["stock_quantity"] for p in latest["products"]}
+            boundary = start + self.interval
+
+        written = 0
+        while boundary <= datetime.now(timezone.utc) - timedelta(seconds=self.settle):
+            stock.update(await last_stock(self.db, start, boundary))
+            products = [{"product_id": product_id, "stock_quantity": quantity} for product_id, quantity in stock.items()]
+            try:
+                await snapshots.insert_one({"_id": boundary, "products": products})
+                written += 1
+            except DuplicateKeyError:
+                pass  # Another worker wrote this one
+            start, boundary = boundary, boundary + self.interval
+        return written
+
+    async def _run(self):
+        while True:
+            try:
+                written = await self.compact()
+                if written:
+                    logger.info("Wrote %d stock snapshot(s)", written)
+            except Exception as e:
+                logger.error("Stock snapshot compaction failed: %s", e)
+            await asyncio.sleep(self.run_every)
+
+    def start(self):
+        self.task = asyncio.create_task(self._run(), name="stock-snapshots")
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
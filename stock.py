@@ -0,0 +1,273 @@
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+
+
+class StockError(Exception):
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.name = name
+
+
+class ProductNotFound(StockError):
+    pass
+
+
+class InsufficientStock(StockError):
+    pass
+
+
+# Raised inside a transaction that found a product whose stock lives in shards
+class ShardedProduct(Exception):
+    pass
+
+
+class StockChange(NamedTuple):
+    name: str  # Product name (field is 'name' in the DB)
+    delta: int  # Negative for sales/installations, positive for returns/restocks
+
+
+class StockResult(NamedTuple):
+    product: dict  # Product document after the whole batch was applied
+    remaining_stock: int  # Stock right after this particular line was applied
+
+
+# Applies stock changes with conditional $inc so concurrent requests never lose
+# updates and stock never goes below zero. A batch touching several products is
+# applied all-or-nothing: inside one transaction when the deployment supports it,
+# otherwise with one guarded bulk write whose successful changes are put back when
+# another product's guard rejects its change. Post-update documents
+# are written through to the catalog cache and handed to the threshold monitor,
+# when those are given. With `shards`, products flagged with stock_shards take their
+# stock changes through the sharded counters instead.
+class StockEngine:
+    def __init__(self, db, cache=None, monitor=None, shards=None):
+        self.db = db
+        self.cache = cache
+        self.monitor = monitor
+        self.shards = shards
+        self.transactions_supported: Optional[bool] = None
+
+    # Products in `names` that this worker's cache knows to be sharded; the write guards
+    # catch the ones it does not know about
+    def _sharded(self, names) -> Dict[str, dict]:
+        if self.shards is None or self.cache is None:
+            return {}
+        cached = {name: self.cache.peek(name) for name in names}
+        return {name: product for name, product in cached.items() if product is not None and "stock_shards" in product}
+
+    # Stock of `names` as MongoDB has it now, for pre-checks that another worker's writes
+    # must not skew the way they can this worker's cache. Sharded products report the
+    # total the rebalancer last wrote.
+    async def current(self, names: List[str]) -> Dict[str, int]:
+        found = self.db.products.find({"name": {"$in": names}}, {"name": 1, "stock_quantity": 1})
+        return {product["name"]: product["stock_quantity"] async for product in found}
+
+    async def apply(self, changes: List[StockChange], set_fields: Optional[dict] = None) -> List[StockResult]:
+        totals: Dict[str, int] = OrderedDict()
+        for change in changes:
+            totals[change.name] = totals.get(change.name, 0) + change.delta
+
+        if len(totals) == 1:
+            name, delta = next(iter(totals.items()))
+            products = {name: await self._adjust(name, delta, set_fields)}
+        elif not self._sharded(totals) and await self._supports_transactions():
+            try:
+                products = await self._apply_in_transaction(totals, set_fields)
+            except ShardedProduct:
+                products = await self._apply_with_compensation(totals, set_fields)
+        else:
+            products = await self._apply_with_compensation(totals, set_fields)
+
+        if self.cache is not None:
+            for product in products.values():
+                self.cache.put(product)
+        if self.monitor is not None:
+            await self.monitor.evaluate(products.values())
+
+        # Work out the stock left after each line, in the order the lines were given
+        running = {name: products[name]["stock_quantity"] - delta for name, delta in totals.items()}
+        results = []
+        for change in changes:
+            running[change.name] += change.delta
+            results.append(StockResult(products[change.name], running[change.name]))
+        return results
+
+    def _update(self, name: str, delta: int, set_fields: Optional[dict]):
+        guard = {"name": name}
+        if delta < 0:
+            guard["stock_quantity"] = {"$gte": -delta}
+        if self.shards is not None:
+            guard["stock_shards"] = {"$exists": False}
+        update = {"$inc": {"stock_quantity": delta}}
+        if set_fields:
+            update["$set"] = set_fields
+        return guard, update
+
+    async def _adjust(self, name: str, delta: int, set_fields: Optional[dict]) -> dict:
+        sharded = self._sharded([name]).get(name)
+        if sharded is not None:
+            return await self._adjust_shards(sharded, delta, set_fields)
+        guard, update = self._update(name, delta, set_fields)
+        product = await self.db.products.find_one_and_update(guard, update, return_document=ReturnDocument.AFTER)
+        if product is None:
+            # The product is missing, the guard rejected the decrement, or it was sharded meanwhile
+            product = await self.db.products.find_one({"name": name})
+            if product is None:
+                raise ProductNotFound(name)
+            if self.shards is not None and "stock_shards" in product:
+                return await self._adjust_shards(product, delta, set_fields)
+            raise InsufficientStock(name)
+        return product
+
+    async def _adjust_shards(self, product: dict, delta: int, set_fields: Optional[dict]) -> dict:
+        product = await self.shards.adjust(product, delta)
+        if set_fields:
+            await self.db.products.update_one({"_id": product["_id"]}, {"$set": set_fields})
+            product.update(set_fields)
+        return product
+
+    async def _supports_transactions(self) -> bool:
+        if self.transactions_supported is None:
+            hello = await self.db.db.command("hello")
+            self.transactions_supported = "setName" in hello or hello.get("msg") == "isdbgrid"
+        return self.transactions_supported
+
+    # Read, check and write inside one snapshot transaction: find + bulk_write + commit,
+    # however many products the batch touches. A concurrent writer on the same product
+    # causes a transient write conflict, which with_transaction retries.
+    async def _apply_in_transaction(self, totals: Dict[str, int], set_fields: Optional[dict]) -> Dict[str, dict]:
+        async def callback(session):
+            found = await self.db.products.find({"name": {"$in": list(totals)}}, session=session).to_list(None)
+            products = {product["name"]: product for product in found}
+            if self.shards is not None and any("stock_shards" in product for product in found):
+                raise ShardedProduct()
+            for name, delta in totals.items():
+                if name not in products:
+                    raise ProductNotFound(name)
+                if products[name]["stock_quantity"] + delta < 0:
+                    raise InsufficientStock(name)
+
+            operations = [UpdateOne(*self._update(name, delta, set_fields)) for name, delta in totals.items()]
+            result = await self.db.products.bulk_write(operations, ordered=False, session=session)
+            if result.matched_count != len(operations):
+                # A guard rejected a decrement the snapshot said was fine; the update result doesn't
+                # say which one, so find the product the batch left unchanged and abort the whole batch
+                after = await self.db.products.find(
+                    {"name": {"$in": list(totals)}}, {"name": 1, "stock_quantity": 1, "stock_shards": 1}, session=session
+                ).to_list(None)
+                if self.shards is not None and any("stock_shards" in product for product in after):
+                    raise ShardedProduct()
+                current = {product["name"]: product["stock_quantity"] for product in after}
+                for name, delta in totals.items():
+                    if name not in current:
+                        raise ProductNotFound(name)
+                    if current[name] != products[name]["stock_quantity"] + delta:
+                        raise InsufficientStock(name)
+                raise InsufficientStock(next((name for name, delta in totals.items() if delta < 0), next(iter(totals))))
+
+            for name, delta in totals.items():
+                products[name]["stock_quantity"] += delta
+                products[name].update(set_fields or {})
+            return products
+
+        async with self.db.client.start_session() as session:
+            return await session.with_transaction(callback)
+
+    # Without transactions: change every product with one guarded bulk_write, and if any
+    # guard rejected its change put back what the others took, so the batch still applies
+    # all-or-nothing. set_fields are written only once every change went through.
+    async def _apply_with_compensation(self, totals: Dict[str, int], set_fields: Optional[dict]) -> Dict[str, dict]:
+        products, failed = await self._apply_bulk(totals)
+        if failed:
+            await self._undo(products, totals)
+            raise next(failed[name] for name in totals if name in failed)
+        if set_fields:
+            await self.db.products.update_many({"_id": {"$in": [p["_id"] for p in products.values()]}}, {"$set": set_fields})
+            for product in products.values():
+                product.update(set_fields)
+        return products
+
+    async def _undo(self, products: Dict[str, dict], totals: Dict[str, int]):
+        operations = []
+        for name, product in products.items():
+            if "stock_shards" in product and self.shards is not None:
+                await self.shards.adjust(product, -totals[name])
+            else:
+                operations.append(UpdateOne({"_id": product["_id"]}, {"$inc": {"stock_quantity": -totals[name]}}))
+            if self.cache is not None:
+                self.cache.invalidate(name)
+        if operations:
+            await self.db.products.bulk_write(operations, ordered=False)
+
+    # Sharded products go through their counters one by one; they are few and hot
+    async def _apply_shards(self, sharded: Dict[str, dict], totals: Dict[str, int],
+                            products: Dict[str, dict], failed: Dict[str, StockError]):
+        for name, product in sharded.items():
+            failed.pop(name, None)
+            try:
+                products[name] = await self.shards.adjust(product, totals[name])
+            except StockError as e:
+                failed[name] = e
+
+    # Apply per-product totals independently with one bulk_write. Each decrement is an
+    # upsert on {_id, stock_quantity >= qty}: when the guard rejects it, the upsert tries
+    # to insert the existing _id and fails with a duplicate key error at that operation's
+    # index, which tells us exactly which products did not have enough stock. Returns the
+    # changed products and the failure of each product left unchanged.
+    async def _apply_bulk(self, totals: Dict[str, int]) -> Tuple[Dict[str, dict], Dict[str, StockError]]:
+        if self.cache is not None:
+            current = await self.cache.get_many(list(totals))
+        else:
+            found = await self.db.products.find({"name": {"$in": list(totals)}}).to_list(None)
+            current = {product["name"]: product for product in found}
+
+        failed: Dict[str, StockError] = {name: ProductNotFound(name) for name in totals if name not in current}
+        products = {}
+        sharded = [name for name in totals if name in current and "stock_shards" in current[name]]
+        if self.shards is not None:
+            await self._apply_shards({name: current[name] for name in sharded}, totals, products, failed)
+        names = [name for name in totals if name not in failed and name not in products]
+        operations = []
+        for name in names:
+            delta = totals[name]
+            guard = {"_id": current[name]["_id"]}
+            if delta < 0:
+                guard["stock_quantity"] = {"$gte": -delta}
+            if self.shards is not None:
+                # Also fails, and is retried below, for a product sharded since it was cached
+                guard["stock_shards"] = {"$exists": False}
+            operations.append(UpdateOne(guard, {"$inc": {"stock_quantity": delta}}, upsert=delta < 0 or self.shards is not None))
+
+        if operations:
+            try:
+                await self.db.products.bulk_write(operations, ordered=False)
+            except BulkWriteError as e:
+                for error in e.details["writeErrors"]:
+                    if error["code"] != 11000:
+                        raise
+                    failed[names[error["index"]]] = InsufficientStock(names[error["index"]])
+            if self.shards is not None:
+                rejected = [current[name]["_id"] for name in names if name in failed]
+                resharded = await self.db.products.find({"_id": {"$in": rejected}, "stock_shards": {"$exists": True}}).to_list(None)
+                await self._apply_shards({product["name"]: product for product in resharded}, totals, products, failed)
+
+        applied = [name for name in names if name not in failed and name not in products]
+        if applied:
+            async for product in self.db.products.find({"_id": {"$in": [current[name]["_id"] for name in applied]}}):
+                products[product["name"]] = product
+            for name in applied:
+                if name not in products:  # Deleted since it was read
+                    failed[name] = ProductNotFound(name)
+        return products, failed
+
+    # For batch callers that report failures per product instead of aborting
+    async def apply_independent(self, totals: Dict[str, int]) -> Tuple[Dict[str, dict], Dict[str, StockError]]:
+        products, failed = await self._apply_bulk(totals)
+        if self.cache is not None:
+            for product in products.values():
+                self.cache.put(product)
+        if self.monitor is not None:
+            await self.monitor.evaluate(products.values())
+        return products, failed
@@ -0,0 +1,119 @@
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Dict, List, Optional
+from bson import ObjectId
+from audit import with_utc_date
+from responses import dumps
+
+SYNC_PAGE_SIZE = 1000  # Most documents per collection in one delta
+FEED = ["stock_log", "sales"]  # Collections whose new documents make up the feed
+WATCHED = ["products", "sales"]  # Version counters that change whenever the feed does
+
+
+# Largest ObjectId that can only have been generated before `when`; ObjectId
+# timestamps have one-second resolution, so that is the end of the previous second
+def last_id_before(when: datetime) -> ObjectId:
+    return ObjectId((int(when.timestamp()) - 1).to_bytes(4, "big") + b"\xff" * 8)
+
+
+# Change feed for offline terminals. A sync token is an ObjectId: everything in the feed
+# with a smaller or equal _id has been delivered. Documents are only handed out once
+# they are `settle` seconds old, so an insert from another worker (or a buffered
+# stock_log flush) that got its _id a little earlier cannot land behind a token that was
+# already given out. Products come as their current documents for every product_id
+# that appears in the delivered stock_log entries.
+class ChangeFeed:
+    def __init__(self, db, versions, settle: float = 5.0, poll_interval: float = 1.0, page_size: int = SYNC_PAGE_SIZE):
+        self.db = db
+        self.versions = versions
+        self.settle = settle
+        self.poll_interval = poll_interval
+        self.page_size = page_size
+
+    def _upper(self) -> datetime:
+        return datetime.now(timezone.utc) - timedelta(seconds=self.settle)
+
+    # What a changes() call made now is sure to cover: its window ends at a whole
+    # second (see last_id_before), so a write later in the current second is not in it
+    def _checked(self) -> datetime:
+        return self._upper().replace(microsecond=0)
+
+    async def _products(self, product_ids: List[str]) -> List[dict]:
+        if not product_ids:
+            return []
+        return await self.db.products.find({"product_id": {"$in": product_ids}}, {"_id": 0}).to_list(None)
+
+    # Full catalog plus the token to ask for changes from
+    async def snapshot(self) -> dict:
+        token = last_id_before(self._upper())
+        products = await self.db.products.find({}, {"_id": 0}).to_list(None)
+        return {"token": str(token), "more": False, "products": products, "sales": [], "stock_log": []}
+
+    # Feed documents after `since`, at most page_size per collection; `more` says whether
+    # the next token has more waiting right away
+    async def changes(self, since: ObjectId) -> dict:
+        upper = self._upper()
+        window = {"$gt": since, "$lte": last_id_before(upper)}
+        if window["$lte"] <= since:
+            return {"token": str(since), "more": False, "products": [], "sales": [], "stock_log": []}
+
+        found: Dict[str, List[dict]] = {}
+        for name in FEED:
+            found[name] = await self.db.db[name].find({"_id": window}).sort("_id", 1).limit(self.page_size + 1).to_list(None)
+
+        # If a collection had more than a page, stop every collection at the same _id
+        truncated = [docs[self.page_size - 1]["_id"] for docs in found.values() if len(docs) > self.page_size]
+        if truncated:
+            cut = min(truncated)
+            found = {name: [doc for doc in docs if doc["_id"] <= cut] for name, docs in found.items()}
+            token = cut
+        else:
+            token = window["$lte"]
+
+        product_ids = list(dict.fromkeys(entry["product_id"] for entry in found["stock_log"]))
+        return {
+            "token": str(token),
+            "more": bool(truncated),
+            "products": await self._products(product_ids),
+            "sales": found["sales"],
+            "stock_log": [with_utc_date(entry) for entry in found["stock_log"]],
+        }
+
+    # True once something may have been written that the last delta could not include.
+    # Reads the shared version counters, so idle polling does not query the feed itself.
+    async def _may_have_changes(self, checked_until: datetime) -> bool:
+        counters = await self.versions.current(WATCHED)
+        modified = [c["modified_at"].replace(tzinfo=timezone.utc) for c in counters if c["modified_at"] is not None]
+        return bool(modified) and max(modified) >= checked_until - timedelta(seconds=self.settle)
+
+    # Long-poll: return as soon as there are changes, or an empty delta after `timeout` seconds
+    async def wait(self, since: ObjectId, timeout: float) -> dict:
+        deadline = time.monotonic() + timeout
+        checked_until = self._checked()
+        delta = await self.changes(since)
+        while not (delta["stock_log"] or delta["sales"]) and time.monotonic() < deadline:
+            await asyncio.sleep(min(self.poll_interval, max(deadline - time.monotonic(), 0)))
+            if await self._may_have_changes(checked_until):
+                checked_until = self._checked()
+                delta = await self.changes(since)
+        return delta
+
+    # Server-Sent Events: one `changes` event per non-empty delta, with the token as the
+    # event id so a reconnecting EventSource resumes through Last-Event-ID
+    async def stream(self, since: Optional[ObjectId], heartbeat: float = 15.0) -> AsyncIterator[bytes]:
+        if since is None:
+            snapshot = await self.snapshot()
+            since = ObjectId(snapshot["token"])
+            yield event("snapshot", snapshot)
+        while True:
+            delta = await self.wait(since, heartbeat)
+            since = ObjectId(delta["token"])
+            if delta["stock_log"] or delta["sales"]:
+                yield event("changes", delta)
+            else:
+                yield b": keep-alive\n\n"
+
+
+def event(name: str, payload: dict) -> bytes:
+    return b"id: " + payload["token"].encode() + b"\nevent: " + name.encode() + b"\ndata: " + dumps(payload) + b"\n\n"
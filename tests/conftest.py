@@ -0,0 +1,148 @@
+import os
+import sys
+from types import SimpleNamespace
+import mongomock
+import pytest
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+# Async stand-ins for PyMongo's async cursor and collection over mongomock, covering the
+# calls the modules under test make. Sessions are accepted and ignored.
+class AsyncCursor:
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def sort(self, *args, **kwargs):
+        self.cursor = self.cursor.sort(*args, **kwargs)
+        return self
+
+    def limit(self, count):
+        self.cursor = self.cursor.limit(count)
+        return self
+
+    def skip(self, count):
+        self.cursor = self.cursor.skip(count)
+        return self
+
+    async def to_list(self, length=None):
+        documents = list(self.cursor)
+        return documents if length is None else documents[:length]
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for document in self.cursor:
+            yield document
+
+
+class AsyncCollection:
+    def __init__(self, collection):
+        self.collection = collection
+
+    def find(self, *args, session=None, batch_size=None, **kwargs):
+        return AsyncCursor(self.collection.find(*args, **kwargs))
+
+    async def aggregate(self, pipeline, session=None, **kwargs):
+        return AsyncCursor(iter(self._aggregate(list(pipeline))))
+
+    # mongomock runs neither $unionWith nor $merge: union in the other collection's results
+    # through a scratch collection, and write the $merge output here
+    def _aggregate(self, pipeline):
+        merge = pipeline.pop()["$merge"] if pipeline and "$merge" in pipeline[-1] else None
+        for index, stage in enumerate(pipeline):
+            if "$unionWith" in stage:
+                union = stage["$unionWith"]
+                other = AsyncCollection(self.collection.database[union["coll"]])
+                documents = list(self.collection.aggregate(pipeline[:index])) + other._aggregate(list(union.get("pipeline", [])))
+                scratch = self.collection.database["_union_" + self.collection.name]
+                scratch.drop()
+                if documents:
+                    scratch.insert_many(documents)
+                documents = AsyncCollection(scratch)._aggregate(pipeline[index + 1:])
+                scratch.drop()
+                break
+        else:
+            documents = list(self.collection.aggregate(pipeline))
+        if merge is None:
+            return documents
+        target = self.collection.database[merge["into"]]
+        for document in documents:
+            target.replace_one({"_id": document["_id"]}, document, upsert=True)
+        return []
+
+    async def options(self, session=None):
+        return {}
+
+    # mongomock's own bulk_write does not accept the operations of the installed PyMongo
+    async def bulk_write(self, operations, ordered=True, session=None):
+        matched = modified = inserted = upserted = 0
+        errors = []
+        for index, operation in enumerate(operations):
+            try:
+                if isinstance(operation, InsertOne):
+                    self.collection.insert_one(operation._doc)
+                    inserted += 1
+                elif isinstance(operation, UpdateOne):
+                    result = self.collection.update_one(operation._filter, operation._doc, upsert=bool(operation._upsert))
+                    matched += result.matched_count
+                    modified += result.modified_count
+                    upserted += result.upserted_id is not None
+                else:
+                    raise NotImplementedError(type(operation).__name__)
+            except DuplicateKeyError as e:
+                errors.append({"index": index, "code": 11000, "errmsg": str(e)})
+                if ordered:
+                    break
+        if errors:
+            raise BulkWriteError({
+                "writeErrors": errors, "nInserted": inserted, "nMatched": matched, "nModified": modified, "nUpserted": upserted,
+            })
+        return SimpleNamespace(matched_count=matched, modified_count=modified, inserted_count=inserted, upserted_count=upserted)
+
+    def __getattr__(self, name):
+        method = getattr(self.collection, name)
+
+        async def call(*args, session=None, **kwargs):
+            return method(*args, **kwargs)
+        return call
+
+
+class AsyncDatabase:
+    def __init__(self, database):
+        self.database = database
+        self.collections = {}
+
+    # The same wrapper each time, so a test can patch one collection's methods
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = AsyncCollection(self.database[name])
+        return self.collections[name]
+
+    async def list_collection_names(self, filter=None, session=None):
+        return self.database.list_collection_names(filter=filter)
+
+    def __getattr__(self, name):
+        return self[name]
+
+
+# Shaped like database.Database after connect()
+class FakeDatabase:
+    def __init__(self):
+        self.raw = mongomock.MongoClient()["stock_management"]
+        self.client = None
+        self.db = AsyncDatabase(self.raw)
+        self.products = self.db.products
+        self.sales = self.db.sales
+        self.customers = self.db.customers
+        self.installations = self.db.installations
+        self.returns = self.db.returns
+        self.stock_log = self.db.stock_log
+
+
+@pytest.fixture
+def db():
+    return FakeDatabase()
@@ -0,0 +1,62 @@
+import asyncio
+import pytest
+from admission import Lane, Overloaded
+
+
+def test_full_queue_is_shed_with_429():
+    async def scenario():
+        lane = Lane("write", limit=1, queue_size=1, max_wait=1.0)
+        await lane.acquire()
+        waiting = asyncio.create_task(lane.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(Overloaded) as raised:
+            await lane.acquire()
+        lane.release(0.01)
+        await waiting
+        return raised.value
+    shed = asyncio.run(scenario())
+    assert (shed.status_code, shed.reason) == (429, "queue_full")
+
+
+def test_expected_wait_past_max_wait_is_shed_with_503():
+    async def scenario():
+        lane = Lane("write", limit=1, queue_size=10, max_wait=0.5)
+        lane.service_seconds = 2.0
+        await lane.acquire()
+        with pytest.raises(Overloaded) as raised:
+            await lane.acquire()
+        return raised.value
+    shed = asyncio.run(scenario())
+    assert (shed.status_code, shed.reason, shed.retry_after) == (503, "latency", 2)
+
+
+def test_waiter_past_max_wait_times_out_with_503():
+    async def scenario():
+        lane = Lane("write", limit=1, queue_size=10, max_wait=0.05)
+        await lane.acquire()
+        with pytest.raises(Overloaded) as raised:
+            await lane.acquire()
+        return lane, raised.value
+    lane, shed = asyncio.run(scenario())
+    assert (shed.status_code, shed.reason) == (503, "timeout")
+    assert lane.running == 1
+    assert not lane.waiters
+
+
+def test_release_hands_the_slot_to_the_next_live_waiter():
+    async def scenario():
+        lane = Lane("write", limit=1, queue_size=10, max_wait=1.0)
+        await lane.acquire()
+        gone = asyncio.create_task(lane.acquire())
+        waiting = asyncio.create_task(lane.acquire())
+        await asyncio.sleep(0)
+        gone.cancel()  # The client went away while queued
+        await asyncio.sleep(0)
+        lane.release(0.01)
+        await waiting
+        assert lane.running == 1
+        lane.release(0.01)
+        return lane
+    lane = asyncio.run(scenario())
+    assert lane.running == 0
+    assert not lane.waiters
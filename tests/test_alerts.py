@@ -0,0 +1,55 @@
+import asyncio
+import pytest
+from alerts import ThresholdMonitor
+
+
+class RecordingNotifier:
+    def __init__(self):
+        self.sent = []
+
+    def notify(self, subject, body):
+        self.sent.append((subject, body))
+
+
+@pytest.fixture
+def monitor(db):
+    db.raw.products.insert_one({"product_id": "p1", "name": "Fan", "stock_quantity": 5, "threshold": 10})
+    return ThresholdMonitor(db, RecordingNotifier(), digest_window=0)
+
+
+# Evaluates the stored document after a write, or `stale` overrides of it
+def evaluate(monitor, stock=None, **stale):
+    if stock is not None:
+        monitor.db.raw.products.update_one({"product_id": "p1"}, {"$set": {"stock_quantity": stock}})
+    product = dict(monitor.db.raw.products.find_one({"product_id": "p1"}), **stale)
+    asyncio.run(monitor.evaluate([product]))
+    return product
+
+
+def alerted(monitor):
+    return monitor.db.raw.products.find_one({"product_id": "p1"})["low_stock_alert"]
+
+
+def test_alert_fires_once_until_stock_recovers(monitor):
+    evaluate(monitor)
+    evaluate(monitor, 4, low_stock_alert=False)
+    assert monitor.fired == 1
+    monitor.flush()
+    assert [subject for subject, _ in monitor.notifier.sent] == ["Low Stock Alert: 1 product(s)"]
+    assert "Fan (p1)" in monitor.notifier.sent[0][1]
+
+    # Within the hysteresis band the alert stays fired
+    evaluate(monitor, 11)
+    assert alerted(monitor)
+    evaluate(monitor, 12)
+    assert not alerted(monitor)
+
+
+def test_rearm_skipped_when_stock_fell_again_since_the_read(monitor):
+    evaluate(monitor)
+    # The document says 20, but a sale has since taken the stored stock back to 5
+    product = evaluate(monitor, stock_quantity=20)
+    assert alerted(monitor)
+    assert product["low_stock_alert"] is True
+    evaluate(monitor)
+    assert monitor.fired == 1
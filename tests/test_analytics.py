@@ -0,0 +1,66 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from analytics import (
+    MANAGER_REVENUE_DAILY, SALES_DAILY, STOCK_MOVEMENTS_DAILY, rebuild_rollups, stock_turnover, track_sales,
+    track_stock_movements,
+)
+
+LATE = datetime(2024, 3, 1, 23, 30, tzinfo=timezone.utc)
+
+
+def sale(when, quantity=2):
+    return {
+        "manager_name": "m", "total_amount": 10.0 * quantity, "date_added": when,
+        "products": [{"product_name": "Fan", "quantity": quantity, "amount": 10.0 * quantity}],
+    }
+
+
+def log(when, action="sale", quantity=-1, remaining=5, name="Fan"):
+    return {
+        "date": when, "action": action, "product_id": "p1", "product_name": name,
+        "quantity_changed": quantity, "remaining_stock": remaining,
+    }
+
+
+# Each rollup as sorted rows; counters never incremented read as 0, as the reports treat them
+def rollups(db):
+    return {
+        name: sorted(
+            (sorted(doc["_id"].items()), *(doc.get(field, 0) for field in fields)) for doc in db.raw[name].find()
+        )
+        for name, fields in (
+            (SALES_DAILY, ("quantity", "revenue", "lines")),
+            (MANAGER_REVENUE_DAILY, ("revenue", "orders")),
+            (STOCK_MOVEMENTS_DAILY, ("sold", "returned", "closing_stock")),
+        )
+    }
+
+
+def test_sales_and_movements_share_the_utc_day(db):
+    asyncio.run(track_sales(db, [sale(LATE)]))
+    asyncio.run(track_stock_movements(db, [log(LATE)]))
+    assert db.raw[SALES_DAILY].find_one()["_id"]["day"] == "2024-03-01"
+    assert db.raw[STOCK_MOVEMENTS_DAILY].find_one()["_id"]["day"] == "2024-03-01"
+
+
+def test_rebuild_matches_the_incremental_rollups(db):
+    sales = [sale(LATE), sale(LATE + timedelta(hours=1), 1)]
+    entries = [log(LATE, remaining=8), log(LATE, "return", 1, 9), log(LATE + timedelta(hours=1), remaining=7)]
+    # MongoDB hands dates back as naive UTC
+    db.raw.sales.insert_many([dict(s, date_added=s["date_added"].replace(tzinfo=None)) for s in sales])
+    db.raw.stock_log.insert_many([dict(e, date=e["date"].replace(tzinfo=None)) for e in entries])
+    asyncio.run(track_sales(db, sales))
+    asyncio.run(track_stock_movements(db, entries))
+    incremental = rollups(db)
+
+    assert asyncio.run(rebuild_rollups(db)) == {"sales": None, "stock_log": None}
+    assert rollups(db) == incremental
+    assert len(incremental[SALES_DAILY]) == 2
+
+
+def test_turnover_names_products_by_their_newest_day(db):
+    entries = [log(LATE + timedelta(days=day), name=f"Fan v{day}", remaining=4) for day in (2, 0, 1)]
+    asyncio.run(track_stock_movements(db, entries))
+    [row] = asyncio.run(stock_turnover(db, None, None))
+    assert row["product_name"] == "Fan v2"
+    assert row["units_out"] == 3
@@ -0,0 +1,69 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+import pytest
+from archive import ARCHIVE_LEASE, Archive
+
+pytest.importorskip("pyarrow")
+
+
+@pytest.fixture
+def old_sales(db):
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    db.raw.sales.insert_many([
+        {"customer_name": "Bob", "total_amount": float(i), "date_added": now - timedelta(days=500 - 20 * i)}
+        for i in range(6)
+    ] + [{"customer_name": "Amy", "total_amount": 9.0, "date_added": now}])
+    return db
+
+
+def test_old_months_move_to_parquet_and_stay_readable(old_sales, tmp_path):
+    archive = Archive(old_sales, str(tmp_path), horizon_days=365)
+    moved = asyncio.run(archive.run())
+    assert moved == 6
+    assert old_sales.raw.sales.count_documents({}) == 1
+    assert archive.covers("sales", None)
+    archived = asyncio.run(archive.find("sales", {"customer_name": "Bob"}))
+    assert sorted(doc["total_amount"] for doc in archived) == [0.0, 1.0, 2.0, 3.0, 4.0, 5.0]
+    assert old_sales.raw[ARCHIVE_LEASE].count_documents({}) == 0
+
+
+def test_lease_held_elsewhere_skips_the_run(old_sales, tmp_path):
+    old_sales.raw[ARCHIVE_LEASE].insert_one({
+        "_id": "archive", "owner": "other:1", "lease_until": datetime.now(timezone.utc) + timedelta(hours=1),
+    })
+    assert asyncio.run(Archive(old_sales, str(tmp_path), horizon_days=365).run()) == 0
+    assert old_sales.raw.sales.count_documents({}) == 7
+
+
+def test_run_stops_before_deleting_once_the_lease_is_taken_over(old_sales, tmp_path, monkeypatch, caplog):
+    archive = Archive(old_sales, str(tmp_path), horizon_days=365)
+    write_part = archive._write_part
+
+    # The part outlives the lease and another worker claims it meanwhile
+    def slow_write_part(*args):
+        old_sales.raw[ARCHIVE_LEASE].update_one({"_id": "archive"}, {"$set": {
+            "owner": "other:1", "lease_until": datetime.now(timezone.utc) + timedelta(hours=1),
+        }})
+        return write_part(*args)
+    monkeypatch.setattr(archive, "_write_part", slow_write_part)
+
+    assert asyncio.run(archive.run()) == 0
+    assert old_sales.raw.sales.count_documents({}) == 7
+    assert old_sales.raw[ARCHIVE_LEASE].find_one({"_id": "archive"})["owner"] == "other:1"
+    assert "taken over" in caplog.text
+
+
+def test_lease_is_renewed_while_a_run_lasts(old_sales, tmp_path, monkeypatch):
+    archive = Archive(old_sales, str(tmp_path), horizon_days=365, lease=60)
+    renewals = []
+    take_lease = archive._take_lease
+
+    async def counting_take_lease():
+        renewals.append(1)
+        return await take_lease()
+    monkeypatch.setattr(archive, "_take_lease", counting_take_lease)
+    asyncio.run(archive.run())
+    months = len({part["month"] for part in archive.parts("sales")})
+    assert months > 1
+    # The claim, then before each month's part, its delete and the check for more
+    assert len(renewals) >= 1 + 3 * months
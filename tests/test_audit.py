@@ -0,0 +1,113 @@
+import asyncio
+from datetime import datetime, timezone
+import pytest
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+import audit
+from analytics import STOCK_MOVEMENTS_DAILY
+from audit import StockLogWriteError, StockLogWriter
+
+
+def entry(product_id="p1", quantity=-1):
+    return {
+        "_id": ObjectId(),
+        "date": datetime.now(timezone.utc),
+        "action": "sale",
+        "product_id": product_id,
+        "product_name": product_id,
+        "quantity_changed": quantity,
+        "remaining_stock": 10,
+        "performed_by": "tester",
+    }
+
+
+def sold(db, product_id):
+    return sum(bucket["sold"] for bucket in db.raw[STOCK_MOVEMENTS_DAILY].find({"_id.product_id": product_id}))
+
+
+# Writes every entry except the ones at `fail` (and entries already stored), then reports
+# those the way MongoDB does for an unordered insert_many
+def failing_insert_many(db, fail):
+    async def insert_many(entries, ordered=True, session=None):
+        errors = []
+        for index, document in enumerate(entries):
+            if index in fail:
+                errors.append({"index": index, "code": 121, "errmsg": "Document failed validation"})
+            elif db.raw.stock_log.find_one({"_id": document["_id"]}) is not None:
+                errors.append({"index": index, "code": 11000, "errmsg": "E11000 duplicate key error"})
+            else:
+                db.raw.stock_log.insert_one(document)
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, "nInserted": len(entries) - len(errors)})
+    return insert_many
+
+
+def test_partial_failure_keeps_only_unwritten_entries(db, monkeypatch):
+    writer = StockLogWriter(db, flush_interval=10)
+    entries = [entry("p1"), entry("p2"), entry("p3")]
+    monkeypatch.setattr(db.stock_log, "insert_many", failing_insert_many(db, fail={1}), raising=False)
+    asyncio.run(writer.write(entries))
+    with pytest.raises(StockLogWriteError) as raised:
+        asyncio.run(writer.flush())
+    assert raised.value.entries == [entries[1]]
+    assert writer.buffer == [entries[1]]
+    assert writer.written == 2
+    assert (sold(db, "p1"), sold(db, "p2"), sold(db, "p3")) == (1, 0, 1)
+
+
+def test_retry_counts_entries_the_failed_attempt_wrote(db, monkeypatch):
+    writer = StockLogWriter(db, flush_interval=10)
+    entries = [entry("p1"), entry("p2")]
+    monkeypatch.setattr(db.stock_log, "insert_many", failing_insert_many(db, fail={1}), raising=False)
+    asyncio.run(writer.write(entries))
+    with pytest.raises(StockLogWriteError):
+        asyncio.run(writer.flush())
+
+    # The entry at index 1 did reach MongoDB before the retry, e.g. a timeout after the write
+    db.raw.stock_log.insert_one(entries[1])
+    monkeypatch.setattr(db.stock_log, "insert_many", failing_insert_many(db, fail=set()), raising=False)
+    asyncio.run(writer.flush())
+    assert writer.buffer == []
+    assert writer.written == 2
+    assert db.raw.stock_log.count_documents({}) == 2
+    assert (sold(db, "p1"), sold(db, "p2")) == (1, 1)
+
+
+def test_failed_flush_keeps_entries_ahead_of_newer_ones(db, monkeypatch):
+    writer = StockLogWriter(db, flush_interval=10)
+    older, newer = entry("p1"), entry("p2")
+
+    async def insert_many(entries, ordered=True, session=None):
+        raise ConnectionError("connection reset")
+    monkeypatch.setattr(db.stock_log, "insert_many", insert_many, raising=False)
+    asyncio.run(writer.write([older]))
+    with pytest.raises(ConnectionError):
+        asyncio.run(writer.flush())
+    asyncio.run(writer.write([newer]))
+    assert writer.buffer == [older, newer]
+    assert writer.written == 0
+
+
+def test_rollup_failure_is_logged_not_retried(db, monkeypatch, caplog):
+    writer = StockLogWriter(db)
+
+    async def track_stock_movements(db, entries):
+        raise ConnectionError("connection reset")
+    monkeypatch.setattr(audit, "track_stock_movements", track_stock_movements)
+    asyncio.run(writer.write([entry("p1")]))
+    assert db.raw.stock_log.count_documents({}) == 1
+    assert writer.buffer == []
+    assert writer.written == 1
+    assert "Could not add 1 stock_log entries to the daily rollups" in caplog.text
+
+
+def test_full_buffer_flush_failure_does_not_fail_the_write(db, monkeypatch, caplog):
+    writer = StockLogWriter(db, flush_interval=10, max_batch=2)
+
+    async def insert_many(entries, ordered=True, session=None):
+        raise ConnectionError("connection reset")
+    monkeypatch.setattr(db.stock_log, "insert_many", insert_many, raising=False)
+    entries = [entry("p1"), entry("p2")]
+    asyncio.run(writer.write(entries))
+    assert writer.buffer == entries
+    assert "Could not flush 2 stock_log entries" in caplog.text
@@ -0,0 +1,116 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+from audit import StockLogWriter
+from batch_orders import RETURN_ORDERS, SALE_ORDERS, OrderKind, UndoFailed, record_orders
+from customers import CustomerResolver
+from stock import StockEngine
+
+
+def sale(products, quantities, name="Bob"):
+    return SimpleNamespace(
+        customer=SimpleNamespace(name=name, number="1", address="a", manager_name="m"),
+        date="2024-01-01",
+        total_amount=1.0,
+        product_names=products,
+        quantities=quantities,
+        amounts=[1.0] * len(products),
+        remarks=["r"] * len(products),
+    )
+
+
+def return_request(products, quantities, name="Bob"):
+    return SimpleNamespace(
+        staff_name="s", manager_name="m", customer_name=name, customer_number="1", customer_address="a",
+        return_date="d", products=products, quantities=quantities, remarks="r",
+    )
+
+
+def stock_of(db, name):
+    return db.raw.products.find_one({"name": name})["stock_quantity"]
+
+
+@pytest.fixture
+def parts(db):
+    db.raw.products.insert_many([
+        {"product_id": "p1", "name": "Fan", "stock_quantity": 5},
+        {"product_id": "p2", "name": "Lamp", "stock_quantity": 1},
+    ])
+    return db, StockEngine(db), StockLogWriter(db), CustomerResolver(db)
+
+
+def test_order_kinds_must_say_how_to_build_records():
+    with pytest.raises(TypeError):
+        OrderKind()
+
+
+def test_orders_are_checked_in_sequence_and_recorded_whole(parts):
+    db, stock, writer, customers = parts
+    orders = [sale(["Fan", "Lamp"], [2, 1]), sale(["Fan", "Lamp"], [1, 1]), sale(["Fan"], [3])]
+    results = asyncio.run(record_orders(db, stock, writer, customers, SALE_ORDERS, orders))
+    assert [result["status"] for result in results] == ["ok", "error", "ok"]
+    assert "Lamp" in results[1]["error"]
+    assert [line["remaining_stock"] for line in results[2]["products"]] == [0]
+    assert (stock_of(db, "Fan"), stock_of(db, "Lamp")) == (0, 0)
+    assert db.raw.sales.count_documents({}) == 2
+    assert db.raw.stock_log.count_documents({}) == 3
+
+
+def test_order_mismatch_is_rejected_without_touching_stock(parts):
+    db, stock, writer, customers = parts
+    order = sale(["Fan", "Lamp"], [1])
+    [result] = asyncio.run(record_orders(db, stock, writer, customers, SALE_ORDERS, [order]))
+    assert result["status"] == "error"
+    assert stock_of(db, "Fan") == 5
+
+
+# A return of Fan and Lamp where Lamp is deleted after the stock check: the Fan return
+# has to be taken back. `undo_races` run before each try at that, e.g. a sale of the Fan.
+def race_return(db, stock, monkeypatch, undo_races):
+    current = stock.current
+
+    async def current_then_delete(names):
+        found = await current(names)
+        db.raw.products.delete_one({"name": "Lamp"})
+        return found
+    monkeypatch.setattr(stock, "current", current_then_delete)
+
+    apply_independent = stock.apply_independent
+    calls = []
+
+    async def apply_with_races(totals):
+        if 0 < len(calls) <= len(undo_races):
+            undo_races[len(calls) - 1]()
+        calls.append(totals)
+        return await apply_independent(totals)
+    monkeypatch.setattr(stock, "apply_independent", apply_with_races)
+    return calls
+
+
+def set_fan(db, quantity):
+    return lambda: db.raw.products.update_one({"name": "Fan"}, {"$set": {"stock_quantity": quantity}})
+
+
+def test_undo_that_keeps_failing_fails_the_batch(parts, monkeypatch, caplog):
+    db, stock, writer, customers = parts
+    asyncio.run(customers.resolve("Bob", "1", "a"))
+    calls = race_return(db, stock, monkeypatch, [set_fan(db, 0)] * 3)
+    with pytest.raises(UndoFailed) as raised:
+        asyncio.run(record_orders(db, stock, writer, customers, RETURN_ORDERS, [return_request(["Fan", "Lamp"], [2, 1])]))
+    assert raised.value.totals == {"Fan": -2}
+    assert len(calls) == 4
+    assert db.raw.returns.count_documents({}) == 0
+    assert "could not undo" in caplog.text
+
+
+def test_undo_is_retried(parts, monkeypatch):
+    db, stock, writer, customers = parts
+    asyncio.run(customers.resolve("Bob", "1", "a"))
+    orders = [return_request(["Fan", "Lamp"], [2, 1]), return_request(["Fan"], [1])]
+    # A sale leaves one Fan, then a restock lets the second try through
+    calls = race_return(db, stock, monkeypatch, [set_fan(db, 1), set_fan(db, 5)])
+    results = asyncio.run(record_orders(db, stock, writer, customers, RETURN_ORDERS, orders))
+    assert [result["status"] for result in results] == ["error", "ok"]
+    assert len(calls) == 3
+    assert stock_of(db, "Fan") == 3
+    assert results[1]["products"][0]["remaining_stock"] == 3
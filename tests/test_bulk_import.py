@@ -0,0 +1,79 @@
+import asyncio
+import csv
+from io import BytesIO
+import pytest
+from fastapi import HTTPException, UploadFile
+from pydantic import BaseModel
+from audit import StockLogWriter
+from bulk_import import ImportReport, MAX_REPORTED_ERRORS, import_stock_adjustments, read_batches
+from stock import StockEngine
+
+
+class Adjustment(BaseModel):
+    product_name: str
+    quantity: int
+    updated_by: str
+
+
+def upload(text: str, filename="adjustments.csv") -> UploadFile:
+    return UploadFile(file=BytesIO(text.encode()), filename=filename)
+
+
+def run_import(db, text: str, fmt="csv") -> dict:
+    stock, writer = StockEngine(db), StockLogWriter(db)
+    report = ImportReport("stock-adjustments")
+
+    async def run():
+        async for batch in read_batches(upload(text), fmt, Adjustment, report):
+            await import_stock_adjustments(db, stock, writer, None, batch, report)
+    asyncio.run(run())
+    return report.summary()
+
+
+@pytest.fixture
+def products(db):
+    db.raw.products.insert_many([
+        {"product_id": "p1", "name": "Fan", "stock_quantity": 5},
+        {"product_id": "p2", "name": "Lamp", "stock_quantity": 1},
+    ])
+    return db
+
+
+def test_rows_are_checked_in_file_order_and_errors_listed_by_row(products):
+    summary = run_import(products, "product_name,quantity,updated_by\nFan,-3,a\nFan,-3,a\nLamp,x,a\nLamp,2,a\nHeater,1,a\n")
+    assert (summary["rows"], summary["applied"], summary["error_count"]) == (5, 2, 3)
+    assert [error["row"] for error in summary["errors"]] == [2, 3, 5]
+    assert "Not enough stock for Fan" in summary["errors"][0]["error"]
+    assert products.raw.products.find_one({"name": "Fan"})["stock_quantity"] == 2
+    assert products.raw.products.find_one({"name": "Lamp"})["stock_quantity"] == 3
+    assert products.raw.stock_log.count_documents({}) == 2
+
+
+def test_unreadable_csv_row_is_reported_not_raised(products):
+    oversized = "x" * (csv.field_size_limit() + 1)
+    summary = run_import(products, f"product_name,quantity,updated_by\nFan,-1,a\n{oversized},1,a\nFan,-1,a\n")
+    assert (summary["applied"], summary["error_count"]) == (2, 1)
+    assert summary["errors"][0]["row"] == 2
+    assert products.raw.products.find_one({"name": "Fan"})["stock_quantity"] == 3
+
+
+def test_unreadable_csv_header_is_rejected(products):
+    oversized = "x" * (csv.field_size_limit() + 1)
+    with pytest.raises(HTTPException) as raised:
+        run_import(products, f"{oversized}\nFan,-1,a\n")
+    assert raised.value.status_code == 400
+
+
+def test_ndjson_rows(products):
+    summary = run_import(products, '{"product_name": "Fan", "quantity": 1, "updated_by": "a"}\nnot json\n', fmt="ndjson")
+    assert (summary["applied"], summary["error_count"]) == (1, 1)
+    assert products.raw.products.find_one({"name": "Fan"})["stock_quantity"] == 6
+
+
+def test_listed_errors_keep_the_lowest_rows():
+    report = ImportReport("products")
+    for row in range(MAX_REPORTED_ERRORS + 5, 0, -1):
+        report.error(row, "bad")
+    summary = report.summary()
+    assert summary["error_count"] == MAX_REPORTED_ERRORS + 5
+    assert [error["row"] for error in summary["errors"]] == list(range(1, MAX_REPORTED_ERRORS + 1))
@@ -0,0 +1,80 @@
+import asyncio
+import pytest
+from catalog import CatalogCache
+
+
+@pytest.fixture
+def products(db):
+    db.raw.products.insert_many([
+        {"product_id": "p1", "name": "Fan", "stock_quantity": 5},
+        {"product_id": "p2", "name": "Lamp", "stock_quantity": 1},
+        {"product_id": "p3", "name": "Bulb", "stock_quantity": 9},
+    ])
+    return db
+
+
+def counting_find(db, monkeypatch):
+    queries = []
+    find = db.products.find
+
+    def recording_find(*args, **kwargs):
+        queries.append(args[0] if args else {})
+        return find(*args, **kwargs)
+    monkeypatch.setattr(db.products, "find", recording_find)
+    return queries
+
+
+def test_misses_are_fetched_together_then_served_from_memory(products, monkeypatch):
+    cache = CatalogCache(products)
+    queries = counting_find(products, monkeypatch)
+    found = asyncio.run(cache.get_many(["Fan", "Lamp", "Heater"]))
+    assert set(found) == {"Fan", "Lamp"}
+    assert queries == [{"name": {"$in": ["Fan", "Lamp", "Heater"]}}]
+
+    asyncio.run(cache.get_many(["Fan", "Lamp"]))
+    assert len(queries) == 1
+    assert (cache.hits, cache.misses) == (2, 3)
+    assert asyncio.run(cache.get_by_product_id("p2"))["name"] == "Lamp"
+    assert cache.hits == 3
+
+
+def test_written_documents_are_served_as_put(products):
+    cache = CatalogCache(products)
+    asyncio.run(cache.get("Fan"))
+    cache.put({"product_id": "p1", "name": "Fan", "stock_quantity": 2})
+    assert asyncio.run(cache.get("Fan"))["stock_quantity"] == 2
+    cache.invalidate("Fan")
+    assert cache.peek("Fan") is None
+    assert asyncio.run(cache.get("Fan"))["stock_quantity"] == 5
+
+
+def test_entries_expire(products):
+    cache = CatalogCache(products, ttl=0)
+    asyncio.run(cache.get("Fan"))
+    products.raw.products.update_one({"name": "Fan"}, {"$set": {"stock_quantity": 0}})
+    assert asyncio.run(cache.get("Fan"))["stock_quantity"] == 0
+    assert cache.hits == 0
+
+
+def test_whole_catalog_is_one_query_until_an_eviction(products, monkeypatch):
+    cache = CatalogCache(products, max_size=3)
+    queries = counting_find(products, monkeypatch)
+    assert len(asyncio.run(cache.all())) == 3
+    assert len(asyncio.run(cache.all())) == 3
+    assert len(queries) == 1
+
+    cache.put({"product_id": "p4", "name": "Heater", "stock_quantity": 1})
+    assert "Fan" not in cache.entries
+    assert "p1" not in cache.names_by_id
+    asyncio.run(cache.all())
+    assert len(queries) == 2
+
+
+def test_watching_gives_up_without_change_streams(products):
+    async def run():
+        cache = CatalogCache(products)
+        cache.start_watching()
+        await asyncio.sleep(0.01)
+        assert not cache.stats()["watching_changes"]
+        await cache.stop_watching()
+    asyncio.run(run())
@@ -0,0 +1,61 @@
+import asyncio
+from bson import ObjectId
+from pymongo import ASCENDING
+from customers import CustomerResolver, backfill_normalized_names, customer_history, search_customers
+
+
+def test_repeat_customers_resolve_from_memory(db):
+    resolver = CustomerResolver(db)
+    first = asyncio.run(resolver.resolve("Bob", "1", "a"))
+    again = asyncio.run(resolver.resolve("Bob", "1", "elsewhere"))
+    assert again is first
+    assert db.raw.customers.count_documents({}) == 1
+    assert (resolver.hits, resolver.misses) == (1, 1)
+
+
+def test_resolve_many_creates_only_the_missing(db):
+    db.raw.customers.create_index([("name", ASCENDING), ("number", ASCENDING)], unique=True)
+    db.raw.customers.insert_one({"name": "Amy", "number": "2", "address": "old"})
+    resolver = CustomerResolver(db)
+    found = asyncio.run(resolver.resolve_many({("Amy", "2"): "new", ("Bob", "1"): "a"}))
+    assert set(found) == {("Amy", "2"), ("Bob", "1")}
+    assert found[("Amy", "2")]["address"] == "old"
+    assert db.raw.customers.count_documents({}) == 2
+    assert asyncio.run(resolver.find_many([("Bob", "1"), ("Eve", "3")])).keys() == {("Bob", "1")}
+
+
+def test_lru_evicts_the_least_recently_used(db):
+    resolver = CustomerResolver(db, max_size=2)
+    for name in ("Amy", "Bob", "Amy", "Eve"):
+        asyncio.run(resolver.resolve(name, "1", "a"))
+    assert list(resolver.entries) == [("Amy", "1"), ("Eve", "1")]
+
+
+def test_search_is_a_case_insensitive_prefix(db):
+    db.raw.customers.insert_many([
+        {"name": "Bob  Smith", "number": "1"}, {"name": "bobby", "number": "2"}, {"name": "Rob", "number": "3"},
+    ])
+    asyncio.run(backfill_normalized_names(db, batch_size=2))
+    found = asyncio.run(search_customers(db, "BOB ", None, 10))
+    assert [customer["number"] for customer in found] == ["1", "2"]
+    assert [c["number"] for c in asyncio.run(search_customers(db, "bob", "2", 10))] == ["2"]
+
+
+def test_history_pages_through_all_record_kinds(db):
+    resolver = CustomerResolver(db)
+    bob = asyncio.run(resolver.resolve("Bob", "1", "a"))
+    ids = [ObjectId() for _ in range(4)]
+    db.raw.sales.insert_many([{"_id": ids[0], "customer_id": bob["_id"]}, {"_id": ids[3], "customer_id": bob["_id"]}])
+    # Written before records carried customer_id
+    db.raw.installations.insert_one({"_id": ids[1], "customer_name": "Bob", "customer_number": "1"})
+    db.raw.returns.insert_many([
+        {"_id": ids[2], "customer_id": bob["_id"]}, {"customer_id": ObjectId(), "customer_name": "Bob", "customer_number": "1"},
+    ])
+
+    page, after = asyncio.run(customer_history(db, [bob], None, 3))
+    assert [(doc["_id"], doc["action"]) for doc in page] == [
+        (ids[0], "Sale"), (ids[1], "Installation"), (ids[2], "Return"),
+    ]
+    page, after = asyncio.run(customer_history(db, [bob], ObjectId(after), 3))
+    assert [doc["_id"] for doc in page] == [ids[3]]
+    assert after is None
@@ -0,0 +1,96 @@
+import asyncio
+import pytest
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+from idempotency import FAILED_RESPONSE, IDEMPOTENCY_KEYS, IdempotencyStore
+
+
+class Endpoint:
+    def __init__(self, error=None):
+        self.error = error
+        self.calls = 0
+
+    async def __call__(self, idempotency_key=None, quantity=1):
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        return {"message": "Sale recorded successfully", "quantity": quantity}
+
+
+def stored(db, key_id):
+    return db.raw[IDEMPOTENCY_KEYS].find_one({"_id": key_id})
+
+
+def test_completed_request_is_replayed(db):
+    store = IdempotencyStore(db)
+    endpoint = Endpoint()
+    guarded = store.guard("record-sale")(endpoint)
+    first = asyncio.run(guarded(idempotency_key="k1", quantity=2))
+    store.cache.clear()  # Replay from MongoDB, as another worker would
+    replay = asyncio.run(guarded(idempotency_key="k1", quantity=2))
+    assert endpoint.calls == 1
+    assert isinstance(replay, JSONResponse)
+    assert replay.headers["Idempotent-Replayed"] == "true"
+    assert replay.body == JSONResponse(first).body
+
+
+def test_key_reused_with_other_parameters_is_rejected(db):
+    guarded = IdempotencyStore(db).guard("record-sale")(Endpoint())
+    asyncio.run(guarded(idempotency_key="k1", quantity=2))
+    with pytest.raises(HTTPException) as raised:
+        asyncio.run(guarded(idempotency_key="k1", quantity=3))
+    assert raised.value.status_code == 422
+
+
+def test_client_error_releases_the_key(db):
+    store = IdempotencyStore(db)
+    endpoint = Endpoint(HTTPException(status_code=400, detail="Insufficient stock"))
+    guarded = store.guard("record-sale")(endpoint)
+    with pytest.raises(HTTPException):
+        asyncio.run(guarded(idempotency_key="k1"))
+    assert stored(db, "record-sale:k1") is None
+
+    endpoint.error = None
+    asyncio.run(guarded(idempotency_key="k1"))
+    assert endpoint.calls == 2
+    assert stored(db, "record-sale:k1")["state"] == "done"
+
+
+@pytest.mark.parametrize("error", [HTTPException(status_code=503, detail="Unavailable"), RuntimeError("connection reset")])
+def test_other_failures_are_stored_as_500(db, error):
+    store = IdempotencyStore(db)
+    endpoint = Endpoint(error)
+    guarded = store.guard("record-sale")(endpoint)
+    with pytest.raises(type(error)):
+        asyncio.run(guarded(idempotency_key="k1"))
+    document = stored(db, "record-sale:k1")
+    assert document["state"] == "failed"
+    assert document["status_code"] == 500
+
+    # The retry must not run the endpoint again, from this worker or another
+    for clear_cache in (False, True):
+        if clear_cache:
+            store.cache.clear()
+        replay = asyncio.run(guarded(idempotency_key="k1"))
+        assert replay.status_code == 500
+        assert replay.body == JSONResponse(FAILED_RESPONSE).body
+    assert endpoint.calls == 1
+
+
+def test_unrecorded_failure_leaves_the_claim_pending(db, caplog, monkeypatch):
+    store = IdempotencyStore(db)
+    guarded = store.guard("record-sale")(Endpoint(RuntimeError("connection reset")))
+
+    async def update_one(*args, **kwargs):
+        raise RuntimeError("primary stepped down")
+    monkeypatch.setattr(db.db[IDEMPOTENCY_KEYS], "update_one", update_one, raising=False)
+    with pytest.raises(RuntimeError):
+        asyncio.run(guarded(idempotency_key="k1"))
+    monkeypatch.undo()
+
+    assert stored(db, "record-sale:k1")["state"] == "pending"
+    assert "record-sale:k1" not in store.cache
+    assert "Could not record the failure of record-sale:k1" in caplog.text
+    with pytest.raises(HTTPException) as raised:
+        asyncio.run(guarded(idempotency_key="k1"))
+    assert raised.value.status_code == 409
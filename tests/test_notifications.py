@@ -0,0 +1,111 @@
+import asyncio
+from email import message_from_bytes
+from notifications import EmailNotifier, digest
+
+
+# Just enough of an SMTP server on localhost to receive plain (no TLS, no login) mail.
+# `refuse` answers that many MAIL commands with a temporary failure first.
+class SMTPStandIn:
+    def __init__(self, refuse=0):
+        self.refuse = refuse
+        self.messages = []
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        writer.write(b"220 stand-in\r\n")
+        while line := await reader.readline():
+            command = line[:4].upper()
+            if command == b"MAIL" and self.refuse:
+                self.refuse -= 1
+                reply = b"451 try again"
+            elif command == b"DATA":
+                writer.write(b"354 go ahead\r\n")
+                data = b"".join([chunk async for chunk in self.read_data(reader)])
+                self.messages.append(message_from_bytes(data))
+                reply = b"250 queued"
+            elif command == b"QUIT":
+                writer.write(b"221 bye\r\n")
+                break
+            else:
+                reply = b"250 ok"
+            writer.write(reply + b"\r\n")
+            await writer.drain()
+        writer.close()
+
+    async def read_data(self, reader):
+        while (line := await reader.readline()) != b".\r\n":
+            yield line
+
+
+def run_notifier(smtp, send, **options):
+    async def run():
+        port = await smtp.start()
+        notifier = EmailNotifier("127.0.0.1", port, "inventory@example.com", None, "ops@example.com",
+                                 use_tls=False, require_login=False, **options)
+        await notifier.start()
+        await send(notifier)
+        await notifier.stop()
+        await smtp.stop()
+        return notifier
+    return asyncio.run(run())
+
+
+def test_burst_goes_out_as_one_digest():
+    smtp = SMTPStandIn()
+
+    async def send(notifier):
+        for i in range(3):
+            assert notifier.notify(f"Sale {i}", f"body {i}")
+    notifier = run_notifier(smtp, send, digest_window=0.2)
+    assert notifier.sent == 1
+    [message] = smtp.messages
+    assert message["Subject"] == "Inventory Digest: 3 notifications"
+    assert message["To"] == "ops@example.com"
+    assert "=== Sale 2 ===" in message.get_payload()[0].get_payload()
+
+
+def test_failed_delivery_is_retried():
+    smtp = SMTPStandIn(refuse=2)
+
+    async def send(notifier):
+        notifier.notify("Low stock", "Fan")
+    notifier = run_notifier(smtp, send, digest_window=0, retry_backoff=0)
+    assert (notifier.sent, notifier.failed) == (1, 0)
+    assert [message["Subject"] for message in smtp.messages] == ["Low stock"]
+
+
+def test_delivery_gives_up_after_max_retries():
+    smtp = SMTPStandIn(refuse=10)
+
+    async def send(notifier):
+        notifier.notify("Low stock", "Fan")
+    notifier = run_notifier(smtp, send, digest_window=0, retry_backoff=0, max_retries=2)
+    assert (notifier.sent, notifier.failed) == (0, 1)
+    assert smtp.messages == []
+
+
+def test_full_queue_drops_instead_of_blocking():
+    smtp = SMTPStandIn()
+
+    async def send(notifier):
+        assert [notifier.notify("n", str(i)) for i in range(3)] == [True, True, False]
+    notifier = run_notifier(smtp, send, queue_size=2, digest_window=0.1)
+    assert notifier.dropped == 1
+
+
+def test_disabled_without_password():
+    notifier = EmailNotifier("127.0.0.1", 25, "inventory@example.com", None, "ops@example.com")
+    asyncio.run(notifier.start())
+    assert notifier.notify("Low stock", "Fan") is False
+    assert notifier.dropped == 1
+
+
+def test_single_message_is_not_wrapped():
+    assert digest([("Low stock", "Fan")]) == ("Low stock", "Fan")
@@ -0,0 +1,100 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from itertools import count
+from bson import ObjectId
+import pytest
+from audit import StockLogWriter
+from reconcile import RECONCILIATION, STOCK_LEDGER, StockReconciler
+from stock import StockEngine
+
+serials = count()
+
+
+# An ObjectId generated `seconds` ago
+def id_from(seconds):
+    when = datetime.now(timezone.utc) - timedelta(seconds=seconds)
+    return ObjectId(int(when.timestamp()).to_bytes(4, "big") + next(serials).to_bytes(8, "big"))
+
+
+# A stock_log entry old enough to be folded
+def entry(product_id, action, quantity_changed, remaining_stock, seconds=60):
+    when = datetime.now(timezone.utc) - timedelta(seconds=seconds)
+    return {
+        "_id": id_from(seconds),
+        "date": when, "action": action, "product_id": product_id,
+        "quantity_changed": quantity_changed, "remaining_stock": remaining_stock,
+    }
+
+
+@pytest.fixture
+def reconciler(db):
+    db.raw.products.insert_many([
+        {"product_id": "p1", "name": "Fan", "stock_quantity": 7},
+        {"product_id": "p2", "name": "Lamp", "stock_quantity": 5},
+    ])
+    db.raw.stock_log.insert_many([
+        entry("p1", "add", 10, 10), entry("p1", "sale", -3, 7),
+        entry("p2", "add", 4, 4), entry("p2", "sale", -1, 3),
+    ])
+    return StockReconciler(db, StockEngine(db), StockLogWriter(db), settle=0, partitions=2)
+
+
+def test_mismatch_is_found_and_the_log_is_folded_once(reconciler, db):
+    report = asyncio.run(reconciler.run())
+    assert (report["products_checked"], report["products_folded"], report["partitions"]) == (2, 2, 2)
+    [mismatch] = report["mismatches"]
+    assert (mismatch["name"], mismatch["expected"], mismatch["difference"]) == ("Lamp", 3, 2)
+    assert mismatch["last_logged_stock"] == 3
+
+    # Only entries since the checkpoint are folded on the next run, here half a minute later
+    checkpoint = id_from(30)
+    db.raw[RECONCILIATION].update_one({"_id": "stock_log"}, {"$set": {"position": checkpoint}})
+    db.raw[STOCK_LEDGER].update_many({}, {"$set": {"position": checkpoint}})
+    db.raw.stock_log.insert_one(entry("p1", "sale", -2, 5, seconds=10))
+    db.raw.products.update_one({"product_id": "p1"}, {"$inc": {"stock_quantity": -2}})
+    report = asyncio.run(reconciler.run())
+    assert report["previous_checkpoint"] is not None
+    assert report["products_folded"] == 1
+    assert [row["name"] for row in report["mismatches"]] == ["Lamp"]
+    assert db.raw[STOCK_LEDGER].find_one({"_id": "p1"})["quantity"] == 5
+
+
+def test_repair_is_logged_and_not_counted_again(reconciler, db):
+    report = asyncio.run(reconciler.run(repair=True, performed_by="ops"))
+    assert report["repaired"] == 1
+    assert report["mismatches"][0]["repair"] == "repaired"
+    assert db.raw.products.find_one({"product_id": "p2"})["stock_quantity"] == 3
+    repair = db.raw.stock_log.find_one({"action": "reconcile"})
+    assert (repair["quantity_changed"], repair["remaining_stock"], repair["performed_by"]) == (-2, 3, "ops")
+    assert asyncio.run(reconciler.run())["mismatch_count"] == 0
+
+
+def test_mismatch_that_moves_before_the_second_read_is_left_alone(reconciler, db, monkeypatch):
+    confirm = reconciler._confirm
+
+    # A sale of a Lamp lands between the two reads
+    async def confirm_after_sale(mismatches, since):
+        db.raw.products.update_one({"product_id": "p2"}, {"$inc": {"stock_quantity": -1}})
+        return await confirm(mismatches, since)
+    monkeypatch.setattr(reconciler, "_confirm", confirm_after_sale)
+    report = asyncio.run(reconciler.run(repair=True))
+    assert (report["repaired"], report["mismatches"][0]["repair"]) == (0, "unconfirmed")
+    assert db.raw.products.find_one({"product_id": "p2"})["stock_quantity"] == 4
+
+
+def test_rerun_of_an_interrupted_window_does_not_count_twice(reconciler, db):
+    asyncio.run(reconciler.run())
+    # As if the run had died after folding, before moving the checkpoint
+    state = db.raw[RECONCILIATION].find_one({"_id": "stock_log"})
+    db.raw[RECONCILIATION].update_one({"_id": "stock_log"}, {"$set": {"pending": state["position"]}, "$unset": {"position": ""}})
+    report = asyncio.run(reconciler.run())
+    assert report["products_folded"] == 0
+    assert db.raw[STOCK_LEDGER].find_one({"_id": "p1"})["quantity"] == 7
+    assert [row["name"] for row in report["mismatches"]] == ["Lamp"]
+
+
+def test_run_is_skipped_while_another_worker_holds_the_lease(reconciler, db):
+    db.raw[RECONCILIATION].insert_one({
+        "_id": "stock_log", "owner": "other:1", "lease_until": datetime.now(timezone.utc) + timedelta(hours=1),
+    })
+    assert asyncio.run(reconciler.run()) is None
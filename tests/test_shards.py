@@ -0,0 +1,69 @@
+import asyncio
+import pytest
+from shards import STOCK_SHARDS, ShardedStock
+from stock import InsufficientStock
+
+
+def shard_quantities(db):
+    return {shard["_id"]: shard["quantity"] for shard in db.raw[STOCK_SHARDS].find()}
+
+
+def stock_of(db):
+    return db.raw.products.find_one({"product_id": "p1"})["stock_quantity"]
+
+
+@pytest.fixture
+def sharded(db):
+    db.raw.products.insert_one({"product_id": "p1", "name": "Fan", "stock_quantity": 10})
+    stock = ShardedStock(db)
+    product = asyncio.run(stock.enable("p1", 3))
+    return db, stock, product
+
+
+def test_enable_spreads_the_stock_once(sharded):
+    db, stock, product = sharded
+    assert product["stock_shards"] == 3
+    assert shard_quantities(db) == {"p1:0": 4, "p1:1": 3, "p1:2": 3}
+    assert asyncio.run(stock.enable("p1", 5)) is None
+
+
+def test_decrements_come_from_one_shard_or_several(sharded):
+    db, stock, product = sharded
+    asyncio.run(stock.read("p1"))
+    assert asyncio.run(stock.adjust(product, -3))["stock_quantity"] == 7
+    assert sorted(shard_quantities(db).values()) in ([0, 3, 4], [1, 3, 3])
+    assert asyncio.run(stock.adjust(product, -6))["stock_quantity"] == 1
+    assert asyncio.run(stock.adjust(product, 2))["stock_quantity"] == 3
+
+
+def test_shortfall_leaves_every_shard_as_it_was(sharded):
+    db, stock, product = sharded
+    with pytest.raises(InsufficientStock):
+        asyncio.run(stock.adjust(product, -11))
+    assert shard_quantities(db) == {"p1:0": 4, "p1:1": 3, "p1:2": 3}
+
+
+def test_rebalance_refreshes_the_total_and_evens_out_shards(sharded):
+    db, stock, product = sharded
+    db.raw[STOCK_SHARDS].update_one({"_id": "p1:0"}, {"$set": {"quantity": 12}})
+    db.raw[STOCK_SHARDS].update_one({"_id": "p1:1"}, {"$set": {"quantity": 0}})
+    asyncio.run(stock.rebalance())
+    assert stock_of(db) == 15
+    assert shard_quantities(db) == {"p1:0": 6, "p1:1": 6, "p1:2": 3}
+
+
+def test_move_does_nothing_when_the_source_ran_short(sharded):
+    db, stock, product = sharded
+    asyncio.run(stock._move("p1:1", "p1:2", 5))
+    assert shard_quantities(db) == {"p1:0": 4, "p1:1": 3, "p1:2": 3}
+
+
+def test_disable_folds_shards_back_including_late_writes(sharded):
+    db, stock, product = sharded
+    assert asyncio.run(stock.disable("p1"))["stock_quantity"] == 10
+    assert "stock_shards" not in db.raw.products.find_one({"product_id": "p1"})
+    # A worker that had not seen the flag go adds to a shard; the rebalancer drains it
+    db.raw[STOCK_SHARDS].update_one({"_id": "p1:2"}, {"$inc": {"quantity": 2}})
+    asyncio.run(stock.rebalance())
+    assert stock_of(db) == 12
+    assert set(shard_quantities(db).values()) == {0}
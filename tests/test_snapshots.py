@@ -0,0 +1,50 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+import pytest
+from snapshots import STOCK_SNAPSHOTS, SnapshotCompactor, product_stock_at, stock_at
+
+DAY = timedelta(days=1)
+# 09:00 UTC six days ago, so compaction only has a week to catch up on
+START = datetime.now(timezone.utc).replace(hour=9, minute=0, second=0, microsecond=0) - 6 * DAY
+
+
+@pytest.fixture
+def history(db):
+    # Every six hours over four days, Fan's stock counts down and Lamp's counts up
+    entries = []
+    for step in range(16):
+        when = START + step * timedelta(hours=6)
+        entries.append({"product_id": "p1", "remaining_stock": 100 - step, "date": when.replace(tzinfo=None)})
+        if step % 2:
+            entries.append({"product_id": "p2", "remaining_stock": step, "date": when.replace(tzinfo=None)})
+    db.raw.stock_log.insert_many(entries)
+    return db
+
+
+def test_snapshots_fall_on_utc_midnights_and_are_written_once(history):
+    compactor = SnapshotCompactor(history, settle=0)
+    written = asyncio.run(compactor.compact())
+    snapshots = list(history.raw[STOCK_SNAPSHOTS].find().sort("_id", 1))
+    assert written == len(snapshots) > 4
+    assert snapshots[0]["_id"] == (START + DAY).replace(hour=0, tzinfo=None)
+    # Entries logged at 09:00, 15:00 and 21:00 on the first day
+    assert {p["product_id"]: p["stock_quantity"] for p in snapshots[0]["products"]} == {"p1": 98, "p2": 1}
+    assert asyncio.run(compactor.compact()) == 0
+
+
+@pytest.mark.parametrize("hours", [0, 5, 6, 20, 30, 47, 100, 1000])
+def test_stock_at_matches_replaying_the_log(history, hours):
+    asyncio.run(SnapshotCompactor(history, settle=0).compact())
+    when = START + timedelta(hours=hours)
+    expected = {}
+    for entry in history.raw.stock_log.find().sort("date", 1):
+        if entry["date"] <= when.replace(tzinfo=None):
+            expected[entry["product_id"]] = entry["remaining_stock"]
+    assert asyncio.run(stock_at(history, when)) == expected
+    assert asyncio.run(product_stock_at(history, "p1", when)) == expected.get("p1")
+
+
+def test_nothing_to_compact_without_a_log(db):
+    assert asyncio.run(SnapshotCompactor(db, settle=0).compact()) == 0
+    assert asyncio.run(stock_at(db, START)) == {}
+    assert asyncio.run(product_stock_at(db, "p1", START)) is None
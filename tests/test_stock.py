@@ -0,0 +1,137 @@
+import asyncio
+import pytest
+from stock import InsufficientStock, ProductNotFound, StockChange, StockEngine
+
+
+class RecordingCache:
+    def __init__(self, db):
+        self.db = db
+        self.put_names = []
+        self.invalidated = []
+
+    def peek(self, name):
+        return None
+
+    async def get_many(self, names):
+        return {product["name"]: product async for product in self.db.products.find({"name": {"$in": names}})}
+
+    def put(self, product):
+        self.put_names.append(product["name"])
+
+    def invalidate(self, name):
+        self.invalidated.append(name)
+
+
+# Runs the callback once, as with_transaction does when nothing conflicts
+class FakeSession:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def with_transaction(self, callback):
+        return await callback(self)
+
+
+class FakeClient:
+    def start_session(self):
+        return FakeSession()
+
+
+def stock_of(db, name):
+    return db.raw.products.find_one({"name": name})["stock_quantity"]
+
+
+@pytest.fixture
+def products(db):
+    db.raw.products.insert_many([
+        {"product_id": "p1", "name": "Fan", "stock_quantity": 5},
+        {"product_id": "p2", "name": "Lamp", "stock_quantity": 1},
+    ])
+    return db
+
+
+def test_batch_reports_remaining_stock_per_line(products):
+    engine = StockEngine(products)
+    engine.transactions_supported = False
+    changes = [StockChange("Fan", -2), StockChange("Lamp", -1), StockChange("Fan", -1)]
+    results = asyncio.run(engine.apply(changes))
+    assert [result.remaining_stock for result in results] == [3, 0, 2]
+    assert stock_of(products, "Fan") == 2
+    assert stock_of(products, "Lamp") == 0
+
+
+def test_compensation_puts_back_stock_on_insufficient_stock(products):
+    cache = RecordingCache(products)
+    engine = StockEngine(products, cache=cache)
+    engine.transactions_supported = False
+    with pytest.raises(InsufficientStock) as raised:
+        asyncio.run(engine.apply([StockChange("Fan", -2), StockChange("Lamp", -3)]))
+    assert raised.value.name == "Lamp"
+    assert stock_of(products, "Fan") == 5
+    assert stock_of(products, "Lamp") == 1
+    assert cache.invalidated == ["Fan"]
+    assert cache.put_names == []
+
+
+def test_batch_without_transactions_is_one_guarded_write(products, monkeypatch):
+    engine = StockEngine(products)
+    engine.transactions_supported = False
+    calls = []
+    bulk_write = products.products.bulk_write
+
+    async def counting_bulk_write(operations, **kwargs):
+        calls.append(len(operations))
+        return await bulk_write(operations, **kwargs)
+    monkeypatch.setattr(products.products, "bulk_write", counting_bulk_write)
+    asyncio.run(engine.apply([StockChange("Fan", -2), StockChange("Lamp", -1)]))
+    assert calls == [2]
+
+
+def test_compensation_leaves_set_fields_unwritten(products):
+    engine = StockEngine(products)
+    engine.transactions_supported = False
+    with pytest.raises(InsufficientStock):
+        asyncio.run(engine.apply([StockChange("Fan", -2), StockChange("Lamp", -3)], set_fields={"supplier": "new"}))
+    assert products.raw.products.count_documents({"supplier": "new"}) == 0
+
+    asyncio.run(engine.apply([StockChange("Fan", -2), StockChange("Lamp", -1)], set_fields={"supplier": "new"}))
+    assert products.raw.products.count_documents({"supplier": "new"}) == 2
+
+
+def test_compensation_puts_back_stock_on_unknown_product(products):
+    engine = StockEngine(products)
+    engine.transactions_supported = False
+    with pytest.raises(ProductNotFound) as raised:
+        asyncio.run(engine.apply([StockChange("Fan", -2), StockChange("Heater", -1)]))
+    assert raised.value.name == "Heater"
+    assert stock_of(products, "Fan") == 5
+
+
+def test_transaction_checks_stock_before_writing(products):
+    products.client = FakeClient()
+    engine = StockEngine(products)
+    engine.transactions_supported = True
+    with pytest.raises(InsufficientStock) as raised:
+        asyncio.run(engine.apply([StockChange("Fan", -2), StockChange("Lamp", -3)]))
+    assert raised.value.name == "Lamp"
+    assert stock_of(products, "Fan") == 5
+
+
+def test_transaction_names_the_product_its_guard_rejected(products):
+    products.client = FakeClient()
+    engine = StockEngine(products)
+    engine.transactions_supported = True
+    products.raw.products.insert_one({"product_id": "p3", "name": "Bulb", "stock_quantity": 4})
+    bulk_write = products.products.bulk_write
+
+    # Another writer takes Bulb's stock between the snapshot read and the guarded update
+    async def racing_bulk_write(operations, **kwargs):
+        products.raw.products.update_one({"name": "Bulb"}, {"$set": {"stock_quantity": 1}})
+        return await bulk_write(operations, **kwargs)
+    products.products.bulk_write = racing_bulk_write
+
+    with pytest.raises(InsufficientStock) as raised:
+        asyncio.run(engine.apply([StockChange("Fan", -3), StockChange("Bulb", -2)]))
+    assert raised.value.name == "Bulb"
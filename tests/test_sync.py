@@ -0,0 +1,83 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from itertools import count
+from bson import ObjectId
+import pytest
+from sync import ChangeFeed, event
+from versions import VersionCounters
+
+serials = count()
+
+
+# An ObjectId generated `seconds` ago
+def id_from(seconds: float) -> ObjectId:
+    when = datetime.now(timezone.utc) - timedelta(seconds=seconds)
+    return ObjectId(int(when.timestamp()).to_bytes(4, "big") + next(serials).to_bytes(8, "big"))
+
+
+def log(seconds, product_id="p1"):
+    return {"_id": id_from(seconds), "product_id": product_id, "date": datetime(2024, 1, 1), "quantity_changed": -1}
+
+
+@pytest.fixture
+def feed(db):
+    db.raw.products.insert_many([
+        {"product_id": "p1", "name": "Fan", "stock_quantity": 5}, {"product_id": "p2", "name": "Lamp", "stock_quantity": 1},
+    ])
+    return ChangeFeed(db, VersionCounters(db, refresh_interval=0), settle=5, poll_interval=0.01, page_size=2)
+
+
+def test_delta_holds_back_documents_that_have_not_settled(feed, db):
+    start = id_from(100)
+    settled, fresh = log(30), log(0)
+    db.raw.stock_log.insert_many([settled, fresh])
+    delta = asyncio.run(feed.changes(start))
+    assert [entry["_id"] for entry in delta["stock_log"]] == [settled["_id"]]
+    assert [product["name"] for product in delta["products"]] == ["Fan"]
+    assert not delta["more"]
+    assert ObjectId(delta["token"]) < fresh["_id"]
+    assert asyncio.run(feed.changes(ObjectId(delta["token"])))["stock_log"] == []
+
+
+def test_pages_stop_every_collection_at_the_same_id(feed, db):
+    entries = [log(40), log(30, "p2"), log(10)]
+    sales = [{"_id": id_from(35)}, {"_id": id_from(20)}]
+    db.raw.stock_log.insert_many(entries)
+    db.raw.sales.insert_many(sales)
+    first = asyncio.run(feed.changes(id_from(100)))
+    assert first["more"]
+    assert first["token"] == str(entries[1]["_id"])
+    assert [entry["_id"] for entry in first["stock_log"]] == [entries[0]["_id"], entries[1]["_id"]]
+    assert first["sales"] == [sales[0]]
+    assert [product["name"] for product in first["products"]] == ["Fan", "Lamp"]
+
+    second = asyncio.run(feed.changes(ObjectId(first["token"])))
+    assert not second["more"]
+    assert [entry["_id"] for entry in second["stock_log"]] == [entries[2]["_id"]]
+    assert second["sales"] == [sales[1]]
+
+
+def test_snapshot_is_the_catalog_and_a_token(feed):
+    snapshot = asyncio.run(feed.snapshot())
+    assert [product["name"] for product in snapshot["products"]] == ["Fan", "Lamp"]
+    assert ObjectId(snapshot["token"]).generation_time < datetime.now(timezone.utc) - timedelta(seconds=5)
+    assert event("snapshot", snapshot).startswith(b"id: " + snapshot["token"].encode() + b"\nevent: snapshot\n")
+
+
+def test_long_poll_times_out_with_an_empty_delta(feed):
+    delta = asyncio.run(feed.wait(id_from(100), timeout=0.05))
+    assert (delta["stock_log"], delta["sales"]) == ([], [])
+
+
+def test_long_poll_returns_once_a_write_is_seen(feed, db):
+    async def run():
+        async def write_later():
+            await asyncio.sleep(0.05)
+            db.raw.stock_log.insert_one(log(30))
+            await feed.versions.bump("products")
+        writer = asyncio.create_task(write_later())
+        delta = await feed.wait(id_from(100), timeout=10)
+        await writer
+        return delta
+    delta = asyncio.run(run())
+    assert len(delta["stock_log"]) == 1
@@ -0,0 +1,85 @@
+import asyncio
+from datetime import datetime, timezone
+from email.utils import format_datetime
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+from versions import VERSIONS, VERSIONS_ID, VersionCounters
+
+
+@pytest.fixture
+def app(db):
+    versions = VersionCounters(db, refresh_interval=0)
+    app = FastAPI()
+    calls = []
+
+    @app.get("/products")
+    @versions.conditional("products")
+    async def products(request: Request, page: int = 1):
+        calls.append(page)
+        return {"page": page}
+
+    @app.get("/records")
+    @versions.conditional(lambda params: [params["kind"]] if params["kind"] in ("sales", "returns") else None)
+    async def records(request: Request, kind: str):
+        calls.append(kind)
+        return {"kind": kind}
+
+    app.state.versions, app.state.calls = versions, calls
+    return app
+
+
+def test_unchanged_collection_answers_304(app):
+    client = TestClient(app)
+    first = client.get("/products")
+    assert first.status_code == 200
+    assert first.json() == {"page": 1}
+    etag = first.headers["ETag"]
+
+    assert client.get("/products", headers={"If-None-Match": etag}).status_code == 304
+    assert client.get("/products?page=2", headers={"If-None-Match": etag}).status_code == 200
+    assert app.state.calls == [1, 2]
+
+    asyncio.run(app.state.versions.bump("products"))
+    changed = client.get("/products", headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
+
+
+def test_last_modified_follows_the_newest_bump(app):
+    client = TestClient(app)
+    asyncio.run(app.state.versions.bump("sales"))
+    last_modified = client.get("/records?kind=sales").headers["Last-Modified"]
+    assert client.get("/records?kind=sales", headers={"If-Modified-Since": last_modified}).status_code == 304
+    long_ago = format_datetime(datetime(2000, 1, 1, tzinfo=timezone.utc), usegmt=True)
+    assert client.get("/records?kind=sales", headers={"If-Modified-Since": long_ago}).status_code == 200
+    # Skipped validation leaves the response alone
+    assert "ETag" not in client.get("/records?kind=other").headers
+
+
+def test_bumps_are_flushed_as_one_increment(db):
+    versions = VersionCounters(db, refresh_interval=60, flush_interval=60)
+
+    async def run():
+        versions.start()
+        for _ in range(3):
+            await versions.bump("products", "sales")
+        [products] = await versions.current(["products"])
+        assert products["version"] == 3
+        assert db.raw[VERSIONS].find_one({"_id": VERSIONS_ID}) is None
+        await versions.stop()
+    asyncio.run(run())
+    doc = db.raw[VERSIONS].find_one({"_id": VERSIONS_ID})
+    assert (doc["products"]["version"], doc["sales"]["version"]) == (3, 3)
+    assert versions.pending == {}
+
+
+def test_other_workers_changes_call_the_listeners(db):
+    ours, theirs = VersionCounters(db, refresh_interval=0), VersionCounters(db, refresh_interval=0)
+    dropped = []
+    ours.on_change("products", lambda: dropped.append("products"))
+    asyncio.run(ours.bump("products"))
+    assert dropped == []
+    asyncio.run(theirs.bump("products"))
+    asyncio.run(ours.current(["products"]))
+    assert dropped == ["products"]
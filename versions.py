@@ -0,0 +1,168 @@
+import asyncio
+import functools
+import logging
+import time
+import zlib
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Callable, Dict, Iterable, List, Optional, Union
+from fastapi import Request, Response
+from pymongo import ReturnDocument
+from responses import FastJSONResponse
+
+logger = logging.getLogger(__name__)
+
+VERSIONS = "collection_versions"
+VERSIONS_ID = "versions"  # One document: {<collection>: {version, modified_at}, ...}
+
+
+# Monotonic change counters per collection, bumped by the write paths and used as
+# HTTP validators (ETag / Last-Modified) for the read endpoints. All counters live in
+# one document. Reads answer from the local copy, which is refreshed from MongoDB at
+# most every `refresh_interval` seconds. Once started, bumps are counted locally and
+# flushed every `flush_interval` seconds as a single $inc per worker, so writes do not
+# queue on that one document or wait for it; this worker's own writes are visible at
+# once, other workers' after at most both intervals.
+class VersionCounters:
+    def __init__(self, db, refresh_interval: float = 1.0, flush_interval: float = 0.25):
+        self.db = db
+        self.refresh_interval = refresh_interval
+        self.flush_interval = flush_interval
+        self.counters: Dict[str, dict] = {}
+        self.pending: Dict[str, int] = {}  # Bumps not yet written to MongoDB
+        self.pending_at: Dict[str, datetime] = {}
+        self.fresh_until = 0.0
+        self.listeners: Dict[str, List[Callable[[], None]]] = {}
+        self.task: Optional[asyncio.Task] = None
+
+    # Call `callback` when another worker is seen changing `collection`, e.g. to drop
+    # cached data so it is not served under the newer ETag
+    def on_change(self, collection: str, callback: Callable[[], None]):
+        self.listeners.setdefault(collection, []).append(callback)
+
+    # `own` are how many bumps of each collection this worker just wrote
+    def _load(self, doc: Optional[dict], own: Optional[Dict[str, int]] = None):
+        own = own or {}
+        for name, counter in (doc or {}).items():
+            if name == "_id":
+                continue
+            known = self.counters.get(name, {"version": 0})["version"]
+            if counter["version"] <= known:
+                continue
+            self.counters[name] = counter
+            if counter["version"] > known + own.get(name, 0):
+                for callback in self.listeners.get(name, []):
+                    callback()
+
+    async def bump(self, *collections: str):
+        now = datetime.now(timezone.utc).replace(tzinfo=None)  # As MongoDB hands dates back
+        for name in collections:
+            self.pending[name] = self.pending.get(name, 0) + 1
+            self.pending_at[name] = now
+        if self.task is None:
+            await self.flush()
+
+    async def flush(self):
+        pending, pending_at = self.pending, self.pending_at
+        if not pending:
+            return
+        self.pending, self.pending_at = {}, {}
+        try:
+            doc = await self.db.db[VERSIONS].find_one_and_update(
+                {"_id": VERSIONS_ID},
+                {
+                    "$inc": {f"{name}.version": count for name, count in pending.items()},
+                    "$max": {f"{name}.modified_at": when for name, when in pending_at.items()},
+                },
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except Exception:
+            # Keep the bumps, and any made meanwhile, for the next flush
+            for name, count in pending.items():
+                self.pending[name] = self.pending.get(name, 0) + count
+                self.pending_at.setdefault(name, pending_at[name])
+            raise
+        self._load(doc, own=pending)
+
+    async def current(self, collections: Iterable[str]) -> List[dict]:
+        if time.monotonic() >= self.fresh_until:
+            self._load(await self.db.db[VERSIONS].find_one({"_id": VERSIONS_ID}))
+            self.fresh_until = time.monotonic() + self.refresh_interval
+        counters = []
+        for name in collections:
+            counter = self.counters.get(name, {"version": 0, "modified_at": None})
+            if name in self.pending:
+                modified = max(filter(None, [counter["modified_at"], self.pending_at[name]]))
+                counter = {"version": counter["version"] + self.pending[name], "modified_at": modified}
+            counters.append(counter)
+        return counters
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error("Could not flush collection version bumps: %s", e)
+
+    def start(self):
+        if self.flush_interval > 0:
+            self.task = asyncio.create_task(self._run(), name="version-flusher")
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        await self.flush()
+
+    # Decorator for GET endpoints taking a `request` parameter. `collections` names what
+    # the response is built from, or is a function of the endpoint's parameters returning
+    # the names (None to skip validation, e.g. for a request the endpoint will reject).
+    # The ETag combines the counters with the query string, so each filter/page has its own.
+    def conditional(self, collections: Union[str, Callable[[dict], Optional[List[str]]]]):
+        def decorate(endpoint):
+            @functools.wraps(endpoint)
+            async def wrapper(**params):
+                names = collections(params) if callable(collections) else [collections]
+                if not names:
+                    return await endpoint(**params)
+                request: Request = params["request"]
+                counters = await self.current(names)
+                variant = zlib.crc32(request.url.query.encode())
+                etag = 'W/"' + "-".join(str(c["version"]) for c in counters) + f'-{variant:08x}"'
+                headers = {"ETag": etag, "Cache-Control": "no-cache"}
+                modified = [c["modified_at"] for c in counters if c["modified_at"] is not None]
+                last_modified = max(modified).replace(tzinfo=timezone.utc) if modified else None
+                if last_modified is not None:
+                    headers["Last-Modified"] = format_datetime(last_modified, usegmt=True)
+
+                if not_modified(request, etag, last_modified):
+                    return Response(status_code=304, headers=headers)
+
+                response = await endpoint(**params)
+                if not isinstance(response, Response):
+                    response = FastJSONResponse(response)
+                response.headers.update(headers)
+                return response
+            return wrapper
+        return decorate
+
+
+# If-None-Match wins over If-Modified-Since, as in RFC 9110
+def not_modified(request: Request, etag: str, last_modified: Optional[datetime]) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or any(tag.removeprefix("W/") == etag.removeprefix("W/") for tag in tags)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is None or last_modified is None:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    return last_modified.replace(microsecond=0) <= since